@@ -0,0 +1,132 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Runs a hook of the charm inside a FakeEnvironment sandbox, see
+# fakeenv.py. The absolute paths the charm manages are relocated below
+# $FAKE_ROOT, rtnetlink answers and the apt cache come from the sandbox,
+# everything else is the real pg_edge_hooks entry point.
+#
+# usage: fake_hook.py <hook-name>
+
+import json
+import os
+import socket
+import struct
+import sys
+from collections import OrderedDict
+
+ROOT = os.environ['FAKE_ROOT']
+
+
+def relocate(path):
+    if path.startswith(ROOT):
+        return path
+    return os.path.join(ROOT, path.lstrip('/'))
+
+
+def sandbox_open(path, *args, **kwargs):
+    '''
+    open() for charmhelpers modules which write to fixed system paths.
+    '''
+    if os.path.isabs(path):
+        path = relocate(path)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'a').close()
+    return open(path, *args, **kwargs)
+
+
+def netlink_dump(net, interfaces):
+    '''
+    Returns a replacement of pg_edge_net._netlink_dump answering from the
+    interfaces of the sandbox.
+    '''
+    def rtattr(rta_type, payload):
+        length = net.RTATTR.size + len(payload)
+        return (net.RTATTR.pack(length, rta_type) + payload +
+                b'\0' * (net._align(length) - length))
+
+    def message(msg_type, payload):
+        return net.NLMSGHDR.pack(net.NLMSGHDR.size + len(payload), msg_type,
+                                 0, 1, 0) + payload
+
+    def dump(msg_type, payload):
+        messages = []
+        for iface in interfaces.values():
+            if msg_type == net.RTM_GETADDR:
+                for address in iface.get('addresses', []):
+                    ip, prefixlen = address.split('/')
+                    messages.append(message(
+                        net.RTM_NEWADDR,
+                        net.IFADDRMSG.pack(socket.AF_INET, int(prefixlen), 0,
+                                           0, iface['index']) +
+                        rtattr(net.IFA_LOCAL, socket.inet_aton(ip))))
+            else:
+                for route in iface.get('routes', []):
+                    network, dst_len = route.split('/')
+                    messages.append(message(net.RTM_NEWROUTE, net.RTMSG.pack(
+                        socket.AF_INET, int(dst_len), 0, 0, net.RT_TABLE_MAIN,
+                        2, net.RT_SCOPE_LINK, net.RTN_UNICAST, 0) +
+                        rtattr(net.RTA_DST, socket.inet_aton(network)) +
+                        rtattr(net.RTA_OIF, struct.pack('=I',
+                                                        iface['index']))))
+        return b''.join(messages) + message(net.NLMSG_DONE, b'\0' * 4)
+    return dump
+
+
+def sandbox():
+    '''
+    Points the charm at the sandbox before any hook code runs.
+    '''
+    import pg_edge_iptables
+    import pg_edge_jobs
+    import pg_edge_net
+    import pg_edge_utils
+    from charmhelpers import fetch
+    from charmhelpers.core import kernel
+
+    for name, value in list(vars(pg_edge_utils).items()):
+        if name.isupper() and isinstance(value, str) and value.startswith('/'):
+            setattr(pg_edge_utils, name, relocate(value))
+    pg_edge_utils.BASE_RESOURCE_MAP = OrderedDict(
+        (relocate(path), resources)
+        for path, resources in pg_edge_utils.BASE_RESOURCE_MAP.items())
+    # Directories which the PLUMgrid packages would have created
+    for path in (list(pg_edge_utils.BASE_RESOURCE_MAP) +
+                 [pg_edge_utils.AUTH_KEY_PATH, pg_edge_utils.SUDOERS_CONF,
+                  pg_edge_utils.PG_PID_FILE, pg_edge_utils.PG_SOURCES_LIST,
+                  pg_edge_utils.IOVISOR_MODULES_LOAD,
+                  os.path.join(pg_edge_utils.APT_ARCHIVES, 'lock')]):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    pg_edge_iptables.IPTABLES_RULES = relocate(pg_edge_iptables.IPTABLES_RULES)
+    pg_edge_net.SYS_CLASS_NET = relocate(pg_edge_net.SYS_CLASS_NET)
+    pg_edge_jobs.JOBS_DIR = relocate(pg_edge_jobs.JOBS_DIR)
+    pg_edge_jobs.SYSTEMD_DIR = relocate(pg_edge_jobs.SYSTEMD_DIR)
+    with open(os.path.join(os.environ['FAKE_ENV'], 'net.json')) as net:
+        pg_edge_net._netlink_dump = netlink_dump(pg_edge_net, json.load(net))
+    kernel.open = fetch.open = sandbox_open
+
+
+def prepare(hook):
+    '''
+    Sets up the interpreter as Juju would to run hook, in the sandbox.
+    '''
+    hooks_dir = os.path.join(os.environ['CHARM_DIR'], 'hooks')
+    sys.path.insert(0, hooks_dir)
+    # apt caches are built from the package state of the sandbox
+    sys.path.insert(0, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'fakeapt'))
+    sys.argv = [os.path.join(hooks_dir, hook)]
+    sandbox()
+
+
+def main():
+    prepare(sys.argv[1])
+    import pg_edge_hooks
+    pg_edge_hooks.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Stand-in for python-apt inside a FakeEnvironment sandbox.
+
+import apt_pkg  # noqa
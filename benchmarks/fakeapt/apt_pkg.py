@@ -0,0 +1,62 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Stand-in for python-apt inside a FakeEnvironment sandbox. The cache is
+# read from the package state kept by the fake apt-get and dpkg-query:
+# installed versions in $FAKE_ENV/dpkg/<package> and available versions,
+# one per line, in $FAKE_ENV/apt/<package>.
+
+import os
+import re
+
+
+class _Config(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+config = _Config()
+
+
+def init():
+    pass
+
+
+def upstream_version(version):
+    return re.sub(r'-[^-]*$', '', re.sub(r'^\d+:', '', version))
+
+
+class Version(object):
+
+    def __init__(self, ver_str):
+        self.ver_str = ver_str
+
+
+class Package(object):
+
+    def __init__(self, name, current, available):
+        self.name = name
+        self.current_ver = Version(current) if current else None
+        self.version_list = [Version(v) for v in available]
+
+
+def _read_lines(path):
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+class Cache(object):
+
+    def __init__(self, progress=None):
+        self._env = os.environ['FAKE_ENV']
+
+    def __getitem__(self, name):
+        current = _read_lines(os.path.join(self._env, 'dpkg', name))
+        available = _read_lines(os.path.join(self._env, 'apt', name))
+        if not current and not available:
+            raise KeyError(name)
+        return Package(name, current[0] if current else None,
+                       available or current)
@@ -0,0 +1,633 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# A local stand-in for the environment Juju runs hooks in. It provides
+# fake hook tools (config-get, relation-*, unit-get, status-set, juju-log)
+# and fake system commands (ip, service, apt-get, dpkg-query, iptables,
+# modprobe, ...) with configurable latency, backed by plain files in a
+# sandbox directory, and runs the real hooks of the charm against them.
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(CHARM_DIR, 'benchmarks')
+
+UNIT_NAME = 'plumgrid-edge/0'
+PRIVATE_ADDRESS = '10.0.0.10'
+
+HOOK_TOOLS = [
+    'config-get',
+    'is-leader',
+    'juju-log',
+    'leader-get',
+    'leader-set',
+    'open-port',
+    'relation-get',
+    'relation-ids',
+    'relation-list',
+    'related-units',
+    'relation-set',
+    'status-get',
+    'status-set',
+    'unit-get',
+]
+
+SYSTEM_COMMANDS = [
+    'aa-disable',
+    'add-apt-repository',
+    'apt-cache',
+    'apt-get',
+    'apt-key',
+    'depmod',
+    'dkms',
+    'dpkg-query',
+    'ifconfig',
+    'ip',
+    'iptables',
+    'iptables-restore',
+    'iptables-save',
+    'modprobe',
+    'nsenter',
+    'rmmod',
+    'service',
+    'sigmund-configure',
+    'sudo',
+    'systemctl',
+    'virsh',
+]
+
+FAKE_TOOL = r'''#!/bin/sh
+# Stand-in for Juju hook tools and system commands, see fakeenv.py.
+tool=${0##*/}
+env=$FAKE_ENV
+echo "$tool $*" >> "$env/calls.log"
+latency=$FAKE_LATENCY
+[ -f "$env/latency/$tool" ] && latency=$(cat "$env/latency/$tool")
+[ -n "$latency" ] && [ "$latency" != 0 ] && sleep "$latency"
+
+case $tool in
+    is-leader|leader-get|leader-set)
+        exec "$FAKE_PYTHON" "$FAKE_BENCH/fakeenv.py" "$tool" "$@" ;;
+    sudo) exec "$@" ;;
+    nsenter)
+        # Runs the command in the fake container by its name
+        while [ $# -gt 0 ]; do
+            case $1 in
+                -t) shift 2 ;;
+                -*) shift ;;
+                *) break ;;
+            esac
+        done
+        cmd=${1##*/}
+        shift
+        exec "$cmd" "$@" ;;
+    sigmund-configure)
+        echo "$*" > "$env/sigmund"
+        touch "$env/services/plumgrid-sigmund"
+        exit 0 ;;
+    dpkg-query)
+        for pkg; do :; done
+        [ -f "$env/dpkg/$pkg" ] || exit 1
+        printf 'install ok installed %s' "$(cat "$env/dpkg/$pkg")"
+        exit 0 ;;
+    iptables-restore) cat >> "$env/iptables-restore.log"; exit 0 ;;
+esac
+
+rid=$JUJU_RELATION_ID
+fmt=text
+args=
+download=
+simulate=
+while [ $# -gt 0 ]; do
+    case $1 in
+        --format=json) fmt=json ;;
+        --download-only) download=1 ;;
+        --simulate) simulate=1 ;;
+        -r) rid=$2; shift ;;
+        --help) [ "$tool" = relation-set ] && echo 'usage: relation-set'
+                exit 0 ;;
+        -) args="$args -" ;;
+        -*) ;;
+        *) args="$args $1" ;;
+    esac
+    shift
+done
+set -- $args
+
+answer() {
+    if [ -f "$1" ]; then cat "$1"; elif [ "$fmt" = json ]; then echo null; fi
+}
+
+build_module() {
+    # As the iovisor-dkms maintainer scripts and dkms would, every build
+    # differs from the last
+    modules=$FAKE_ROOT/lib/modules/$1/updates/dkms
+    mkdir -p "$modules"
+    echo "iovisor $$ $(date +%s%N)" > "$modules/iovisor.ko"
+}
+
+case $tool in
+    config-get)
+        if [ $# -gt 0 ]; then answer "$env/config/$1.json"
+        else cat "$env/config.json"; fi ;;
+    unit-get) answer "$env/unit/$1.json" ;;
+    relation-ids) answer "$env/relation-ids/$1.$fmt" ;;
+    relation-list|related-units) answer "$env/relation-list/$rid.$fmt" ;;
+    relation-get)
+        unit=${2:-$JUJU_REMOTE_UNIT}
+        if [ "${1:--}" = - ]; then answer "$env/relations/$rid/$unit.json"
+        else answer "$env/relations/$rid/$unit/$1.json"; fi ;;
+    relation-set)
+        # Settings of peers are shared by the units of a FakeFleet
+        case $rid in
+            edge-peers:*) exec "$FAKE_PYTHON" "$FAKE_BENCH/fakeenv.py" \
+                relation-set "$rid" "$@" ;;
+        esac ;;
+    status-set) echo "$*" > "$env/status" ;;
+    service|systemctl)
+        if [ "$tool" = service ]; then name=$1 action=$2
+        else name=$2 action=$1; fi
+        case $action in
+            start|restart)
+                touch "$env/services/$name"
+                [ "$name" = plumgrid ] &&
+                    echo "$FAKE_PG_PID" > "$FAKE_PG_PID_FILE" ;;
+            stop)
+                rm -f "$env/services/$name"
+                [ "$name" = plumgrid ] && rm -f "$FAKE_PG_PID_FILE" ;;
+            status)
+                if [ -f "$env/services/$name" ]; then
+                    echo "$name start/running, process $FAKE_PG_PID"
+                else echo "$name stop/waiting"; fi ;;
+            is-active) [ -f "$env/services/$name" ] || exit 3 ;;
+        esac ;;
+    apt-get)
+        [ "$1" = install ] || exit 0
+        shift
+        archives=$FAKE_ROOT/var/cache/apt/archives
+        for pkg; do
+            name=${pkg%%=*}
+            version=${pkg#*=}
+            [ "$version" = "$pkg" ] && version=1.0-1
+            if [ -n "$simulate" ]; then
+                [ "$(cat "$env/dpkg/$name" 2>/dev/null)" = "$version" ] ||
+                    echo "Inst $name ($version fake [all])"
+            elif [ -n "$download" ]; then
+                mkdir -p "$archives"
+                touch "$archives/${name}_$(echo "$version" |
+                    sed 's/:/%3a/g')_all.deb"
+            else
+                echo "$version" > "$env/dpkg/$name"
+                [ "$name" = iovisor-dkms ] && build_module "$(uname -r)"
+            fi
+        done ;;
+    dkms) [ "$1" = autoinstall ] && build_module "$2" ;;
+    add-apt-repository)
+        case $1 in
+            ppa:*)
+                ppa=${1#ppa:}
+                lists=$FAKE_ROOT/etc/apt/sources.list.d
+                mkdir -p "$lists"
+                echo "deb http://ppa.launchpad.net/$ppa/ubuntu trusty main" \
+                    > "$lists/$(echo "$ppa" | tr / -)-trusty.list" ;;
+        esac ;;
+    iptables-save) answer "$env/iptables" ;;
+    modprobe) mkdir -p "$FAKE_ROOT/sys/module/$1" ;;
+    rmmod) rm -rf "$FAKE_ROOT/sys/module/$1" ;;
+esac
+exit 0
+'''
+
+DEFAULT_INTERFACES = {
+    'eth0': {'index': 2, 'mtu': 1500,
+             'addresses': ['%s/24' % PRIVATE_ADDRESS],
+             'routes': ['10.0.0.0/24']},
+    'eth1': {'index': 3, 'mtu': 1500},
+    'eth2': {'index': 4, 'mtu': 1500},
+    'br-fabric': {'index': 5, 'mtu': 1500, 'members': ['eth1', 'eth2'],
+                  'addresses': ['10.1.0.10/24'], 'routes': ['10.1.0.0/24']},
+}
+
+# Installed packages of a Kilo compute node and versions known to apt
+DEFAULT_PACKAGES = {
+    'nova-common': '1:2015.1.0-0ubuntu1',
+    'nova-compute': '1:2015.1.0-0ubuntu1',
+}
+DEFAULT_AVAILABLE = {
+    'plumgrid-lxc': ['5.0-1', '4.1-1'],
+    'iovisor-dkms': ['5.0-1', '4.1-1'],
+}
+
+
+def charm_defaults():
+    '''
+    Returns the default config of the charm as config-get reports it.
+    '''
+    import yaml
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as config_yaml:
+        options = yaml.safe_load(config_yaml)['options']
+    return dict((key, option.get('default'))
+                for key, option in options.items())
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as out:
+        out.write(content)
+
+
+def _write_json(path, data):
+    _write(path, json.dumps(data) + '\n')
+
+
+class FakeEnvironment(object):
+    '''
+    A sandbox holding fake hook tools, the charm config, relation data,
+    network interfaces and package state of one unit.
+    '''
+
+    def __init__(self, config=None, latency=0.0, tool_latency=None,
+                 interfaces=None, packages=None, available=None, python=None,
+                 root=None, unit=UNIT_NAME, shared=None):
+        self.root = root or tempfile.mkdtemp(prefix='pg-edge-bench-')
+        self.unit = unit
+        self.bin = os.path.join(self.root, 'bin')
+        self.env = os.path.join(self.root, 'env')
+        self.fs = os.path.join(self.root, 'fs')
+        self.charm = os.path.join(self.root, 'charm')
+        self.python = python or sys.executable
+        self.latency = latency
+        self.relations = {}
+        self._next_rid = 0
+        self._container = None
+        # Leader settings and peer relation data, shared by a FakeFleet
+        self.shared = shared or self.env
+        self._setup(tool_latency or {}, interfaces or DEFAULT_INTERFACES)
+        self.set_config(**(config or {}))
+        self.set_packages(packages or DEFAULT_PACKAGES,
+                          available or DEFAULT_AVAILABLE)
+
+    def _setup(self, tool_latency, interfaces):
+        for path in [self.bin, self.fs, self.charm]:
+            os.makedirs(path)
+        for name in ['services', 'dpkg', 'apt', 'latency']:
+            os.makedirs(os.path.join(self.env, name))
+        tool = os.path.join(self.bin, 'fake-tool')
+        _write(tool, FAKE_TOOL)
+        os.chmod(tool, 0o755)
+        for name in HOOK_TOOLS + SYSTEM_COMMANDS:
+            os.symlink(tool, os.path.join(self.bin, name))
+        nsenter = os.path.join(self.fs, 'opt/local/bin/nsenter')
+        os.makedirs(os.path.dirname(nsenter))
+        os.symlink(tool, nsenter)
+        for name, latency in tool_latency.items():
+            _write(os.path.join(self.env, 'latency', name), str(latency))
+        _write(os.path.join(self.env, 'calls.log'), '')
+        _write_json(os.path.join(self.env, 'unit', 'private-address.json'),
+                    PRIVATE_ADDRESS)
+        self.set_interfaces(interfaces)
+        # The charm is linked into the sandbox so that hook state such as
+        # the persistent config and traces is kept out of the source tree.
+        for name in ['hooks', 'templates', 'config.yaml', 'metadata.yaml',
+                     'revision']:
+            if os.path.exists(os.path.join(CHARM_DIR, name)):
+                os.symlink(os.path.join(CHARM_DIR, name),
+                           os.path.join(self.charm, name))
+        # Live processes standing in for the libvirt LXC process of the
+        # plumgrid container and its init
+        with open(os.devnull, 'w') as devnull:
+            self._container = subprocess.Popen(
+                ['sh', '-c', 'sleep 1000000 & wait'], stdout=devnull,
+                stderr=devnull, preexec_fn=os.setsid)
+
+    def stop(self):
+        '''
+        Stops the processes of the sandbox but keeps its files.
+        '''
+        if self._container is not None:
+            os.killpg(self._container.pid, signal.SIGKILL)
+            self._container.wait()
+            self._container = None
+
+    def cleanup(self):
+        self.stop()
+        shutil.rmtree(self.root)
+
+    def set_config(self, **options):
+        '''
+        Sets the config reported by config-get, on top of the charm
+        defaults.
+        '''
+        config = charm_defaults()
+        config.update(options)
+        _write_json(os.path.join(self.env, 'config.json'), config)
+        for key, value in config.items():
+            _write_json(os.path.join(self.env, 'config', key + '.json'),
+                        value)
+
+    def set_packages(self, installed, available):
+        '''
+        Sets the installed version of packages, as dpkg-query reports it,
+        and the versions apt knows about.
+        '''
+        for pkg, version in installed.items():
+            _write(os.path.join(self.env, 'dpkg', pkg), version + '\n')
+        for pkg, versions in available.items():
+            _write(os.path.join(self.env, 'apt', pkg),
+                   ''.join(v + '\n' for v in versions))
+
+    def set_interfaces(self, interfaces):
+        '''
+        Builds a fake /sys/class/net and the rtnetlink answers from a dict
+        of interface name to index, mtu, members, addresses and routes.
+        '''
+        sysfs = os.path.join(self.fs, 'sys', 'class', 'net')
+        if os.path.isdir(sysfs):
+            shutil.rmtree(sysfs)
+        os.makedirs(sysfs)
+        for name, iface in interfaces.items():
+            path = os.path.join(sysfs, name)
+            _write(os.path.join(path, 'ifindex'), '%d\n' % iface['index'])
+            _write(os.path.join(path, 'mtu'), '%d\n' % iface['mtu'])
+        for name, iface in interfaces.items():
+            if 'members' not in iface:
+                continue
+            os.makedirs(os.path.join(sysfs, name, 'brif'))
+            for member in iface['members']:
+                os.makedirs(os.path.join(sysfs, name, 'brif', member))
+                os.symlink(os.path.join(sysfs, name),
+                           os.path.join(sysfs, member, 'master'))
+        _write_json(os.path.join(self.env, 'net.json'), interfaces)
+
+    def add_relation(self, reltype, units):
+        '''
+        Adds a reltype relation with units, a dict of unit name to relation
+        settings, and returns its relation id.
+        '''
+        rid = '%s:%d' % (reltype, self._next_rid)
+        self._next_rid += 1
+        self.relations.setdefault(reltype, {})[rid] = units
+        self._write_relations(reltype)
+        return rid
+
+    def add_peers(self, rid, units):
+        '''
+        Adds the peer relation rid with units, the other units of the
+        fleet, whose settings are kept in the shared directory.
+        '''
+        shared = os.path.join(self.shared, 'relations', rid)
+        if not os.path.isdir(shared):
+            os.makedirs(shared)
+        local = os.path.join(self.env, 'relations', rid)
+        if not os.path.isdir(os.path.dirname(local)):
+            os.makedirs(os.path.dirname(local))
+        if shared != local:
+            os.symlink(shared, local)
+        reltype = rid.split(':')[0]
+        _write_json(os.path.join(self.env, 'relation-ids', reltype + '.json'),
+                    [rid])
+        _write(os.path.join(self.env, 'relation-ids', reltype + '.text'),
+               rid + '\n')
+        _write_json(os.path.join(self.env, 'relation-list', rid + '.json'),
+                    sorted(units))
+        _write(os.path.join(self.env, 'relation-list', rid + '.text'),
+               ''.join(unit + '\n' for unit in sorted(units)))
+
+    def set_relation_units(self, rid, units):
+        reltype = rid.split(':')[0]
+        self.relations[reltype][rid] = units
+        self._write_relations(reltype)
+
+    def _write_relations(self, reltype):
+        rids = sorted(self.relations[reltype])
+        _write_json(os.path.join(self.env, 'relation-ids', reltype + '.json'),
+                    rids)
+        _write(os.path.join(self.env, 'relation-ids', reltype + '.text'),
+               ''.join(rid + '\n' for rid in rids))
+        for rid, units in self.relations[reltype].items():
+            names = sorted(units)
+            _write_json(os.path.join(self.env, 'relation-list',
+                                     rid + '.json'), names)
+            _write(os.path.join(self.env, 'relation-list', rid + '.text'),
+                   ''.join(unit + '\n' for unit in names))
+            for unit, settings in units.items():
+                base = os.path.join(self.env, 'relations', rid, unit)
+                _write_json(base + '.json', settings)
+                for key, value in settings.items():
+                    _write_json(os.path.join(base, key + '.json'), value)
+
+    def hook_env(self, relation_id=None, remote_unit=None):
+        '''
+        Returns the environment a hook runs with in this sandbox.
+        '''
+        env = dict(os.environ)
+        env.update({
+            'PATH': '%s:%s' % (self.bin, os.environ.get('PATH', '')),
+            'CHARM_DIR': self.charm,
+            'JUJU_UNIT_NAME': self.unit,
+            'PG_EDGE_TRACE': '1',
+            'UNIT_STATE_DB': os.path.join(self.root, 'unit-state.db'),
+            'FAKE_ENV': self.env,
+            'FAKE_ROOT': self.fs,
+            'FAKE_LATENCY': str(self.latency),
+            'FAKE_SHARED': self.shared,
+            'FAKE_PYTHON': sys.executable,
+            'FAKE_BENCH': BENCH_DIR,
+            'FAKE_PG_PID': str(self._container.pid),
+            'FAKE_PG_PID_FILE': os.path.join(
+                self.fs, 'var/run/libvirt/lxc/plumgrid.pid'),
+        })
+        for key in ['JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT']:
+            env.pop(key, None)
+        if relation_id:
+            env['JUJU_RELATION'] = relation_id.split(':')[0]
+            env['JUJU_RELATION_ID'] = relation_id
+        if remote_unit:
+            env['JUJU_REMOTE_UNIT'] = remote_unit
+        return env
+
+    def tool_calls(self):
+        '''
+        Returns the number of calls made to every fake tool so far.
+        '''
+        calls = {}
+        with open(os.path.join(self.env, 'calls.log')) as log:
+            for line in log:
+                tool = line.split(' ', 1)[0].strip()
+                calls[tool] = calls.get(tool, 0) + 1
+        return calls
+
+    def last_trace(self):
+        '''
+        Returns the summary of the last traced hook run, or None.
+        '''
+        history = os.path.join(self.charm, '.pg-edge-traces',
+                               'history.jsonl')
+        if not os.path.exists(history):
+            return None
+        with open(history) as history_file:
+            lines = history_file.readlines()
+        return json.loads(lines[-1]) if lines else None
+
+    def run(self, args, relation_id=None, remote_unit=None):
+        '''
+        Runs a script of the benchmarks with args in a fresh interpreter
+        inside the sandbox and returns its exit status, wall time and peak
+        RSS. Its output goes to hooks.log in the sandbox.
+        '''
+        start = time.time()
+        with open(os.path.join(self.root, 'hooks.log'), 'a') as log:
+            log.write('=== %s\n' % ' '.join(args))
+            log.flush()
+            proc = subprocess.Popen(
+                [self.python, os.path.join(BENCH_DIR, args[0])] + args[1:],
+                cwd=self.charm, env=self.hook_env(relation_id, remote_unit),
+                stdout=log, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(proc.pid, 0)
+        return {
+            'status': os.WEXITSTATUS(status),
+            'start': start,
+            'ms': (time.time() - start) * 1000,
+            'maxrss_kb': rusage.ru_maxrss,
+        }
+
+    def run_hook(self, hook, relation_id=None, remote_unit=None):
+        '''
+        Runs hook and returns its exit status, wall time, fork count, fake
+        tool calls and peak RSS.
+        '''
+        calls = self.tool_calls()
+        result = self.run(['fake_hook.py', hook], relation_id, remote_unit)
+        after = self.tool_calls()
+        trace = self.last_trace() or {}
+        if trace.get('time', 0) < result['start']:
+            trace = {}
+        return {
+            'hook': hook,
+            'status': result['status'],
+            'ms': result['ms'],
+            'forks': trace.get('forks'),
+            'tool_calls': dict((tool, count - calls.get(tool, 0))
+                               for tool, count in after.items()
+                               if count != calls.get(tool, 0)),
+            'maxrss_kb': result['maxrss_kb'],
+            'spans': trace.get('spans', {}),
+        }
+
+
+class FakeFleet(object):
+    '''
+    Units of the charm, each in its own FakeEnvironment, sharing leader
+    settings and the settings of their peer relation. The first unit is
+    the leader.
+    '''
+
+    PEER_RID = 'edge-peers:100'
+
+    def __init__(self, size, **kwargs):
+        self.shared = tempfile.mkdtemp(prefix='pg-edge-fleet-')
+        self.units = [FakeEnvironment(unit='plumgrid-edge/%d' % i,
+                                      shared=self.shared, **kwargs)
+                      for i in range(size)]
+        _write_json(os.path.join(self.shared, 'leader-unit.json'),
+                    self.units[0].unit)
+        _write_json(os.path.join(self.shared, 'leader.json'), {})
+
+    def add_peers(self):
+        '''
+        Relates the units of the fleet to each other.
+        '''
+        names = [env.unit for env in self.units]
+        for env in self.units:
+            env.add_peers(self.PEER_RID,
+                          [name for name in names if name != env.unit])
+
+    @property
+    def leader(self):
+        return self.units[0]
+
+    def leader_settings(self):
+        return _read_json(os.path.join(self.shared, 'leader.json'))
+
+    def peer_settings(self):
+        '''
+        Returns the peer relation settings of every unit.
+        '''
+        return dict((env.unit, _read_json(os.path.join(
+            self.shared, 'relations', self.PEER_RID, env.unit + '.json'))
+            or {}) for env in self.units)
+
+    def set_config(self, **options):
+        for env in self.units:
+            env.set_config(**options)
+
+    def cleanup(self):
+        for env in self.units:
+            env.cleanup()
+        shutil.rmtree(self.shared)
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as data:
+        return json.load(data)
+
+
+def fake_tool(tool, args):
+    '''
+    The hook tools which need more than the shell stand-in: leadership and
+    settings of the peer relation, which are shared by the units of a
+    FakeFleet.
+    '''
+    shared = os.environ['FAKE_SHARED']
+    unit = os.environ['JUJU_UNIT_NAME']
+    leader = _read_json(os.path.join(shared, 'leader-unit.json')) or unit
+    settings_path = os.path.join(shared, 'leader.json')
+    if tool == 'is-leader':
+        print(json.dumps(leader == unit))
+        return 0
+    if tool == 'leader-get':
+        settings = _read_json(settings_path) or {}
+        key = [arg for arg in args if not arg.startswith('--')][-1]
+        print(json.dumps(settings if key == '-' else settings.get(key)))
+        return 0
+    if tool == 'leader-set':
+        if leader != unit:
+            print('cannot write leadership settings: not the leader',
+                  file=sys.stderr)
+            return 1
+        path = settings_path
+        pairs = args
+    else:
+        path = os.path.join(os.environ['FAKE_ENV'], 'relations', args[0],
+                            unit + '.json')
+        pairs = args[1:]
+    settings = _read_json(path) or {}
+    for pair in pairs:
+        key, value = pair.split('=', 1)
+        if value:
+            settings[key] = value
+        else:
+            settings.pop(key, None)
+    _write_json(path, settings)
+    if tool == 'relation-set':
+        base = path[:-len('.json')]
+        if os.path.isdir(base):
+            shutil.rmtree(base)
+        for key, value in settings.items():
+            _write_json(os.path.join(base, key + '.json'), value)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(fake_tool(sys.argv[1], sys.argv[2:]))
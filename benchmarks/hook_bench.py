@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Runs the hooks of this charm end to end against the fake hook tools and
+# system commands of fakeenv.py, and reports latency, fork count, fake tool
+# calls and peak RSS per hook. The first run of every hook is reported
+# separately from the steady state, in which nothing changes between runs.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeenv import FakeEnvironment  # noqa
+
+DIRECTOR_RELATION = 'plumgrid'
+REPEATED_HOOKS = [
+    'config-changed',
+    'plumgrid-relation-changed',
+    'update-status',
+]
+
+
+def director_units(count, opsvm_ip='10.0.0.200'):
+    '''
+    Returns the relation settings of count plumgrid-director units.
+    '''
+    units = {}
+    for i in range(count):
+        units['plumgrid-director/%d' % i] = {
+            'private-address': '10.0.%d.%d' % (100 + i // 200, 1 + i % 200),
+            'opsvm_ip': opsvm_ip,
+        }
+    return units
+
+
+def deploy(env, directors=1):
+    '''
+    Runs the hooks of a fresh deployment related to directors and returns
+    their results.
+    '''
+    results = [env.run_hook('install'), env.run_hook('config-changed')]
+    rid = env.add_relation(DIRECTOR_RELATION, director_units(directors))
+    for unit in sorted(env.relations[DIRECTOR_RELATION][rid]):
+        results.append(env.run_hook('plumgrid-relation-joined', rid, unit))
+        results.append(env.run_hook('plumgrid-relation-changed', rid, unit))
+    results.append(env.run_hook('update-status'))
+    return results, rid
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def summarize(results):
+    '''
+    Aggregates the results of the runs of every hook.
+    '''
+    summary = {}
+    for result in results:
+        summary.setdefault(result['hook'], []).append(result)
+    report = {}
+    for hook, runs in summary.items():
+        calls = {}
+        for tool, count in runs[-1]['tool_calls'].items():
+            calls[tool] = count
+        report[hook] = {
+            'runs': len(runs),
+            'median_ms': round(_median([r['ms'] for r in runs]), 1),
+            'max_ms': round(max(r['ms'] for r in runs), 1),
+            'forks': runs[-1]['forks'],
+            'tool_calls': calls,
+            'maxrss_kb': max(r['maxrss_kb'] for r in runs),
+            'failed': sum(1 for r in runs if r['status']),
+        }
+    return report
+
+
+def print_report(title, report):
+    print(title)
+    print('%-28s %5s %10s %10s %6s %7s %9s %6s' % (
+        'hook', 'runs', 'median ms', 'max ms', 'forks', 'tools', 'rss MB',
+        'failed'))
+    for hook in sorted(report):
+        res = report[hook]
+        print('%-28s %5d %10.1f %10.1f %6s %7d %9.1f %6d' % (
+            hook, res['runs'], res['median_ms'], res['max_ms'],
+            '-' if res['forks'] is None else res['forks'],
+            sum(res['tool_calls'].values()), res['maxrss_kb'] / 1024.0,
+            res['failed']))
+    print('')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the hooks end to end against fake hook tools.')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='steady state runs of every hook')
+    parser.add_argument('--directors', type=int, default=1,
+                        help='number of related plumgrid-director units')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every fake tool call takes')
+    parser.add_argument('--tool-latency', action='append', default=[],
+                        metavar='TOOL=SECONDS',
+                        help='latency of a single fake tool')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter used to run the hooks')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the sandbox and print its path')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as json')
+    args = parser.parse_args()
+
+    tool_latency = dict(item.split('=', 1) for item in args.tool_latency)
+    env = FakeEnvironment(latency=args.latency, tool_latency=tool_latency,
+                          python=args.python)
+    try:
+        first, rid = deploy(env, args.directors)
+        unit = sorted(env.relations[DIRECTOR_RELATION][rid])[0]
+        steady = []
+        for _ in range(args.repeat):
+            for hook in REPEATED_HOOKS:
+                if hook.startswith(DIRECTOR_RELATION):
+                    steady.append(env.run_hook(hook, rid, unit))
+                else:
+                    steady.append(env.run_hook(hook))
+        results = {'deploy': summarize(first), 'steady': summarize(steady)}
+        if args.json:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            print_report('Deployment', results['deploy'])
+            print_report('Steady state', results['steady'])
+        if args.keep:
+            print('Sandbox kept in %s' % env.root, file=sys.stderr)
+    finally:
+        if args.keep:
+            env.stop()
+        else:
+            env.cleanup()
+    failed = sum(res['failed'] for report in results.values()
+                 for res in report.values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Measures the start-up cost of every hook of this charm: the time it
+# takes to import pg_edge_hooks, as Juju does when it runs a hook, and the
+# number of modules pulled in. The hooks themselves are not executed.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOOKS_DIR = os.path.join(CHARM_DIR, 'hooks')
+
+PROBE = '''
+import json, sys, time
+sys.argv = [%(hook)r]
+sys.path.insert(0, %(hooks_dir)r)
+start = time.time()
+import pg_edge_hooks
+elapsed = time.time() - start
+configs = getattr(pg_edge_hooks.CONFIGS, '_configs', True)
+print(json.dumps({'import': elapsed,
+                  'modules': len(sys.modules),
+                  'configs_built': configs is not None}))
+'''
+
+
+def hook_names():
+    '''
+    Returns the hooks which are symlinked to pg_edge_hooks.py.
+    '''
+    return sorted(name for name in os.listdir(HOOKS_DIR)
+                  if os.path.islink(os.path.join(HOOKS_DIR, name)) and
+                  os.readlink(os.path.join(HOOKS_DIR, name)) ==
+                  'pg_edge_hooks.py')
+
+
+def probe(hook, python):
+    '''
+    Imports pg_edge_hooks as hook in a fresh interpreter and returns the
+    measured import time and module count.
+    '''
+    code = PROBE % {'hook': os.path.join(HOOKS_DIR, hook),
+                    'hooks_dir': HOOKS_DIR}
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output([python, '-c', code], cwd=CHARM_DIR,
+                                         stderr=devnull)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the start-up cost of every hook.')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='number of fresh interpreters per hook')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter used to run the hooks')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as json')
+    args = parser.parse_args()
+
+    results = {}
+    for hook in hook_names():
+        samples = [probe(hook, args.python) for _ in range(args.repeat)]
+        times = sorted(sample['import'] for sample in samples)
+        results[hook] = {
+            'median_ms': round(times[len(times) // 2] * 1000, 1),
+            'min_ms': round(times[0] * 1000, 1),
+            'modules': samples[-1]['modules'],
+            'configs_built': samples[-1]['configs_built'],
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('%-34s %10s %10s %8s %8s' % ('hook', 'median ms', 'min ms',
+                                       'modules', 'configs'))
+    for hook in sorted(results):
+        res = results[hook]
+        print('%-34s %10.1f %10.1f %8d %8s' % (
+            hook, res['median_ms'], res['min_ms'], res['modules'],
+            'built' if res['configs_built'] else 'lazy'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Rolls a plumgrid-build upgrade through a fleet of edges related as peers,
+# each unit in its own FakeEnvironment. Juju is stood in for by running
+# leader-settings-changed on the units whenever the leader settings change
+# and edge-peers-relation-changed on the leader whenever the peer settings
+# change, until the fleet settles. Reports the order in which edges were
+# upgraded, how many held a restart slot at once and the fleet progress
+# reported by the leader.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeenv import FakeFleet  # noqa
+from hook_bench import deploy  # noqa
+
+PEER_HOOK = 'edge-peers-relation-changed'
+LEADER_HOOK = 'leader-settings-changed'
+UPGRADE_BUILD = '5.0-1'
+MAX_ROUNDS = 50
+
+
+def plumgrid_version(env):
+    with open(os.path.join(env.env, 'dpkg', 'plumgrid-lxc')) as version:
+        return version.read().strip()
+
+
+def slots(fleet):
+    return json.loads(fleet.leader_settings().get('restart-slots') or '{}')
+
+
+def roll(fleet, concurrency):
+    '''
+    Upgrades every edge of fleet and returns the timeline of the hooks run
+    and the edges holding a slot after each of them.
+    '''
+    timeline = []
+
+    def run(env, hook, rid=None):
+        before = plumgrid_version(env)
+        res = env.run_hook(hook, rid)
+        timeline.append({
+            'unit': env.unit, 'hook': hook, 'status': res['status'],
+            'ms': res['ms'], 'upgraded': plumgrid_version(env) != before,
+            'slots': sorted(slots(fleet)),
+            'progress': fleet.leader_settings().get('restart-progress'),
+        })
+
+    fleet.set_config(**{'plumgrid-build': UPGRADE_BUILD,
+                        'rolling-restart-concurrency': concurrency})
+    for env in fleet.units:
+        run(env, 'config-changed')
+    seen_leader = dict((env.unit, None) for env in fleet.units)
+    seen_peers = None
+    for _ in range(MAX_ROUNDS):
+        ran = False
+        peers = fleet.peer_settings()
+        if peers != seen_peers:
+            seen_peers = peers
+            run(fleet.leader, PEER_HOOK, fleet.PEER_RID)
+            ran = True
+        for env in fleet.units[1:]:
+            settings = fleet.leader_settings()
+            if settings != seen_leader[env.unit]:
+                seen_leader[env.unit] = settings
+                run(env, LEADER_HOOK)
+                ran = True
+        if not ran:
+            break
+    return timeline
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Roll an upgrade through a fleet of fake edges.')
+    parser.add_argument('--units', type=int, default=4,
+                        help='number of edges in the fleet')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='rolling-restart-concurrency of the fleet')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter used to run the hooks')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as json')
+    args = parser.parse_args()
+
+    fleet = FakeFleet(args.units, python=args.python)
+    try:
+        for env in fleet.units:
+            deploy(env)
+        fleet.add_peers()
+        timeline = roll(fleet, args.concurrency)
+        versions = dict((env.unit, plumgrid_version(env))
+                        for env in fleet.units)
+    finally:
+        fleet.cleanup()
+    max_slots = max(len(row['slots']) for row in timeline)
+    failed = [row for row in timeline if row['status']]
+    pending = [unit for unit, version in versions.items()
+               if version != UPGRADE_BUILD]
+    if args.json:
+        print(json.dumps({'timeline': timeline, 'versions': versions,
+                          'max_slots': max_slots}, indent=2,
+                         sort_keys=True))
+    else:
+        print('%-18s %-30s %8s %9s  %-36s %s' % (
+            'unit', 'hook', 'ms', 'upgraded', 'slots', 'progress'))
+        for row in timeline:
+            print('%-18s %-30s %8.1f %9s  %-36s %s' % (
+                row['unit'], row['hook'], row['ms'],
+                'yes' if row['upgraded'] else '',
+                ' '.join(row['slots']) or '-', row['progress'] or '-'))
+        print('')
+        print('%d hooks, at most %d edges restarting at once (limit %d), '
+              '%d failed hooks, %d edges not upgraded' % (
+                  len(timeline), max_slots, args.concurrency, len(failed),
+                  len(pending)))
+    return 1 if failed or pending or max_slots > args.concurrency else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
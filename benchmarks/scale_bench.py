@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Simulates how the cost of the charm grows with the size of the fleet: the
+# number of related plumgrid-director units and the number of hosts listed
+# in the fabric-interfaces config. For every size a FakeEnvironment is
+# deployed, the context and rendering functions are timed by
+# scale_probe.py and the config-changed and plumgrid-relation-changed hooks
+# are run end to end. Growth faster than linear between two sizes is
+# flagged.
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeenv import FakeEnvironment  # noqa
+from hook_bench import DIRECTOR_RELATION, director_units  # noqa
+
+DIRECTOR_COUNTS = [1, 3, 10, 50, 200]
+FABRIC_SIZES = [1, 100, 1000, 5000, 20000]
+STEPS = ['dir_context', 'fabric_interface', 'pg_ctxt', 'write_all']
+HOOKS = ['config-changed', 'plumgrid-relation-changed']
+# Exponent of the growth between two sizes above which a path is flagged
+SUPERLINEAR = 1.2
+# Durations below this are noise and never flagged
+MIN_FLAG_MS = 5.0
+
+
+def fabric_interfaces(size):
+    '''
+    Returns a fabric-interfaces config listing size hosts, the local one
+    being the last.
+    '''
+    interfaces = dict(('edge-%05d' % i, 'br-fabric')
+                      for i in range(size - 1))
+    interfaces[socket.gethostname()] = 'br-fabric'
+    return json.dumps(interfaces, sort_keys=True)
+
+
+def measure(directors, fabric_size, repeat, python, latency):
+    '''
+    Deploys a unit related to directors with a fabric-interfaces map of
+    fabric_size hosts and returns the timings of the probed functions
+    and hooks.
+    '''
+    env = FakeEnvironment(
+        config={'fabric-interfaces': fabric_interfaces(fabric_size)},
+        latency=latency, python=python)
+    try:
+        env.run_hook('install')
+        env.run_hook('config-changed')
+        rid = env.add_relation(DIRECTOR_RELATION, director_units(directors))
+        unit = sorted(env.relations[DIRECTOR_RELATION][rid])[0]
+        row = {'directors': directors, 'fabric_size': fabric_size}
+        result_path = os.path.join(env.root, 'probe.json')
+        probe = env.run(['scale_probe.py', result_path, str(repeat)])
+        if probe['status']:
+            row['failed'] = 'scale_probe.py'
+            return row
+        with open(result_path) as result:
+            row['steps'] = json.load(result)
+        row['hooks'] = {}
+        for hook in HOOKS:
+            res = env.run_hook(hook, rid, unit) if hook.startswith(
+                DIRECTOR_RELATION) else env.run_hook(hook)
+            row['hooks'][hook] = res
+            if res['status']:
+                row['failed'] = hook
+        return row
+    finally:
+        env.cleanup()
+
+
+def _cost(row, column):
+    if column in STEPS:
+        return row['steps'][column]['median_ms']
+    return row['hooks'][column]['ms']
+
+
+def growth(rows, axis, column):
+    '''
+    Returns the growth exponent of column between consecutive rows, None
+    where it can not be computed.
+    '''
+    exponents = [None]
+    for prev, cur in zip(rows, rows[1:]):
+        if 'failed' in prev or 'failed' in cur:
+            exponents.append(None)
+            continue
+        t1, t2 = _cost(prev, column), _cost(cur, column)
+        n1, n2 = prev[axis], cur[axis]
+        if min(t1, t2) <= 0 or n1 == n2:
+            exponents.append(None)
+        else:
+            exponents.append(math.log(t2 / t1) / math.log(float(n2) / n1))
+    return exponents
+
+
+def print_table(title, rows, axis):
+    columns = STEPS + HOOKS
+    print(title)
+    print('%-8s' % axis.split('_')[0] + ''.join(
+        '%18s' % c[:17] for c in columns) + '%10s' % 'rss MB')
+    exponents = dict((c, growth(rows, axis, c)) for c in columns)
+    flagged = []
+    for i, row in enumerate(rows):
+        if 'failed' in row:
+            print('%-8d failed in %s' % (row[axis], row['failed']))
+            continue
+        cells = []
+        for column in columns:
+            cost, exp = _cost(row, column), exponents[column][i]
+            mark = ''
+            if exp is not None and exp > SUPERLINEAR and cost > MIN_FLAG_MS:
+                mark = '!'
+                flagged.append((column, rows[i - 1][axis], row[axis], exp))
+            cells.append('%18s' % ('%.1f%s' % (cost, mark) + (
+                ' (x^%.1f)' % exp if exp is not None else '')))
+        rss = max([s['maxrss_kb'] for s in row['steps'].values()] +
+                  [h['maxrss_kb'] for h in row['hooks'].values()])
+        print('%-8d' % row[axis] + ''.join(cells) + '%10.1f' % (rss / 1024.0))
+    for column, n1, n2, exp in flagged:
+        print('  ! %s grows as n^%.1f between %d and %d' %
+              (column, exp, n1, n2))
+    print('')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how hook cost grows with the fleet size.')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='runs of every probed function')
+    parser.add_argument('--directors', type=int, nargs='+',
+                        default=DIRECTOR_COUNTS,
+                        help='director unit counts to simulate')
+    parser.add_argument('--fabric-sizes', type=int, nargs='+',
+                        default=FABRIC_SIZES,
+                        help='fabric-interfaces map sizes to simulate')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every fake tool call takes')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter used to run the hooks')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as json')
+    args = parser.parse_args()
+
+    by_directors = [measure(d, 1, args.repeat, args.python, args.latency)
+                    for d in args.directors]
+    by_fabric = [measure(3, size, args.repeat, args.python, args.latency)
+                 for size in args.fabric_sizes]
+    if args.json:
+        print(json.dumps({'directors': by_directors, 'fabric': by_fabric},
+                         indent=2, sort_keys=True))
+    else:
+        print_table('Director units (fabric-interfaces of 1 host), ms',
+                    by_directors, 'directors')
+        print_table('fabric-interfaces hosts (3 directors), ms', by_fabric,
+                    'fabric_size')
+    failed = [row for row in by_directors + by_fabric if 'failed' in row]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# Times the context and rendering functions of the charm inside a
+# FakeEnvironment sandbox, see scale_bench.py. Every step is run repeat
+# times with a cold hookenv cache, as at the start of a hook.
+#
+# usage: scale_probe.py <result-file> <repeat>
+
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+from fake_hook import prepare
+
+
+def maxrss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    result_path, repeat = sys.argv[1], int(sys.argv[2])
+    prepare('scale-probe')
+    from charmhelpers.core import hookenv
+    import pg_edge_context
+    import pg_edge_utils
+
+    configs = pg_edge_utils.register_configs()
+    steps = OrderedDict([
+        ('dir_context', pg_edge_context._pg_dir_context),
+        ('fabric_interface', pg_edge_utils.get_fabric_interface),
+        ('pg_ctxt', lambda: pg_edge_context.PGEdgeContext()()),
+        ('write_all', configs.write_all),
+    ])
+    results = OrderedDict()
+    for name, step in steps.items():
+        samples = []
+        for _ in range(repeat):
+            hookenv.cache.clear()
+            start = time.time()
+            step()
+            samples.append((time.time() - start) * 1000)
+        rest = sorted(samples[1:]) or samples
+        results[name] = {
+            'first_ms': samples[0],
+            'median_ms': rest[len(rest) // 2],
+            'maxrss_kb': maxrss_kb(),
+        }
+    with open(result_path, 'w') as result:
+        json.dump(results, result)
+
+
+if __name__ == '__main__':
+    main()
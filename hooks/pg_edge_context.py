@@ -3,9 +3,16 @@
 # This file contains the class that generates context for
 # PLUMgrid template files.
 
+import hashlib
+import json
+import os
+import subprocess
 from charmhelpers.contrib.openstack import context
 from charmhelpers.contrib.openstack.utils import get_host_ip
+from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import (
+    config,
+    log,
     relation_ids,
     related_units,
     relation_get,
@@ -14,12 +21,91 @@ from socket import (
     gethostname,
     getfqdn
 )
+from pg_edge_trace import span, traced
+
+
+RELATION_LOADER = '''
+for rid in $(relation-ids "$1"); do
+    echo "rid $rid"
+    for unit in $(relation-list -r "$rid"); do
+        echo "unit $unit"
+        printf 'data '
+        relation-get --format=json -r "$rid" - "$unit" || echo null
+    done
+done
+'''
+
+
+def _cache_key(func, *args, **kwargs):
+    '''
+    Returns the hookenv cache key func would use when called with args.
+    '''
+    return str((func._wrapped, args, kwargs))
+
+
+@traced
+def load_relations(reltype):
+    '''
+    Reads the relation ids, units and settings of every reltype relation
+    with a single shell script and fills the hookenv cache with them, so
+    later relation_ids(), related_units() and relation_get() calls don't
+    each spawn a hook tool from Python. The script still runs one hook
+    tool per call. Returns the number of Python spawns done and avoided
+    and of hook tools the script ran, or None on failure, in which case
+    those calls spawn their hook tools as usual.
+    '''
+    loaded_key = 'pg-edge-relations-loaded:%s' % reltype
+    if loaded_key in hookenv.cache:
+        return hookenv.cache[loaded_key]
+    try:
+        output = subprocess.check_output(
+            ['sh', '-c', RELATION_LOADER, 'load-relations', reltype])
+    except (OSError, subprocess.CalledProcessError) as e:
+        log('Unable to bulk load %s relations: %s' % (reltype, e))
+        return None
+    rids = []
+    units = {}
+    settings = {}
+    rid = unit = None
+    try:
+        for line in output.splitlines():
+            kind, _, value = line.partition(' ')
+            if kind == 'rid':
+                rid = value
+                rids.append(rid)
+                units[rid] = []
+            elif kind == 'unit':
+                unit = value
+                units[rid].append(unit)
+            elif kind == 'data':
+                settings[(rid, unit)] = json.loads(value)
+    except ValueError as e:
+        log('Unable to parse %s relation data: %s' % (reltype, e))
+        return None
+    for (rid, unit), data in settings.items():
+        hookenv.cache[_cache_key(relation_get, rid=rid, unit=unit)] = data
+    hookenv.cache[_cache_key(relation_ids, reltype)] = rids
+    for rid in rids:
+        hookenv.cache[_cache_key(related_units, rid)] = units[rid]
+    # relation-ids once, relation-list per relation, relation-get per unit
+    tool_calls = 1 + len(rids) + len(settings)
+    stats = {
+        'python_spawns': 1,
+        'python_spawns_avoided': tool_calls - 1,
+        'tool_calls': tool_calls,
+    }
+    log('Loaded %s relation data with %d hook tool call(s) from one script, '
+        'avoiding %d Python spawn(s)' % (reltype, stats['tool_calls'],
+                                         stats['python_spawns_avoided']))
+    hookenv.cache[loaded_key] = stats
+    return stats
 
 
 def _pg_dir_context():
     '''
     Inspects relation with PLUMgrid director.
     '''
+    load_relations('plumgrid')
     ctxt = {
         'opsvm_ip': '127.0.0.1',
         'director_ips': [],
@@ -35,6 +121,22 @@ def _pg_dir_context():
     return ctxt
 
 
+PG_CTXT_CACHE_KEY = 'pg-edge-context'
+
+
+def _pg_ctxt_cache_key():
+    '''
+    Key under which the PLUMgrid context is memoized in the hookenv cache.
+    It contains the local unit name, so the flush done by relation_set()
+    drops it, and a digest of the charm config, so config changes made
+    during the hook produce a fresh context.
+    '''
+    cfg = json.dumps(config() or {}, sort_keys=True)
+    return '%s:%s:%s' % (PG_CTXT_CACHE_KEY,
+                         os.environ.get('JUJU_UNIT_NAME', ''),
+                         hashlib.md5(cfg).hexdigest())
+
+
 class PGEdgeContext(context.NeutronContext):
 
     @property
@@ -60,6 +162,17 @@ class PGEdgeContext(context.NeutronContext):
         '''
         pass
 
+    def __call__(self):
+        '''
+        Computes the context once per hook execution and shares it with
+        every template registered against this generator.
+        '''
+        key = _pg_ctxt_cache_key()
+        if key not in hookenv.cache:
+            with span('pg_edge_context'):
+                hookenv.cache[key] = super(PGEdgeContext, self).__call__()
+        return dict(hookenv.cache[key])
+
     def pg_ctxt(self):
         '''
         Generated Config for all PLUMgrid templates inside the
@@ -81,7 +194,8 @@ class PGEdgeContext(context.NeutronContext):
                                           '')
         unit_hostname = gethostname()
         pg_ctxt['pg_hostname'] = unit_hostname
-        pg_ctxt['pg_fqdn'] = getfqdn()
+        with span('getfqdn'):
+            pg_ctxt['pg_fqdn'] = getfqdn()
         from pg_edge_utils import get_mgmt_interface, get_fabric_interface
         pg_ctxt['interface'] = get_mgmt_interface()
         pg_ctxt['fabric_interface'] = get_fabric_interface()
@@ -5,7 +5,10 @@
 # The hooks of this charm have been symlinked to functions
 # in this file.
 
+import os
 import sys
+import pg_edge_trace
+import pg_edge_utils
 from charmhelpers.core.host import service_running
 
 from charmhelpers.core.hookenv import (
@@ -18,32 +21,37 @@ from charmhelpers.core.hookenv import (
     status_set
 )
 
-from charmhelpers.fetch import (
-    apt_install,
-    configure_sources,
-)
-
 from pg_edge_utils import (
     register_configs,
     ensure_files,
-    restart_pg,
     restart_map,
     stop_pg,
-    determine_packages,
     load_iovisor,
-    remove_iovisor,
     ensure_mtu,
     add_lcm_key,
     fabric_interface_changed,
     load_iptables,
     restart_on_change,
-    director_cluster_ready,
     configure_pg_sources,
-    configure_analyst_opsvm
+    director_cluster_ready,
+    configure_analyst_opsvm,
+    analyst_opsvm_retry,
+    LazyConfigs,
+    director_state_delta,
+    commit_director_state,
+    install_packages,
 )
 
+from pg_edge_restarts import (
+    cancel_restarts,
+    request_restart,
+    run_restarts,
+)
+from pg_edge_rolling import update_slots
+from pg_edge_tasks import TaskGraph
+
 hooks = Hooks()
-CONFIGS = register_configs()
+CONFIGS = LazyConfigs(register_configs)
 
 
 @hooks.hook()
@@ -52,29 +60,38 @@ def install():
     Install hook is run when the charm is first deployed on a node.
     '''
     status_set('maintenance', 'Executing pre-install')
-    load_iptables()
-    configure_sources(update=True)
-    status_set('maintenance', 'Installing apt packages')
-    pkgs = determine_packages()
-    for pkg in pkgs:
-        apt_install(pkg, options=['--force-yes'], fatal=True)
-    load_iovisor()
-    ensure_mtu()
-    ensure_files()
-    add_lcm_key()
+    steps = TaskGraph('install')
+    steps.add('iptables', load_iptables, locks=['apt'])
+    steps.add('sources', lambda: configure_pg_sources(update=True),
+              locks=['apt'])
+    steps.add('mtu', ensure_mtu)
+    steps.add('packages', install_packages, requires=['sources'],
+              locks=['apt'])
+    steps.add('iovisor', load_iovisor, requires=['packages'])
+    steps.add('files', ensure_files, requires=['packages'], locks=['apt'])
+    steps.add('lcm-key', add_lcm_key, requires=['packages'])
+    steps.run()
 
 
 @hooks.hook('plumgrid-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def director_changed():
     '''
     This hook is run when relation between plumgrid-edge and
     plumgrid-director is made or changed.
     '''
+    delta = director_state_delta()
+    if not delta:
+        log('PLUMgrid director relation data unchanged')
+        return
     if director_cluster_ready():
         ensure_mtu()
-        configure_analyst_opsvm()
+        failed = []
+        if 'opsvm_ip' in delta and not configure_analyst_opsvm():
+            # retried by the next hook
+            failed.append('opsvm_ip')
         CONFIGS.write_all()
+        commit_director_state(skip=failed)
 
 
 @hooks.hook('plumgrid-relation-joined')
@@ -109,40 +126,30 @@ def config_changed():
     charm_config = config()
     if charm_config.changed('lcm-ssh-key'):
         if add_lcm_key():
-            log("PLUMgrid LCM Key added")
+            log("PLUMgrid LCM keys updated")
     if charm_config.changed('fabric-interfaces'):
         if not fabric_interface_changed():
             log("Fabric interface already set")
         else:
-            stop_pg()
+            request_restart('restart', 'fabric-interfaces')
     if (charm_config.changed('install_sources') or
         charm_config.changed('plumgrid-build') or
         charm_config.changed('install_keys') or
             charm_config.changed('iovisor-build')):
-        stop_pg()
-        status_set('maintenance', 'Upgrading apt packages')
-        if charm_config.changed('install_sources'):
-            configure_pg_sources()
-        configure_sources(update=True)
-        pkgs = determine_packages()
-        for pkg in pkgs:
-            apt_install(pkg, options=['--force-yes'], fatal=True)
-            remove_iovisor()
-            load_iovisor()
+        request_restart('upgrade', 'package upgrade')
     if charm_config.changed('metadata-shared-key'):
-        stop_pg()
+        request_restart('restart', 'metadata-shared-key')
         for rid in relation_ids('neutron-plugin'):
             neutron_plugin_joined(rid)
         for rid in relation_ids('plumgrid-plugin'):
             neutron_plugin_joined(rid)
     ensure_mtu()
     CONFIGS.write_all()
-    if not service_running('plumgrid'):
-        restart_pg()
+    request_restart('start')
 
 
 @hooks.hook('upgrade-charm')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def upgrade_charm():
     ensure_mtu()
     CONFIGS.write_all()
@@ -153,23 +160,79 @@ def stop():
     '''
     This hook is run when the charm is destroyed.
     '''
+    cancel_restarts()
     stop_pg()
 
 
+@hooks.hook('edge-peers-relation-joined')
+@hooks.hook('edge-peers-relation-changed')
+@hooks.hook('edge-peers-relation-departed')
+@hooks.hook('leader-elected')
+@hooks.hook('leader-settings-changed')
+def rolling_restart_changed():
+    '''
+    These hooks are run when edges request or release restart slots, or
+    the leader hands them out. Restarts deferred on this unit are run once
+    it holds a slot.
+    '''
+    update_slots()
+
+
 @hooks.hook('update-status')
 def update_status():
     if service_running('plumgrid'):
+        if analyst_opsvm_retry():
+            # the restart requested for plumgrid-sigmund brought PLUMgrid up
+            director_changed()
         status_set('active', 'Unit is ready')
     else:
         status_set('blocked', 'plumgrid service not running')
 
 
-def main():
+TRACED_HOOK_TOOLS = [
+    'add_source',
+    'apt_install',
+    'apt_update',
+    'relation_set',
+    'service_restart',
+    'service_running',
+    'service_start',
+    'service_stop',
+    'status_set',
+]
+
+
+def execute():
     try:
         hooks.execute(sys.argv)
+        run_restarts()
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
 
 
+def main():
+    if not pg_edge_trace.tracing_enabled():
+        execute()
+        return
+    import charmhelpers.core.hookenv
+    import charmhelpers.core.host
+    import charmhelpers.fetch
+    import pg_edge_context
+    import pg_edge_iptables
+    import pg_edge_jobs
+    import pg_edge_lcm
+    import pg_edge_restarts
+    pg_edge_trace.instrument(sys.modules[__name__], TRACED_HOOK_TOOLS)
+    pg_edge_trace.instrument(pg_edge_utils, TRACED_HOOK_TOOLS)
+    pg_edge_trace.instrument(pg_edge_iptables, TRACED_HOOK_TOOLS)
+    pg_edge_trace.instrument(pg_edge_restarts, TRACED_HOOK_TOOLS)
+    pg_edge_trace.count_forks([
+        charmhelpers.core.hookenv, charmhelpers.core.host, charmhelpers.fetch,
+        pg_edge_context, pg_edge_iptables, pg_edge_jobs, pg_edge_lcm,
+        pg_edge_restarts, pg_edge_utils])
+    with pg_edge_trace.trace_hook(os.path.basename(sys.argv[0])):
+        execute()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,101 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file manages the iptables rules which allow PLUMgrid communication
+# on the management network. The rules loaded by the charm are recorded in
+# unitdata, so that rules of a previous management network are removed,
+# and only the PLUMgrid INPUT rules are saved to the filter table restored
+# on boot, leaving rules loaded by other software alone.
+
+import os
+import subprocess
+from charmhelpers.core.hookenv import log, ERROR
+from charmhelpers.fetch import apt_install
+from pg_edge_tasks import kv
+from pg_edge_utils import installed_version, write_file_atomic
+
+IPTABLES_RULES = '/etc/iptables/rules.v4'
+IPTABLES_KV_KEY = 'pg_edge.iptables-rules'
+
+
+def load_rules(network):
+    '''
+    Loads the iptables rules which allow all PLUMgrid communication within
+    network, replacing those loaded for a previous network. Only missing
+    rules are loaded, in a single iptables-restore run.
+    '''
+    desired = pg_iptables_rules(network)
+    previous = kv().get(IPTABLES_KV_KEY, [])
+    current = set(_rule_key(rule) for rule in iptables_input_rules())
+    changes = ['-D%s' % rule[2:] for rule in previous
+               if rule not in desired and _rule_key(rule) in current]
+    changes += [rule for rule in desired if _rule_key(rule) not in current]
+    if changes:
+        restore = subprocess.Popen(['iptables-restore', '--noflush'],
+                                   stdin=subprocess.PIPE)
+        restore.communicate('*filter\n%s\nCOMMIT\n' % '\n'.join(changes))
+        if restore.returncode:
+            log('Error loading PLUMgrid iptables rules', level=ERROR)
+            return
+        persist_iptables(desired, previous)
+    kv().set(IPTABLES_KV_KEY, desired)
+    kv().flush()
+
+
+def pg_iptables_rules(network):
+    '''
+    Returns the INPUT rules, in iptables-save format, that allow all PLUMgrid
+    communication within network.
+    '''
+    return ['-A INPUT -s {0} -d {0} -p {1} -m state --state NEW -j ACCEPT'
+            .format(network, proto) for proto in ['tcp', 'udp']]
+
+
+def _rule_key(rule):
+    '''
+    Returns a key identifying rule regardless of the order of its options.
+    '''
+    return tuple(sorted(rule.split()))
+
+
+def iptables_input_rules():
+    '''
+    Returns the rules of the INPUT chain of the filter table.
+    '''
+    try:
+        rules = subprocess.check_output(['iptables-save', '-t', 'filter'])
+    except (OSError, subprocess.CalledProcessError):
+        log('Unable to read iptables rules', level=ERROR)
+        return []
+    return [line.strip() for line in rules.splitlines()
+            if line.startswith('-A INPUT ')]
+
+
+def persist_iptables(desired, previous=()):
+    '''
+    Replaces the PLUMgrid INPUT rules previous with desired in the filter
+    table restored on boot by iptables-persistent, installing it only if
+    it is missing. The other rules of the file are kept, and rules loaded
+    at runtime by other software, such as libvirt or nova, are not saved.
+    '''
+    if not installed_version('iptables-persistent'):
+        apt_install('iptables-persistent')
+    if not os.path.isdir(os.path.dirname(IPTABLES_RULES)):
+        return
+    try:
+        with open(IPTABLES_RULES) as rules:
+            lines = rules.read().splitlines()
+    except IOError:
+        lines = []
+    replaced = set(_rule_key(rule) for rule in list(previous) + desired)
+    kept = [line for line in lines
+            if not (line.startswith('-A INPUT ') and
+                    _rule_key(line) in replaced)]
+    if '*filter' not in kept:
+        kept += ['*filter', ':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]',
+                 ':OUTPUT ACCEPT [0:0]', 'COMMIT']
+    end = kept.index('COMMIT', kept.index('*filter'))
+    kept[end:end] = desired
+    if kept != lines:
+        write_file_atomic(IPTABLES_RULES,
+                          ''.join(line + '\n' for line in kept),
+                          perms=None if lines else 0o640)
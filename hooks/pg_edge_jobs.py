@@ -0,0 +1,180 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file runs long operations, such as package downloads and kernel
+# module builds, outside of hooks, so that they do not hold the Juju
+# machine lock and block the hooks of every other charm on the machine.
+# A job is a list of commands run one after the other by a transient
+# systemd unit, or by a detached worker where systemd is not running. The
+# worker records its progress in the job directory, where later hooks pick
+# the result up. Once done, the worker runs update-status through juju-run
+# so that the result is not left waiting for the next hook.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from charmhelpers.core.hookenv import local_unit, log
+
+JOBS_DIR = '/var/lib/plumgrid-edge/jobs'
+SYSTEMD_DIR = '/run/systemd/system'
+SPEC_FILE = 'spec.json'
+PROGRESS_FILE = 'progress.json'
+OUTPUT_FILE = 'output.log'
+# Seconds a job may take to record its worker before it is deemed lost
+JOB_START_TIMEOUT = 60
+OUTPUT_LINES = 20
+
+
+def _job_dir(name):
+    return os.path.join(JOBS_DIR, name)
+
+
+def _read(job_dir, filename):
+    try:
+        with open(os.path.join(job_dir, filename)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write(job_dir, filename, data):
+    '''
+    Writes data as json to filename of job_dir so that readers never see
+    it half written.
+    '''
+    path = os.path.join(job_dir, filename)
+    with open(path + '.new', 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(path + '.new', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _output_tail(job_dir):
+    try:
+        with open(os.path.join(job_dir, OUTPUT_FILE)) as output:
+            return output.read().splitlines()[-OUTPUT_LINES:]
+    except IOError:
+        return []
+
+
+def start_job(name, commands, meta=None, env=None):
+    '''
+    Starts job name running commands, a list of (description, argv)
+    pairs, one after the other in the background, with env added to the
+    environment of the hook. meta is kept with the job for the hook which
+    picks the result up. Returns False if the job is running already.
+    '''
+    state = job_state(name)
+    if state and state['status'] == 'running':
+        return False
+    job_dir = _job_dir(name)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    _write(job_dir, SPEC_FILE, {
+        'commands': [[description, list(cmd)]
+                     for description, cmd in commands],
+        'env': env or {},
+        'meta': meta or {},
+        'unit': local_unit(),
+    })
+    _write(job_dir, PROGRESS_FILE, {
+        'status': 'running',
+        'started': time.time(),
+        'step': 0,
+        'total': len(commands),
+    })
+    worker = [sys.executable, os.path.abspath(__file__), job_dir]
+    if os.path.isdir(SYSTEMD_DIR):
+        unit = 'plumgrid-edge-%s-%d' % (name, time.time())
+        subprocess.check_call(['systemd-run', '--unit=%s' % unit,
+                               '--description=PLUMgrid Edge %s' % name] +
+                              worker)
+    else:
+        with open(os.devnull) as devnull, \
+                open(os.path.join(job_dir, OUTPUT_FILE), 'a') as output:
+            subprocess.Popen(worker, stdin=devnull, stdout=output,
+                             stderr=subprocess.STDOUT, close_fds=True,
+                             preexec_fn=os.setsid)
+    log('Started background job %s: %s' % (
+        name, ', '.join(description for description, _ in commands)))
+    return True
+
+
+def job_state(name):
+    '''
+    Returns the progress of job name, None if there is no such job. The
+    status is 'running', 'done' or 'failed'; failed jobs come with the
+    last lines of their output.
+    '''
+    job_dir = _job_dir(name)
+    progress = _read(job_dir, PROGRESS_FILE)
+    if progress is None:
+        return None
+    if progress['status'] == 'running':
+        if 'pid' in progress:
+            lost = not _alive(progress['pid'])
+        else:
+            lost = time.time() - progress['started'] > JOB_START_TIMEOUT
+        if lost:
+            progress.update(status='failed', error='worker exited')
+    progress['meta'] = (_read(job_dir, SPEC_FILE) or {}).get('meta', {})
+    if progress['status'] == 'failed':
+        progress['output'] = _output_tail(job_dir)
+    return progress
+
+
+def clear_job(name):
+    '''
+    Forgets job name once its result was picked up.
+    '''
+    shutil.rmtree(_job_dir(name), ignore_errors=True)
+
+
+def run_worker(job_dir):
+    '''
+    Runs the commands of the job in job_dir, recording the progress, and
+    returns the exit code of the job.
+    '''
+    spec = _read(job_dir, SPEC_FILE)
+    progress = _read(job_dir, PROGRESS_FILE)
+    progress['pid'] = os.getpid()
+    env = dict(os.environ, **spec['env'])
+    returncode = 0
+    with open(os.path.join(job_dir, OUTPUT_FILE), 'a') as output:
+        for step, (description, cmd) in enumerate(spec['commands'], 1):
+            progress.update(step=step, description=description)
+            _write(job_dir, PROGRESS_FILE, progress)
+            output.write('=== %s: %s\n' % (description, ' '.join(cmd)))
+            output.flush()
+            try:
+                returncode = subprocess.call(cmd, stdin=open(os.devnull),
+                                             stdout=output,
+                                             stderr=subprocess.STDOUT,
+                                             env=env)
+            except OSError as e:
+                output.write('%s\n' % e)
+                returncode = 127
+            if returncode:
+                break
+    progress.update(status='failed' if returncode else 'done',
+                    returncode=returncode, finished=time.time())
+    _write(job_dir, PROGRESS_FILE, progress)
+    try:
+        subprocess.call(['juju-run', spec['unit'], 'hooks/update-status'],
+                        stdin=open(os.devnull))
+    except OSError:
+        pass
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(run_worker(sys.argv[1]))
@@ -0,0 +1,94 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file manages the keys which let PLUMgrid LCM log into the PLUMgrid
+# container. Keys are told apart by the fingerprint of their public key,
+# and the fingerprints of the keys the charm authorized are recorded in
+# unitdata, so that keys added to authorized_keys by other means are left
+# alone.
+
+import base64
+import hashlib
+import os
+import six
+from collections import OrderedDict
+from charmhelpers.core.hookenv import config, log, DEBUG
+from pg_edge_tasks import kv
+from pg_edge_utils import write_file_atomic
+
+LCM_KEYS_KV_KEY = 'pg_edge.lcm-keys'
+
+
+def lcm_keys():
+    '''
+    Returns the LCM public keys of the lcm-ssh-key config, one per line.
+    '''
+    keys = config('lcm-ssh-key') or ''
+    if keys == 'null':
+        return []
+    return [line.strip() for line in keys.splitlines()
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def ssh_key_fingerprint(key):
+    '''
+    Returns the SHA256 fingerprint of the public key of an authorized_keys
+    line, or of the whole line if it holds no key.
+    '''
+    for field in key.split():
+        if field.startswith('AAAA'):
+            try:
+                blob = base64.b64decode(field)
+            except (TypeError, ValueError):
+                continue
+            break
+    else:
+        blob = ' '.join(key.split())
+    if isinstance(blob, six.text_type):
+        blob = blob.encode('utf-8')
+    return 'SHA256:%s' % base64.b64encode(
+        hashlib.sha256(blob).digest()).rstrip('=')
+
+
+def authorize_keys(path):
+    '''
+    Makes the LCM keys of the config the keys authorized by the charm in
+    the authorized_keys file path. Keys the charm authorized before and
+    which are no longer configured are removed, keys added by other means
+    are kept. Configured keys found in the file, such as those appended by
+    earlier versions of the charm, are taken over by the charm. The file
+    is rewritten atomically, and only if keys changed. Returns the number
+    of keys added or removed.
+    '''
+    if not os.path.isdir(os.path.dirname(path)):
+        log('plumgrid-lxc not installed yet')
+        return 0
+    desired = OrderedDict((ssh_key_fingerprint(key), key)
+                          for key in lcm_keys())
+    owned = set(kv().get(LCM_KEYS_KV_KEY, []))
+    try:
+        with open(path, 'r') as auth_keys:
+            lines = auth_keys.read().splitlines()
+    except IOError:
+        lines = []
+    present = set()
+    kept = []
+    removed = 0
+    for line in lines:
+        fingerprint = ssh_key_fingerprint(line) if line.strip() else None
+        if fingerprint in owned and fingerprint not in desired:
+            removed += 1
+            continue
+        present.add(fingerprint)
+        kept.append(line)
+    added = [key for digest, key in desired.items()
+             if digest not in present]
+    if added or removed:
+        write_file_atomic(path,
+                          ''.join(line + '\n' for line in kept + added),
+                          perms=None if lines else 0o600)
+        log('Authorized %d LCM key(s), removed %d' % (len(added), removed))
+    else:
+        log('LCM keys already authorized', level=DEBUG)
+    kv().set(LCM_KEYS_KV_KEY, sorted(desired))
+    kv().flush()
+    return len(added) + removed
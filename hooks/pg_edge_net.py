@@ -0,0 +1,310 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file contains an in-process inventory of the network interfaces of
+# the node, built from /sys/class/net and an rtnetlink socket instead of
+# spawning ip or ohai.
+
+import os
+import socket
+import struct
+import threading
+from charmhelpers.core.hookenv import (
+    cached,
+    flush,
+    log,
+    WARNING,
+)
+from pg_edge_trace import traced
+
+SYS_CLASS_NET = '/sys/class/net'
+MTU_WORKERS = 8
+
+# Constants from linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_DST = 1
+RTA_OIF = 4
+RT_TABLE_MAIN = 254
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+
+NLMSGHDR = struct.Struct('=IHHII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _read_sysfs(path):
+    '''
+    Returns the stripped content of a sysfs attribute or None.
+    '''
+    try:
+        with open(path, 'r') as attr:
+            return attr.read().strip()
+    except IOError:
+        return None
+
+
+def _read_int(path):
+    value = _read_sysfs(path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _attributes(data, offset, end):
+    '''
+    Returns a dict of the rtattr type and payload found in data[offset:end].
+    '''
+    attrs = {}
+    while offset + RTATTR.size <= end:
+        length, rta_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[rta_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_messages(data):
+    '''
+    Yields the type, flags and payload offsets of every netlink message
+    in data.
+    '''
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, flags, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield msg_type, offset + NLMSGHDR.size, offset + length
+        offset += _align(length)
+
+
+def parse_addresses(data):
+    '''
+    Returns a list of (ifindex, address/prefixlen) parsed from RTM_NEWADDR
+    messages.
+    '''
+    addresses = []
+    for msg_type, start, end in parse_messages(data):
+        if msg_type != RTM_NEWADDR:
+            continue
+        family, prefixlen, _, _, index = IFADDRMSG.unpack_from(data, start)
+        attrs = _attributes(data, start + IFADDRMSG.size, end)
+        address = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if address is None:
+            continue
+        addresses.append(
+            (index, '%s/%d' % (socket.inet_ntop(family, address), prefixlen)))
+    return addresses
+
+
+def parse_connected_routes(data):
+    '''
+    Returns a list of (ifindex, network/prefixlen) for the link scoped
+    unicast routes of the main table parsed from RTM_NEWROUTE messages.
+    '''
+    routes = []
+    for msg_type, start, end in parse_messages(data):
+        if msg_type != RTM_NEWROUTE:
+            continue
+        (family, dst_len, _, _, table, _, scope, rtm_type,
+         _) = RTMSG.unpack_from(data, start)
+        if (table != RT_TABLE_MAIN or scope != RT_SCOPE_LINK or
+                rtm_type != RTN_UNICAST):
+            continue
+        attrs = _attributes(data, start + RTMSG.size, end)
+        if RTA_DST not in attrs or RTA_OIF not in attrs:
+            continue
+        index = struct.unpack('=I', attrs[RTA_OIF])[0]
+        routes.append(
+            (index, '%s/%d' % (socket.inet_ntop(family, attrs[RTA_DST]),
+                               dst_len)))
+    return routes
+
+
+def _netlink_dump(msg_type, payload):
+    '''
+    Sends a rtnetlink dump request and returns the raw reply.
+    '''
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        request = NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                                NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + payload
+        sock.send(request)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            chunks.append(chunk)
+            types = [msg[0] for msg in parse_messages(chunk)]
+            if NLMSG_DONE in types or NLMSG_ERROR in types or not types:
+                break
+        return ''.join(chunks)
+    finally:
+        sock.close()
+
+
+@traced
+def interface_snapshot():
+    '''
+    Returns a dict describing every network interface of the node: index,
+    MTU, bridge master, bridge members, addresses and connected routes.
+    '''
+    interfaces = {}
+    by_index = {}
+    try:
+        names = os.listdir(SYS_CLASS_NET)
+    except OSError:
+        names = []
+    for name in names:
+        path = os.path.join(SYS_CLASS_NET, name)
+        master = os.path.join(path, 'master')
+        brif = os.path.join(path, 'brif')
+        iface = {
+            'index': _read_int(os.path.join(path, 'ifindex')),
+            'mtu': _read_int(os.path.join(path, 'mtu')),
+            'master': (os.path.basename(os.readlink(master))
+                       if os.path.islink(master) else None),
+            'bridge_members': (sorted(os.listdir(brif))
+                               if os.path.isdir(brif) else None),
+            'addresses': [],
+            'routes': [],
+        }
+        interfaces[name] = iface
+        by_index[iface['index']] = iface
+    try:
+        for index, address in parse_addresses(_netlink_dump(
+                RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))):
+            if index in by_index:
+                by_index[index]['addresses'].append(address)
+        for index, route in parse_connected_routes(_netlink_dump(
+                RTM_GETROUTE, RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0,
+                                         0, 0))):
+            if index in by_index:
+                by_index[index]['routes'].append(route)
+    except socket.error as e:
+        log('Unable to query rtnetlink: %s' % e, level=WARNING)
+    return interfaces
+
+
+@cached
+def snapshot():
+    '''
+    Returns the interface snapshot, taken at most once per hook execution
+    until flush_snapshot() is called.
+    '''
+    return interface_snapshot()
+
+
+def flush_snapshot():
+    '''
+    Drops the cached snapshot, to be called after interfaces changed.
+    '''
+    flush('snapshot')
+
+
+def interface_exists(interface):
+    return interface in snapshot()
+
+
+def bridge_members(bridge):
+    return list(snapshot().get(bridge, {}).get('bridge_members') or [])
+
+
+def interface_for_address(address):
+    '''
+    Returns the interface holding address, or None.
+    '''
+    for name, iface in sorted(snapshot().iteritems()):
+        if address in [a.split('/')[0] for a in iface['addresses']]:
+            return name
+    return None
+
+
+def connected_network(interface):
+    '''
+    Returns the first IPv4 network directly connected to interface, in
+    CIDR notation, or None.
+    '''
+    routes = snapshot().get(interface, {}).get('routes') or []
+    return routes[0] if routes else None
+
+
+def read_mtu(interface):
+    '''
+    Returns the current MTU of interface read from sysfs, or None.
+    '''
+    return _read_int(os.path.join(SYS_CLASS_NET, interface, 'mtu'))
+
+
+def _write_mtu(interface, mtu):
+    with open(os.path.join(SYS_CLASS_NET, interface, 'mtu'), 'w') as attr:
+        attr.write(str(mtu))
+
+
+def _apply_mtu(interfaces, mtu):
+    '''
+    Sets the MTU of interfaces concurrently, as drivers may take a while
+    to bring a link back up, and returns the errors per interface.
+    '''
+    errors = {}
+
+    def apply(interface):
+        try:
+            _write_mtu(interface, mtu)
+        except (IOError, OSError) as e:
+            errors[interface] = e
+
+    for i in range(0, len(interfaces), MTU_WORKERS):
+        threads = [threading.Thread(target=apply, args=(interface,))
+                   for interface in interfaces[i:i + MTU_WORKERS]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return errors
+
+
+@traced
+def reconcile_mtu(stages, mtu):
+    '''
+    Sets the MTU of the interfaces of every stage, a list of lists of
+    interfaces, one stage after the other. Only interfaces whose current
+    MTU differs are changed, since setting the MTU resets the link on
+    some drivers even when it is unchanged. Returns the list of
+    (interface, previous MTU, MTU) changed, raises ValueError, before
+    going on with the next stage, if some interface could not be changed.
+    '''
+    mtu = int(mtu)
+    changes = []
+    for stage in stages:
+        current = dict((interface, read_mtu(interface))
+                       for interface in stage)
+        pending = [interface for interface in stage
+                   if current[interface] != mtu]
+        if not pending:
+            continue
+        errors = _apply_mtu(pending, mtu)
+        flush_snapshot()
+        changes.extend((interface, current[interface], mtu)
+                       for interface in pending if interface not in errors)
+        if errors:
+            raise ValueError('Unable to set MTU %d on %s: %s' % (
+                mtu, ', '.join(sorted(errors)),
+                '; '.join(str(errors[i]) for i in sorted(errors))))
+    return changes
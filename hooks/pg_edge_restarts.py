@@ -0,0 +1,307 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file coordinates the restarts of PLUMgrid service. Hooks request
+# actions on the service, which are deduplicated and carried out at the
+# end of the hook with at most one stop and one start, upgrades being
+# downloaded and built before the service is stopped. Requests and the
+# progress of a restart are kept in unitdata, so that a failed hook is
+# resumed by the next one, and when rolling restarts are enabled the
+# restart waits for a slot handed out by the leader (see pg_edge_rolling).
+
+import time
+import pg_edge_jobs
+import pg_edge_rolling
+from collections import OrderedDict
+from contextlib import contextmanager
+from charmhelpers.core import hookenv
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    status_set,
+    DEBUG,
+)
+from charmhelpers.core.host import service_running
+from pg_edge_tasks import kv
+from pg_edge_trace import span, traced
+from pg_edge_utils import (
+    configure_pg_sources,
+    determine_packages,
+    install_pg,
+    load_iovisor,
+    missing_debs,
+    prebuild_iovisor,
+    prefetch_pg,
+    remove_iovisor,
+    start_pg,
+    stop_pg,
+)
+
+RESTART_CACHE_KEY = 'pg-edge-restarts'
+RESTART_KV_KEY = 'pg_edge.restarts'
+RESTART_TIMING_KV_KEY = 'pg_edge.restart-timing'
+RESTART_CHECKPOINT_KV_KEY = 'pg_edge.restart-checkpoint'
+UPGRADE_JOB = 'upgrade'
+# Steps of a restart which only have to be redone for other packages
+UPGRADE_STEPS = ('prefetch', 'prebuild', 'install')
+# Phases of a restart during which PLUMgrid service is down
+OUTAGE_PHASES = ('stop', 'install', 'reload', 'start')
+RESTART_ACTIONS = ('start', 'restart', 'reload', 'upgrade')
+# Actions which take a running PLUMgrid service down
+DISRUPTIVE_ACTIONS = ('restart', 'reload', 'upgrade')
+
+
+def _requests():
+    '''
+    Returns the restart requests of the current hook.
+    '''
+    return hookenv.cache.setdefault(RESTART_CACHE_KEY, OrderedDict())
+
+
+def request_restart(action='restart', reason=None):
+    '''
+    Requests an action on PLUMgrid service for the current hook:
+    'start' makes sure the service runs at the end of the hook, 'restart'
+    restarts it at the end of the hook, 'reload' also reloads the iovisor
+    kernel module while it is stopped and 'upgrade' upgrades the PLUMgrid
+    packages while it is stopped. Requests are deduplicated and carried out
+    by run_restarts(). They are also stored in unitdata right away, as the
+    charm config is saved once the hook function returns, so that a hook
+    retried after run_restarts() failed still carries them out.
+    '''
+    if action not in RESTART_ACTIONS:
+        raise ValueError('Unknown PLUMgrid service action: %s' % action)
+    _requests().setdefault(action, []).append(reason)
+    stored = kv().get(RESTART_KV_KEY) or {}
+    if reason not in stored.get(action, ()):
+        stored.setdefault(action, []).append(reason)
+        kv().set(RESTART_KV_KEY, stored)
+        kv().flush()
+
+
+@traced
+def run_restarts():
+    '''
+    Carries out the restart requests of the current hook, and those
+    deferred or left incomplete by earlier hooks, with at most one stop and
+    one start of PLUMgrid service. When other edges are related, requests
+    which would take a running PLUMgrid down are deferred until the leader
+    hands this unit a restart slot, which is only requested once the
+    packages of an upgrade are downloaded and built. Every completed step
+    is checkpointed in unitdata, so that the hook following a failure
+    resumes at the first incomplete step. Returns the actions taken.
+    '''
+    requests = _requests()
+    checkpoint = kv().get(RESTART_CHECKPOINT_KV_KEY) or {}
+    for stored in (kv().get(RESTART_KV_KEY) or {},
+                   checkpoint.get('requests', {})):
+        for action, reasons in stored.items():
+            action_reasons = requests.setdefault(action, [])
+            action_reasons.extend(r for r in reasons
+                                  if r not in action_reasons)
+    if not requests:
+        return []
+    reasons = sorted(set(r for rs in requests.values() for r in rs if r))
+    for action, action_reasons in requests.items():
+        log('PLUMgrid service %s requested for %s' % (
+            action, ', '.join(sorted(set(r for r in action_reasons if r))) or
+            'hook'), level=DEBUG)
+    done = checkpoint.get('done', [])
+    packages = checkpoint.get('packages')
+    if ('upgrade' in requests and config('background-upgrades') and
+            'prefetch' not in done):
+        packages = prepare_upgrade()
+        if packages is None:
+            log('PLUMgrid service actions deferred until the upgrade is '
+                'prepared')
+            _defer_restarts(requests)
+            return []
+        done = [step for step in done if step not in UPGRADE_STEPS]
+        _checkpoint(requests, done, 'prefetch', packages)
+    if done:
+        log('Resuming PLUMgrid service actions after %s' % ', '.join(done))
+    else:
+        _checkpoint(requests, done, None, packages)
+    actions = []
+    phases = OrderedDict()
+    if 'upgrade' in requests:
+        if 'prefetch' in done and not _prefetched(packages):
+            log('PLUMgrid packages changed since the interrupted upgrade, '
+                'starting it over')
+            done = [step for step in done if step not in UPGRADE_STEPS]
+        if 'prefetch' not in done:
+            with _phase(phases, 'prefetch'):
+                packages = prefetch_pg()
+            _checkpoint(requests, done, 'prefetch', packages)
+        if 'prebuild' not in done:
+            with _phase(phases, 'prebuild'):
+                if prebuild_iovisor(packages):
+                    requests.setdefault('reload', []).append('iovisor-dkms')
+            _checkpoint(requests, done, 'prebuild', packages)
+    # Downloads and builds don't take PLUMgrid down, the restart slot is
+    # only needed from here on
+    if (any(action in requests for action in DISRUPTIVE_ACTIONS) and
+            service_running('plumgrid') and pg_edge_rolling.coordinated()):
+        if not pg_edge_rolling.request_slot(reasons):
+            log('PLUMgrid service actions deferred until this unit holds a '
+                'restart slot')
+            _defer_restarts(requests)
+            return []
+        pg_edge_rolling.wait_jitter()
+    stopped = False
+    if any(action in requests for action in DISRUPTIVE_ACTIONS):
+        if 'stop' not in done or service_running('plumgrid'):
+            with _phase(phases, 'stop'):
+                stop_pg()
+            _checkpoint(requests, done, 'stop', packages)
+            actions.append('stop')
+        stopped = True
+    if 'upgrade' in requests and 'install' not in done:
+        with _phase(phases, 'install'):
+            if install_pg(packages):
+                requests.setdefault('reload', []).append('iovisor-dkms')
+        _checkpoint(requests, done, 'install', packages)
+        actions.append('upgrade')
+    if 'reload' in requests and 'reload' not in done:
+        with _phase(phases, 'reload'):
+            remove_iovisor()
+            load_iovisor()
+        _checkpoint(requests, done, 'reload', packages)
+        actions.append('reload')
+    if stopped or not service_running('plumgrid'):
+        with _phase(phases, 'start'):
+            start_pg()
+        actions.append('start')
+    requests.clear()
+    kv().unset(RESTART_KV_KEY)
+    kv().unset(RESTART_CHECKPOINT_KV_KEY)
+    if phases:
+        _record_phases(actions, phases)
+    kv().flush()
+    pg_edge_rolling.release_slot()
+    log('PLUMgrid service actions: %s' % (', '.join(actions) or 'none'))
+    return actions
+
+
+def _defer_restarts(requests):
+    '''
+    Stores requests in unitdata for a later hook to carry them out.
+    '''
+    kv().set(RESTART_KV_KEY, dict(
+        (action, sorted(set(action_reasons)))
+        for action, action_reasons in requests.items()))
+    kv().flush()
+    requests.clear()
+
+
+def prepare_upgrade():
+    '''
+    Downloads the packages of an upgrade in a background job, while
+    PLUMgrid keeps running and the hooks of the machine are not held up.
+    Only the download runs outside the hook: installing iovisor-dkms runs
+    dpkg, which must not race the apt runs of other charms, so its module
+    is built by the hook once the packages are downloaded. Starts the job
+    or reports its progress and returns None until it is done, then the
+    packages.
+    '''
+    job = pg_edge_jobs.job_state(UPGRADE_JOB)
+    if job is not None and job['status'] == 'running':
+        status_set('maintenance', '%s in the background (%d/%d)' % (
+            job.get('description', 'Preparing PLUMgrid upgrade'),
+            job['step'], job['total']))
+        return None
+    configure_pg_sources(update=True)
+    packages = determine_packages()
+    if job is not None:
+        pg_edge_jobs.clear_job(UPGRADE_JOB)
+        if job['status'] == 'failed':
+            raise ValueError('Preparing the PLUMgrid upgrade failed: %s' % (
+                '; '.join(job['output'][-3:]) or job.get('error')))
+        if job['meta']['packages'] == packages:
+            missing = missing_debs(packages)
+            if missing:
+                raise ValueError('PLUMgrid packages were not downloaded: %s'
+                                 % ', '.join(missing))
+            return packages
+        log('PLUMgrid packages changed while the upgrade was prepared, '
+            'preparing it again')
+    pg_edge_jobs.start_job(UPGRADE_JOB, [
+        ('Downloading PLUMgrid packages',
+         ['apt-get', '--assume-yes', '--force-yes', '--download-only',
+          'install'] + packages),
+    ], meta={'packages': packages}, env={'DEBIAN_FRONTEND': 'noninteractive'})
+    status_set('maintenance', 'Preparing PLUMgrid upgrade in the background')
+    return None
+
+
+def _checkpoint(requests, done, step, packages):
+    '''
+    Records in unitdata that step of the restart carrying out requests
+    completed, after the steps done, with packages as the packages of the
+    upgrade. A step of None records the requests before the first step.
+    '''
+    if step is not None:
+        done.append(step)
+    kv().set(RESTART_CHECKPOINT_KV_KEY, {
+        'requests': dict((action, sorted(set(reasons)))
+                         for action, reasons in requests.items()),
+        'done': done,
+        'packages': packages,
+    })
+    kv().flush()
+
+
+def _prefetched(packages):
+    '''
+    Returns True if packages, downloaded by an interrupted upgrade, are
+    still the packages to upgrade to and are still in the apt archives.
+    '''
+    if not packages or packages != determine_packages():
+        return False
+    return not missing_debs(packages)
+
+
+def cancel_restarts():
+    '''
+    Drops the restart requests of the current hook and those deferred or
+    left incomplete by earlier hooks.
+    '''
+    _requests().clear()
+    kv().unset(RESTART_KV_KEY)
+    kv().unset(RESTART_CHECKPOINT_KV_KEY)
+    kv().flush()
+
+
+@contextmanager
+def _phase(phases, name):
+    '''
+    Times the enclosed block as phase name of a restart.
+    '''
+    start = time.time()
+    with span('phase:%s' % name):
+        yield
+    phases[name] = (start, time.time())
+
+
+def _record_phases(actions, phases):
+    '''
+    Logs and records in unitdata how long every phase of a restart took
+    and how long PLUMgrid service was down.
+    '''
+    durations = OrderedDict((name, round(end - start, 3))
+                            for name, (start, end) in phases.items())
+    down = [phases[name] for name in OUTAGE_PHASES if name in phases]
+    outage = None
+    if 'stop' in phases and 'start' in phases:
+        outage = round(phases['start'][1] - phases['stop'][0], 3)
+    elif down:
+        outage = round(sum(end - start for start, end in down), 3)
+    log('PLUMgrid service %s: %s, outage %s' % (
+        ', '.join(actions), ', '.join('%s %.1fs' % (name, elapsed)
+                                      for name, elapsed in durations.items()),
+        '%.1fs' % outage if outage is not None else 'none'))
+    kv().set(RESTART_TIMING_KV_KEY, {
+        'time': time.time(),
+        'actions': actions,
+        'phases': list(durations.items()),
+        'outage': outage,
+    })
@@ -0,0 +1,193 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file coordinates disruptive actions on PLUMgrid service across the
+# edges of a model, so that upgrades and restarts roll through the fleet
+# instead of taking the whole overlay fabric down at once. Units publish a
+# request token on the edge-peers relation and run their deferred actions
+# once the leader has handed them a slot in the leader settings.
+
+import json
+import random
+import time
+from charmhelpers.core.hookenv import (
+    config,
+    is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    log,
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
+    status_set,
+    DEBUG,
+)
+from charmhelpers.core.unitdata import kv
+from pg_edge_trace import traced
+
+PEER_RELATION = 'edge-peers'
+REQUEST_KEY = 'restart-request'
+DONE_KEY = 'restart-done'
+SLOTS_KEY = 'restart-slots'
+PROGRESS_KEY = 'restart-progress'
+ROLLING_KV_KEY = 'pg_edge.rolling'
+
+
+def peer_relation_id():
+    '''
+    Returns the id of the edge-peers relation, None if it is not there.
+    '''
+    rids = relation_ids(PEER_RELATION)
+    return rids[0] if rids else None
+
+
+def _leader():
+    '''
+    Returns True if this unit is the leader, False if it is not or Juju
+    has no leadership support.
+    '''
+    try:
+        return is_leader()
+    except NotImplementedError:
+        return False
+
+
+def coordinated():
+    '''
+    Returns True if disruptive actions of this unit have to wait for a
+    restart slot: rolling restarts are enabled, other edges are related
+    as peers and Juju supports leadership.
+    '''
+    if not config('rolling-restart-concurrency'):
+        return False
+    rid = peer_relation_id()
+    if rid is None or not related_units(rid):
+        return False
+    try:
+        is_leader()
+    except NotImplementedError:
+        return False
+    return True
+
+
+def _slots():
+    return json.loads(leader_get(SLOTS_KEY) or '{}')
+
+
+def _peer_requests(rid):
+    '''
+    Returns the request and done tokens published by every edge, this one
+    included.
+    '''
+    requests = {}
+    for unit in related_units(rid) + [local_unit()]:
+        settings = relation_get(rid=rid, unit=unit) or {}
+        requests[unit] = (settings.get(REQUEST_KEY),
+                          settings.get(DONE_KEY))
+    return requests
+
+
+def allocate_slots():
+    '''
+    Frees the slots of edges which are done or gone and hands the free
+    slots out to waiting edges in the order of their requests. To be run on
+    the leader. Returns the slots, a dict of unit to request token.
+    '''
+    rid = peer_relation_id()
+    if rid is None:
+        return {}
+    requests = _peer_requests(rid)
+    current = _slots()
+    slots = dict((unit, token) for unit, token in current.items()
+                 if unit in requests and requests[unit][0] == token and
+                 requests[unit][1] != token)
+    pending = sorted((request, unit)
+                     for unit, (request, done) in requests.items()
+                     if request and request != done)
+    free = max(int(config('rolling-restart-concurrency')) - len(slots), 0)
+    for request, unit in [p for p in pending if p[1] not in slots][:free]:
+        slots[unit] = request
+    finished = [unit for unit, (request, done) in requests.items()
+                if request and request == done]
+    progress = '%d/%d edges done, %d restarting, %d waiting' % (
+        len(finished), len(finished) + len(pending), len(slots),
+        len(pending) - len(slots))
+    if slots != current or leader_get(PROGRESS_KEY) != progress:
+        log('Restart slots: %s (%s)' % (
+            ', '.join(sorted(slots)) or 'none', progress))
+        leader_set({SLOTS_KEY: json.dumps(slots, sort_keys=True),
+                    PROGRESS_KEY: progress})
+    return slots
+
+
+def update_slots():
+    '''
+    Reallocates the restart slots if this unit is the leader.
+    '''
+    if _leader():
+        allocate_slots()
+
+
+@traced
+def request_slot(reasons):
+    '''
+    Queues this edge for a restart slot for reasons, keeping its place if
+    it is already queued, and returns True if it holds a slot.
+    '''
+    state = kv().get(ROLLING_KV_KEY) or {}
+    if not state.get('token'):
+        state = {'token': '%d' % (time.time() * 1000), 'reasons': []}
+    state['reasons'] = sorted(set(state['reasons']) | set(reasons))
+    kv().set(ROLLING_KV_KEY, state)
+    kv().flush()
+    rid = peer_relation_id()
+    if relation_get(REQUEST_KEY, rid=rid, unit=local_unit()) != \
+            state['token']:
+        relation_set(relation_id=rid, **{REQUEST_KEY: state['token']})
+    if _leader():
+        allocate_slots()
+    if holds_slot():
+        return True
+    status_set('waiting', 'Waiting for a restart slot for %s: %s' % (
+        ', '.join(state['reasons']) or 'restart',
+        leader_get(PROGRESS_KEY) or 'queued'))
+    return False
+
+
+def holds_slot():
+    '''
+    Returns True if the leader handed this edge a slot for its current
+    request.
+    '''
+    state = kv().get(ROLLING_KV_KEY) or {}
+    return bool(state.get('token') and
+                _slots().get(local_unit()) == state['token'])
+
+
+def release_slot():
+    '''
+    Marks the current request of this edge as done, freeing its slot.
+    '''
+    state = kv().get(ROLLING_KV_KEY) or {}
+    if not state.get('token'):
+        return
+    rid = peer_relation_id()
+    if rid is not None:
+        relation_set(relation_id=rid, **{DONE_KEY: state['token']})
+    kv().unset(ROLLING_KV_KEY)
+    kv().flush()
+    if rid is not None and _leader():
+        allocate_slots()
+
+
+def wait_jitter():
+    '''
+    Sleeps up to rolling-restart-jitter seconds, so that edges granted a
+    slot at the same time do not restart in lockstep.
+    '''
+    jitter = config('rolling-restart-jitter')
+    if jitter:
+        delay = random.uniform(0, jitter)
+        log('Waiting %.1fs before restarting' % delay, level=DEBUG)
+        time.sleep(delay)
@@ -0,0 +1,186 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file runs the steps of a hook which do not depend on each other
+# concurrently. The unitdata store of the hook can only be used by the
+# thread which opened it, so the worker threads running steps are handed
+# a SharedStore which passes their unitdata calls to that thread. Code
+# which may run in a step gets the unitdata store through kv().
+
+import threading
+import time
+import traceback
+import six
+from collections import OrderedDict
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import log, ERROR
+
+TASKS_KV_PREFIX = 'pg_edge.tasks.'
+TASK_WORKERS = 4
+
+_worker = threading.local()
+
+
+def kv():
+    '''
+    Returns the unitdata store: the SharedStore handed to the worker thread
+    running a step, the store of the hook in any other thread.
+    '''
+    store = getattr(_worker, 'store', None)
+    if store is None:
+        return unitdata.kv()
+    return store
+
+
+class SharedStore(object):
+    '''
+    Stands in for the unitdata store in the worker threads of a TaskGraph.
+    The sqlite connection of the store can only be used by the thread
+    which opened it, so calls from other threads are put on calls and wait
+    for that thread to run them.
+    '''
+
+    def __init__(self, store, calls):
+        self._store = store
+        self._calls = calls
+        self._owner = threading.current_thread()
+
+    def __getattr__(self, attr):
+        method = getattr(self._store, attr)
+        if threading.current_thread() is self._owner:
+            return method
+
+        def call(*args, **kwargs):
+            reply = six.moves.queue.Queue(1)
+            self._calls.put((None, (method, args, kwargs, reply)))
+            error, value = reply.get()
+            if error is not None:
+                raise error
+            return value
+        return call
+
+
+class TaskGraph(object):
+    '''
+    Runs steps of a hook which declare the steps they depend on and the
+    resources they use, such as 'apt', running independent steps
+    concurrently in worker threads. Every worker thread is handed the
+    SharedStore of the run, which steps reach through kv(), steps which
+    must run in the thread running the TaskGraph are added with
+    main_thread=True. A failed step fails its dependents, the others still
+    run.
+    '''
+
+    def __init__(self, name, workers=TASK_WORKERS):
+        self.name = name
+        self.workers = workers
+        self.tasks = OrderedDict()
+
+    def add(self, name, func, requires=(), locks=(), main_thread=False):
+        for dep in requires:
+            if dep not in self.tasks:
+                raise ValueError('Step %s requires unknown step %s'
+                                 % (name, dep))
+        self.tasks[name] = {
+            'func': func,
+            'requires': list(requires),
+            'locks': set(locks),
+            'main_thread': main_thread,
+        }
+
+    def _run_task(self, name, store=None, done=None):
+        start = time.time()
+        _worker.store = store
+        try:
+            self.tasks[name]['func']()
+            result = {'status': 'done', 'error': None}
+        except (Exception, SystemExit) as e:
+            log('Step %s failed: %s' % (name, traceback.format_exc()),
+                level=ERROR)
+            result = {'status': 'failed', 'error': e}
+        finally:
+            _worker.store = None
+        result['elapsed'] = time.time() - start
+        if done is None:
+            return result
+        done.put((name, result))
+
+    def _ready(self, name, results, held):
+        task = self.tasks[name]
+        return (all(dep in results for dep in task['requires']) and
+                not task['locks'] & held)
+
+    def run(self):
+        '''
+        Runs all steps and returns their status and duration. Raises the
+        error of the first failed step once all steps are finished.
+        '''
+        done = six.moves.queue.Queue()
+        pending = list(self.tasks)
+        results = OrderedDict()
+        running = set()
+        held = set()
+
+        def finish(name, result):
+            results[name] = result
+            running.discard(name)
+            held.difference_update(self.tasks[name]['locks'])
+            log('Step %s %s in %.2fs' % (name, result['status'],
+                                         result['elapsed']))
+
+        def receive(name, message):
+            if name is not None:
+                finish(name, message)
+                return
+            # A unitdata call of a step running in a worker thread
+            method, args, kwargs, reply = message
+            try:
+                reply.put((None, method(*args, **kwargs)))
+            except Exception as e:
+                reply.put((e, None))
+
+        store = SharedStore(kv(), done)
+        while pending or running:
+            for name in list(pending):
+                task = self.tasks[name]
+                failed = [dep for dep in task['requires']
+                          if results.get(dep, {}).get('status') in
+                          ['failed', 'skipped']]
+                if failed:
+                    pending.remove(name)
+                    finish(name, {'status': 'skipped', 'elapsed': 0,
+                                  'error': None})
+            threaded = [name for name in pending
+                        if not self.tasks[name]['main_thread']]
+            for name in threaded:
+                if (len(running) < self.workers and
+                        self._ready(name, results, held)):
+                    pending.remove(name)
+                    running.add(name)
+                    held.update(self.tasks[name]['locks'])
+                    threading.Thread(target=self._run_task,
+                                     args=(name, store, done)).start()
+            inline = [name for name in pending
+                      if self.tasks[name]['main_thread'] and
+                      self._ready(name, results, held)]
+            if inline:
+                name = inline[0]
+                pending.remove(name)
+                held.update(self.tasks[name]['locks'])
+                finish(name, self._run_task(name))
+            elif running:
+                receive(*done.get())
+            elif pending:
+                raise ValueError('Steps %s can not be scheduled'
+                                 % ', '.join(pending))
+            while not done.empty():
+                receive(*done.get())
+
+        kv().set(TASKS_KV_PREFIX + self.name, dict(
+            (name, {'status': res['status'],
+                    'elapsed': round(res['elapsed'], 3)})
+            for name, res in results.items()))
+        kv().flush()
+        for name, result in results.items():
+            if result['error'] is not None:
+                raise result['error']
+        return results
@@ -0,0 +1,115 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file contains the renderer used to write PLUMgrid template files.
+
+import hashlib
+import json
+import os
+import six
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    ERROR,
+    INFO,
+)
+from charmhelpers.core.unitdata import kv
+from pg_edge_trace import span, traced
+from pg_edge_utils import write_file_atomic
+
+RENDER_KV_PREFIX = 'pg_edge.render.'
+
+
+class PGConfigRenderer(templating.OSConfigRenderer):
+    '''
+    OSConfigRenderer that fingerprints the template context and source of
+    every config file and only renders and writes files whose fingerprint
+    differs from the one recorded in unitdata on the previous write, or
+    whose content changed since, so that files edited outside the charm
+    are repaired.
+    '''
+
+    def _template_source(self, config_file):
+        '''
+        Resolves the template of config_file the same way render() does and
+        returns its name and source.
+        '''
+        self._get_tmpl_env()
+        names = [os.path.basename(config_file),
+                 '_'.join(config_file.split('/')[1:])]
+        for name in names:
+            try:
+                return name, self._tmpl_env.loader.get_source(
+                    self._tmpl_env, name)[0]
+            except templating.exceptions.TemplateNotFound:
+                continue
+        log('Could not load template from %s by %s or %s.' %
+            (self.templates_dir, names[0], names[1]), level=ERROR)
+        raise templating.OSConfigException
+
+    def _write(self, config_file):
+        '''
+        Writes config_file if its fingerprint changed, returns True when the
+        file has been written.
+        '''
+        if config_file not in self.templates:
+            log('Config not registered: %s' % config_file, level=ERROR)
+            raise templating.OSConfigException
+        ctxt = self.templates[config_file].context()
+        name, source = self._template_source(config_file)
+        fingerprint = render_fingerprint(ctxt, source, self.openstack_release)
+        key = RENDER_KV_PREFIX + config_file
+        if kv().get(key) == {'fingerprint': fingerprint,
+                             'content': content_digest(config_file)}:
+            log('Template %s unchanged, skipping.' % config_file, level=DEBUG)
+            return False
+        log('Rendering from template: %s' % name, level=INFO)
+        with span('render:%s' % os.path.basename(config_file)):
+            rendered = self._tmpl_env.get_template(name).render(ctxt)
+            write_file_atomic(config_file, rendered)
+        kv().set(key, {'fingerprint': fingerprint,
+                       'content': content_digest(config_file)})
+        log('Wrote template %s.' % config_file, level=INFO)
+        return True
+
+    def write(self, config_file):
+        '''
+        Write a single config file if it changed, raises if config file is
+        not registered.
+        '''
+        written = self._write(config_file)
+        kv().flush()
+        return written
+
+    @traced
+    def write_all(self):
+        '''
+        Write out all registered config files which changed and returns the
+        list of files actually written.
+        '''
+        written = [k for k in six.iterkeys(self.templates) if self._write(k)]
+        kv().flush()
+        return written
+
+
+def render_fingerprint(ctxt, source, release=None):
+    '''
+    Returns a digest identifying the output of rendering source with ctxt.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(ctxt, sort_keys=True, default=str))
+    digest.update(source.encode('utf-8')
+                  if isinstance(source, six.text_type) else source)
+    digest.update(str(release))
+    return digest.hexdigest()
+
+
+def content_digest(path):
+    '''
+    Returns a digest of the content of path, None if it does not exist.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
@@ -0,0 +1,291 @@
+# Copyright (c) 2015, PLUMgrid Inc, http://plumgrid.com
+
+# This file contains a lightweight tracer which records nested spans with
+# wall time and fork counts for a hook execution, and keeps a rolling
+# history of hook traces under the charm directory. Hooks are only traced
+# when they run with PG_EDGE_TRACE set, so that the hooks of a deployment
+# are not slowed down by it.
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+TRACE_ENV = 'PG_EDGE_TRACE'
+TRACE_DIR = '.pg-edge-traces'
+HISTORY_FILE = 'history.jsonl'
+TRACE_HISTORY = 50
+SUMMARY_HISTORY = 1000
+
+_tracer = None
+
+
+class Span(object):
+    '''
+    A timed section of a hook execution.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.elapsed = None
+        self.forks = 0
+        self.children = []
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def total_forks(self):
+        return self.forks + sum(c.total_forks() for c in self.children)
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.time() - self.start
+        span = {
+            'name': self.name,
+            'ms': round(elapsed * 1000, 2),
+            'forks': self.total_forks(),
+        }
+        if self.children:
+            span['children'] = [c.as_dict() for c in self.children]
+        return span
+
+
+class Tracer(object):
+    '''
+    Collects the spans of one hook execution. Every thread nests its spans
+    below the span it is in, or below the root span for new threads.
+    '''
+
+    def __init__(self, name):
+        self.root = Span(name)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = [self.root]
+        return self._local.stack
+
+    def current(self):
+        return self._stack()[-1]
+
+    def push(self, name):
+        span = Span(name)
+        with self._lock:
+            self.current().children.append(span)
+        self._stack().append(span)
+        return span
+
+    def pop(self, span):
+        span.finish()
+        stack = self._stack()
+        if span in stack:
+            del stack[stack.index(span):]
+
+
+@contextmanager
+def span(name):
+    '''
+    Records the enclosed block as a span of the current hook trace.
+    '''
+    tracer = _tracer
+    if tracer is None:
+        yield None
+        return
+    current = tracer.push(name)
+    try:
+        yield current
+    finally:
+        tracer.pop(current)
+
+
+def traced(func):
+    '''
+    Decorator recording every call of func as a span.
+    '''
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument(module, names):
+    '''
+    Replaces the functions called names in module with traced versions.
+    '''
+    for name in names:
+        func = getattr(module, name, None)
+        if func is not None and not getattr(func, '_pg_traced', False):
+            wrapper = traced(func)
+            wrapper._pg_traced = True
+            setattr(module, name, wrapper)
+
+
+def _command_name(args):
+    if isinstance(args, basestring):
+        args = args.split()
+    args = [a for a in args if a != 'sudo'] or ['?']
+    return os.path.basename(args[0])
+
+
+def _counted(func):
+    '''
+    Wraps func, a function of the subprocess module, to record every
+    command it runs as a span of one fork.
+    '''
+    @wraps(func)
+    def wrapper(args, *a, **kw):
+        with span('exec:%s' % _command_name(args)) as current:
+            if current is not None:
+                current.forks = 1
+            return func(args, *a, **kw)
+    return wrapper
+
+
+class CountingSubprocess(object):
+    '''
+    Stands in for the subprocess module in the modules given to
+    count_forks(), recording the commands they run.
+    '''
+
+    def __init__(self):
+        for name in ['call', 'check_call', 'check_output', 'Popen']:
+            setattr(self, name, _counted(getattr(subprocess, name)))
+
+    def __getattr__(self, attr):
+        return getattr(subprocess, attr)
+
+
+def count_forks(modules):
+    '''
+    Records the commands modules run through their subprocess module in
+    the hook trace. Other modules, and subprocess itself, are left alone.
+    '''
+    counting = CountingSubprocess()
+    for module in modules:
+        if getattr(module, 'subprocess', None) is subprocess:
+            module.subprocess = counting
+
+
+def tracing_enabled():
+    '''
+    Returns True if the hook runs with PG_EDGE_TRACE set.
+    '''
+    return os.environ.get(TRACE_ENV, '') not in ('', '0')
+
+
+def charm_revision(charm_dir):
+    '''
+    Returns the revision of the charm deployed in charm_dir.
+    '''
+    for name in ['revision', 'version']:
+        try:
+            with open(os.path.join(charm_dir, name)) as revision:
+                return revision.read().strip()
+        except IOError:
+            continue
+    return 'unknown'
+
+
+def write_trace(trace_dir, trace, revision):
+    '''
+    Writes trace in trace_dir, drops the oldest traces beyond TRACE_HISTORY
+    and appends a one line summary to the rolling history.
+    '''
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(trace.start))
+    path = os.path.join(trace_dir, '%s-%06d-%s.json' % (
+        stamp, int((trace.start % 1) * 1e6), trace.name))
+    data = trace.as_dict()
+    data['revision'] = revision
+    data['time'] = trace.start
+    with open(path, 'w') as trace_file:
+        json.dump(data, trace_file, separators=(',', ':'))
+    traces = sorted(f for f in os.listdir(trace_dir) if f.endswith('.json'))
+    for old in traces[:-TRACE_HISTORY]:
+        os.unlink(os.path.join(trace_dir, old))
+
+    summary = {
+        'hook': trace.name,
+        'revision': revision,
+        'time': trace.start,
+        'ms': data['ms'],
+        'forks': data['forks'],
+        'spans': dict((c['name'], c['ms'])
+                      for c in data.get('children', [])),
+    }
+    history = os.path.join(trace_dir, HISTORY_FILE)
+    lines = []
+    if os.path.exists(history):
+        with open(history) as history_file:
+            lines = history_file.readlines()[-(SUMMARY_HISTORY - 1):]
+    lines.append(json.dumps(summary, sort_keys=True) + '\n')
+    with open(history + '.tmp', 'w') as history_file:
+        history_file.writelines(lines)
+    os.rename(history + '.tmp', history)
+    return path
+
+
+@contextmanager
+def trace_hook(name, charm_dir=None):
+    '''
+    Traces the enclosed hook execution and writes the trace under
+    charm_dir when it is done. Tracing never makes a hook fail.
+    '''
+    global _tracer
+    charm_dir = charm_dir or os.environ.get('CHARM_DIR')
+    _tracer = Tracer(name)
+    try:
+        yield _tracer
+    finally:
+        tracer, _tracer = _tracer, None
+        tracer.root.finish()
+        if charm_dir:
+            try:
+                write_trace(os.path.join(charm_dir, TRACE_DIR), tracer.root,
+                            charm_revision(charm_dir))
+            except (IOError, OSError) as e:
+                sys.stderr.write('Unable to write hook trace: %s\n' % e)
+
+
+def history_summary(trace_dir):
+    '''
+    Returns the mean duration and fork count of every hook per charm
+    revision recorded in the history of trace_dir.
+    '''
+    summary = {}
+    history = os.path.join(trace_dir, HISTORY_FILE)
+    if not os.path.exists(history):
+        return summary
+    with open(history) as history_file:
+        for line in history_file:
+            entry = json.loads(line)
+            stats = summary.setdefault(entry['revision'], {}).setdefault(
+                entry['hook'], {'runs': 0, 'ms': 0.0, 'forks': 0})
+            stats['runs'] += 1
+            stats['ms'] += entry['ms']
+            stats['forks'] += entry['forks']
+    for hooks in summary.values():
+        for stats in hooks.values():
+            stats['ms'] = round(stats['ms'] / stats['runs'], 2)
+            stats['forks'] = round(float(stats['forks']) / stats['runs'], 1)
+    return summary
+
+
+if __name__ == '__main__':
+    charm_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    trace_dir = os.path.join(sys.argv[1] if len(sys.argv) > 1 else charm_dir,
+                             TRACE_DIR)
+    print(json.dumps(history_summary(trace_dir), indent=2, sort_keys=True))
@@ -2,29 +2,32 @@
 
 # This file contains functions used by the hooks to deploy PLUMgrid Edge.
 
-import pg_edge_context
+import pg_edge_net
 import subprocess
 import time
 import os
 import json
+import re
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import six
 from collections import OrderedDict
+from contextlib import contextmanager
+from yaml import safe_load
 from socket import gethostname as get_unit_hostname
 from copy import deepcopy
-from charmhelpers.contrib.openstack.neutron import neutron_plugin_attribute
-from charmhelpers.contrib.storage.linux.ceph import modprobe
-from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import (
+    cached,
+    flush,
     log,
     config,
     unit_get,
-    status_set
-)
-from charmhelpers.contrib.network.ip import (
-    get_iface_from_addr,
-    get_host_ip,
-    get_iface_addr,
-    get_bridges,
-    get_bridge_nics,
+    status_set,
+    DEBUG,
+    ERROR,
 )
 from charmhelpers.core.host import (
     write_file,
@@ -32,18 +35,23 @@ from charmhelpers.core.host import (
     service_start,
     service_stop,
     service_running,
+    file_hash,
     path_hash,
-    set_nic_mtu
 )
 from charmhelpers.fetch import (
+    SourceConfigError,
+    _run_apt_command,
+    add_source,
     apt_cache,
-    apt_install
-)
-from charmhelpers.contrib.openstack.utils import (
-    os_release,
+    apt_install,
+    apt_update,
 )
+from pg_edge_tasks import kv
+from pg_edge_trace import traced
 
 SOURCES_LIST = '/etc/apt/sources.list'
+SOURCES_LIST_D = '/etc/apt/sources.list.d'
+PG_SOURCES_LIST = '%s/plumgrid.list' % SOURCES_LIST_D
 SHARED_SECRET = "/etc/nova/secret.txt"
 LXC_CONF = '/etc/libvirt/lxc.conf'
 TEMPLATES = 'templates/'
@@ -57,38 +65,116 @@ AUTH_KEY_PATH = '%s/root/.ssh/authorized_keys' % PG_LXC_DATA_PATH
 SUDOERS_CONF = '/etc/sudoers.d/ifc_ctl_sudoers'
 FILTERS_CONF_DIR = '/etc/nova/rootwrap.d'
 FILTERS_CONF = '%s/network.filters' % FILTERS_CONF_DIR
+PG_PID_FILE = '/var/run/libvirt/lxc/plumgrid.pid'
+NSENTER = '/opt/local/bin/nsenter'
+NSENTER_NAMESPACES = ['-m', '-n', '-u', '-i', '-p']
+SIGMUND_SERVICE = ['/usr/bin/service', 'plumgrid-sigmund']
+SIGMUND_CONFIGURE = '/usr/bin/sigmund-configure'
+IOVISOR_SYSFS_DIR = '/sys/module/iovisor'
+IOVISOR_MODULE = '/lib/modules/%s/updates/dkms/iovisor.ko'
+IOVISOR_MODULES_LOAD = '/etc/modules-load.d/iovisor.conf'
+IOVISOR_CACHE_DIR = '/var/cache/plumgrid-edge/iovisor'
+IOVISOR_KV_KEY = 'pg_edge.iovisor'
+# iovisor-dkms versions whose prebuilt modules are kept per kernel release
+IOVISOR_CACHE_VERSIONS = 2
+WAIT_KV_PREFIX = 'pg_edge.wait.'
+WAIT_INITIAL_DELAY = 0.1
+WAIT_MAX_DELAY = 2
+PG_START_TIMEOUT = 60
+PG_STOP_TIMEOUT = 30
+IOVISOR_UNLOAD_TIMEOUT = 10
+APT_LISTS_DIR = '/var/lib/apt/lists'
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_INDEX_KV_KEY = 'pg_edge.apt-index'
+INDEXED_PACKAGES = ['plumgrid-lxc', 'iovisor-dkms']
+DIRECTOR_KV_PREFIX = 'pg_edge.director.'
+FABRIC_INDEX_KV_KEY = 'pg_edge.fabric-index'
+FABRIC_LOOKUP_KV_KEY = 'pg_edge.fabric-interface'
+FABRIC_DEFAULT_KEY = 'DEFAULT'
+FABRIC_GROUPS_KEY = 'GROUPS'
+FABRIC_GROUP_PREFIX = '@'
+FABRIC_REGEX_PREFIX = 're:'
+SIGMUND_KV_KEY = 'pg_edge.sigmund'
+SIGMUND_RETRY_KV_KEY = 'pg_edge.sigmund-retry'
+PG_SOURCES_KV_KEY = 'pg_edge.apt-sources'
+# Seconds after which the PLUMgrid apt indexes are refreshed even if the
+# sources did not change
+PG_SOURCES_MAX_AGE = 6 * 60 * 60
+SOURCES_REFRESHED_CACHE_KEY = 'pg-edge-sources-refreshed'
+APT_ARCHIVES = '/var/cache/apt/archives'
 
 BASE_RESOURCE_MAP = OrderedDict([
     (PG_CONF, {
         'services': ['plumgrid'],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
     (PG_HN_CONF, {
         'services': ['plumgrid'],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
     (PG_HS_CONF, {
         'services': ['plumgrid'],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
     (OPS_CONF, {
         'services': ['plumgrid'],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
     (PG_IFCS_CONF, {
         'services': [],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
     (FILTERS_CONF, {
         'services': [],
-        'contexts': [pg_edge_context.PGEdgeContext()],
     }),
 ])
 
 
-def configure_pg_sources():
+class LazyConfigs(object):
+    '''
+    Stands in for the renderer returned by factory and only builds it on
+    first use, so that hooks which never render templates don't pay for
+    the OpenStack release lookup and the template machinery.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._configs = None
+
+    def __getattr__(self, name):
+        if self._configs is None:
+            self._configs = self._factory()
+        return getattr(self._configs, name)
+
+
+def write_file_atomic(path, content, perms=None):
     '''
-    Returns true if install sources is updated in sources.list file
+    Writes content to path through a temporary file in the same directory
+    which is renamed over path, so readers never see a partial file.
+    Existing ownership is kept, as are existing permissions unless perms is
+    given.
+    '''
+    if isinstance(content, six.text_type):
+        content = content.encode('utf-8')
+    try:
+        current = os.stat(path)
+    except OSError:
+        current = None
+    if perms is None:
+        perms = current.st_mode & 0o7777 if current else 0o644
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(content)
+        if current:
+            os.chown(tmp_path, current.st_uid, current.st_gid)
+        os.chmod(tmp_path, perms)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _remove_legacy_sources():
+    '''
+    Removes the PLUMgrid sources which earlier versions of the charm added
+    to /etc/apt/sources.list.
     '''
     try:
         with open(SOURCES_LIST, 'r+') as sources:
@@ -97,42 +183,188 @@ def configure_pg_sources():
             for i in (line for line in all_lines if "plumgrid" not in line):
                 sources.write(i)
             sources.truncate()
-        sources.close()
     except IOError:
         log('Unable to update /etc/apt/sources.list')
 
 
+def pg_sources():
+    '''
+    Returns the install_sources config paired with the install_keys config.
+    '''
+    sources = safe_load((config('install_sources') or '').strip()) or []
+    keys = safe_load((config('install_keys') or '').strip()) or None
+    if isinstance(sources, six.string_types):
+        sources = [sources]
+    if keys is None:
+        keys = [None] * len(sources)
+    elif isinstance(keys, six.string_types):
+        keys = [keys]
+    if len(sources) != len(keys):
+        raise SourceConfigError(
+            'Install sources and keys lists are different lengths')
+    return zip(sources, keys)
+
+
+def _pg_source_lines(sources):
+    '''
+    Returns the sources.list lines of the plain apt repositories among
+    sources.
+    '''
+    lines = []
+    for source, _ in sources:
+        if source and source.startswith('deb '):
+            lines.append(source)
+        elif source and source.startswith('http'):
+            lines.append('deb ' + source)
+    return lines
+
+
+def _pg_source_files(sources):
+    '''
+    Returns the apt source lists holding sources, or None if the list of a
+    source can not be told.
+    '''
+    files = [PG_SOURCES_LIST] if _pg_source_lines(sources) else []
+    lists = sorted(os.path.join(SOURCES_LIST_D, name)
+                   for name in os.listdir(SOURCES_LIST_D)
+                   if name.endswith('.list'))
+    for source, _ in sources:
+        if (not source or source == 'distro' or source.startswith('deb ') or
+                source.startswith('http')):
+            continue
+        if source.startswith('ppa:'):
+            pattern = 'ppa.launchpad.net/%s/' % source[len('ppa:'):]
+        elif source.startswith('cloud:'):
+            pattern = 'ubuntu-cloud.archive.canonical.com'
+        else:
+            return None
+        matches = []
+        for path in lists:
+            with open(path, 'r') as source_list:
+                if pattern in source_list.read():
+                    matches.append(path)
+        if not matches:
+            return None
+        files.extend(path for path in matches if path not in files)
+    return files
+
+
+@traced
+def configure_pg_sources(update=False, force=False):
+    '''
+    Configures the apt sources of install_sources and install_keys. Plain
+    repositories are kept in their own list, PPAs and cloud archive pockets
+    in the lists add-apt-repository manages. With update, refreshes the
+    indexes of these lists only, and unless force not at all if the sources
+    are unchanged and were refreshed less than PG_SOURCES_MAX_AGE ago.
+    Returns True if the indexes were refreshed.
+    '''
+    sources = pg_sources()
+    digest = hashlib.md5(json.dumps(sources, sort_keys=True)).hexdigest()
+    state = kv().get(PG_SOURCES_KV_KEY) or {}
+    if state.get('configured') != digest:
+        _remove_legacy_sources()
+        for source, key in sources:
+            if source is None or source.startswith('deb ') or \
+                    source.startswith('http'):
+                # 'distro' adds nothing but the key
+                add_source('distro', key)
+            else:
+                add_source(source, key)
+        write_file_atomic(PG_SOURCES_LIST, ''.join(
+            line + '\n' for line in _pg_source_lines(sources)), perms=0o644)
+        state['configured'] = digest
+        kv().set(PG_SOURCES_KV_KEY, state)
+        kv().flush()
+    if not update:
+        return False
+    if (not force and state.get('refreshed') == digest and
+            time.time() - state.get('time', 0) < PG_SOURCES_MAX_AGE):
+        log('PLUMgrid apt indexes are fresh, not refreshing', level=DEBUG)
+        return False
+    files = _pg_source_files(sources)
+    if files is None:
+        log('Refreshing all apt indexes')
+        apt_update(fatal=True)
+    for path in files or []:
+        log('Refreshing apt indexes of %s' % path)
+        _run_apt_command(['apt-get', 'update',
+                          '-o', 'Dir::Etc::sourcelist=%s' % path,
+                          '-o', 'Dir::Etc::sourceparts=-',
+                          '-o', 'APT::Get::List-Cleanup=0'], fatal=True)
+    state.update(refreshed=digest, time=time.time())
+    kv().set(PG_SOURCES_KV_KEY, state)
+    kv().flush()
+    return True
+
+
+@traced
 def configure_analyst_opsvm():
     '''
-    Configures Anaylyst for OPSVM
+    Configures Anaylyst for OPSVM. Returns True if plumgrid-sigmund points
+    at the current OPSVM, whether it was (re)configured or already did,
+    False if it could not be configured. plumgrid-sigmund runs in the
+    PLUMgrid container, so if PLUMgrid is not running a restart is
+    requested and the configuration is retried by update-status once
+    PLUMgrid runs.
     '''
+    import pg_edge_context
+    from pg_edge_restarts import request_restart
+    kv().unset(SIGMUND_RETRY_KV_KEY)
     if not service_running('plumgrid'):
-        restart_pg()
-    opsvm_ip = pg_edge_context._pg_dir_context()['opsvm_ip']
-    NS_ENTER = ('/opt/local/bin/nsenter -t $(ps ho pid --ppid $(cat'
-                '/var/run/libvirt/lxc/plumgrid.pid)) -m -n -u -i -p ')
-    sigmund_stop = NS_ENTER + '/usr/bin/service plumgrid-sigmund stop'
-    sigmund_status = NS_ENTER \
-        + '/usr/bin/service plumgrid-sigmund status'
-    sigmund_autoboot = NS_ENTER \
-        + '/usr/bin/sigmund-configure --ip {0} --start --autoboot' \
-        .format(opsvm_ip)
+        request_restart('restart', 'opsvm')
+        kv().set(SIGMUND_RETRY_KV_KEY, True)
+        kv().flush()
+        log('plumgrid-sigmund configuration deferred until PLUMgrid runs')
+        return False
+    opsvm_ip = str(pg_edge_context._pg_dir_context()['opsvm_ip'])
     try:
-        status = subprocess.check_output(sigmund_status, shell=True)
-        if 'start/running' in status:
-            if subprocess.call(sigmund_stop, shell=True):
-                log('plumgrid-sigmund couldn\'t be stopped!')
-                return
-        subprocess.check_call(sigmund_autoboot, shell=True)
-    except:
-        log('plumgrid-sigmund couldn\'t be started!')
+        init_pid = pg_container_init_pid()
+        status = container_exec(SIGMUND_SERVICE + ['status'])[1]
+        running = 'start/running' in status
+        applied = {'opsvm_ip': opsvm_ip, 'init_pid': init_pid}
+        if running and kv().get(SIGMUND_KV_KEY) == applied:
+            log('plumgrid-sigmund already configured for OPSVM %s' %
+                opsvm_ip, level=DEBUG)
+            return True
+        if running and container_exec(SIGMUND_SERVICE + ['stop'])[0]:
+            log('plumgrid-sigmund couldn\'t be stopped!')
+            return False
+        if container_exec([SIGMUND_CONFIGURE, '--ip', opsvm_ip, '--start',
+                           '--autoboot'])[0]:
+            log('plumgrid-sigmund couldn\'t be started!')
+            return False
+    except (OSError, ValueError) as e:
+        log('plumgrid-sigmund couldn\'t be started! %s' % e)
+        return False
+    kv().set(SIGMUND_KV_KEY, applied)
+    kv().flush()
+    return True
+
+
+def analyst_opsvm_retry():
+    '''
+    Returns True, once, if configuring plumgrid-sigmund was deferred until
+    PLUMgrid runs.
+    '''
+    if not kv().get(SIGMUND_RETRY_KV_KEY):
+        return False
+    kv().unset(SIGMUND_RETRY_KV_KEY)
+    kv().flush()
+    return True
 
 
+@traced
 def determine_packages():
     '''
     Returns list of packages required by PLUMgrid Edge as specified
-    in the neutron_plugins dictionary in charmhelpers.
+    in the neutron_plugins dictionary in charmhelpers. The PLUMgrid apt
+    indexes are refreshed, once per hook, if a pinned build is not in
+    them, as it may have been published since they were last refreshed.
     '''
+    from charmhelpers.contrib.openstack.neutron import (
+        neutron_plugin_attribute,
+    )
     pkgs = []
     tag = 'latest'
     for pkg in neutron_plugin_attribute('plumgrid', 'packages', 'neutron'):
@@ -144,8 +376,15 @@ def determine_packages():
         if tag == 'latest':
             pkgs.append(pkg)
         else:
-            if tag in [i.ver_str for i in apt_cache()[pkg].version_list]:
+            if tag in available_versions(pkg):
                 pkgs.append('%s=%s' % (pkg, tag))
+            elif not hookenv.cache.get(SOURCES_REFRESHED_CACHE_KEY):
+                hookenv.cache[SOURCES_REFRESHED_CACHE_KEY] = True
+                log("Build version '%s' for package '%s' not in the apt "
+                    "indexes, refreshing them" % (tag, pkg))
+                configure_pg_sources(update=True, force=True)
+                flush_apt_cache()
+                return determine_packages()
             else:
                 error_msg = \
                     "Build version '%s' for package '%s' not available" \
@@ -154,17 +393,121 @@ def determine_packages():
     return pkgs
 
 
+def install_packages():
+    '''
+    Installs the packages required by PLUMgrid Edge.
+    '''
+    status_set('maintenance', 'Installing apt packages')
+    with parallel_build():
+        apt_install(determine_packages(), options=['--force-yes'],
+                    fatal=True)
+    flush_apt_cache()
+
+
+@cached
+def pg_apt_cache():
+    '''
+    Returns an apt cache which is built lazily, at most once per hook
+    execution, and shared by every caller.
+    '''
+    return apt_cache()
+
+
+def flush_apt_cache():
+    '''
+    Drops the shared apt cache, to be called once package state changed.
+    '''
+    flush('pg_apt_cache')
+
+
+def _apt_index_key():
+    '''
+    Returns the mtimes identifying the current state of the apt indexes.
+    '''
+    mtimes = []
+    for path in [APT_LISTS_DIR, DPKG_STATUS]:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def available_versions(pkg):
+    '''
+    Returns the versions of pkg known to apt. Versions of the PLUMgrid
+    packages come from an index kept in unitdata which is only rebuilt,
+    from the shared apt cache, when the apt lists or dpkg status change.
+    '''
+    if pkg not in INDEXED_PACKAGES:
+        return [v.ver_str for v in pg_apt_cache()[pkg].version_list]
+    index_key = _apt_index_key()
+    index = kv().get(APT_INDEX_KV_KEY)
+    if not index or index['key'] != index_key:
+        versions = {}
+        cache = pg_apt_cache()
+        for indexed_pkg in INDEXED_PACKAGES:
+            try:
+                versions[indexed_pkg] = [
+                    v.ver_str for v in cache[indexed_pkg].version_list]
+            except KeyError:
+                versions[indexed_pkg] = []
+        index = {'key': index_key, 'versions': versions}
+        kv().set(APT_INDEX_KV_KEY, index)
+        kv().flush()
+    return index['versions'][pkg]
+
+
+@cached
+def openstack_release(package='nova-compute', base='kilo'):
+    '''
+    Returns the OpenStack release codename of package, or base if it can
+    not be determined. Same resolution as os_release() but the version is
+    read from dpkg instead of a full apt cache build.
+    '''
+    from charmhelpers.contrib.openstack.utils import (
+        OPENSTACK_CODENAMES,
+        PACKAGE_CODENAMES,
+    )
+    version = installed_version(package)
+    if not version:
+        return base
+    version = re.sub(r'^\d+:', '', version)
+    match = re.match(r'^(\d+)\.(\d+)', version)
+    if match:
+        version = match.group(0)
+    return (PACKAGE_CODENAMES.get(package, {}).get(version) or
+            OPENSTACK_CODENAMES.get(version) or base)
+
+
+def installed_version(pkg):
+    '''
+    Returns the installed version of pkg or None if it is not installed.
+    '''
+    try:
+        version = subprocess.check_output(
+            ['dpkg-query', '-W', '-f=${Status} ${Version}', pkg],
+            stderr=open(os.devnull, 'w'))
+    except subprocess.CalledProcessError:
+        return None
+    status = version.split()
+    if len(status) < 4 or status[2] != 'installed':
+        return None
+    return status[3]
+
+
 def register_configs(release=None):
     '''
     Returns an object of the Openstack Tempating Class which contains the
     the context required for all templates of this charm.
     '''
-    release = release or os_release('nova-compute', base='kilo')
+    from pg_edge_templating import PGConfigRenderer
+    release = release or openstack_release()
     if release < 'kilo':
         raise ValueError('OpenStack %s release not supported' % release)
 
-    configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
-                                          openstack_release=release)
+    configs = PGConfigRenderer(templates_dir=TEMPLATES,
+                               openstack_release=release)
     for cfg, rscs in resource_map().iteritems():
         configs.register(cfg, rscs['contexts'])
     return configs
@@ -175,7 +518,13 @@ def resource_map():
     Dynamically generate a map of resources that will be managed for a single
     hook execution.
     '''
+    from pg_edge_context import PGEdgeContext
+    # A single context generator is shared by every template so that the
+    # PLUMgrid context is only computed once per hook execution.
+    pg_edge_context = PGEdgeContext()
     resource_map = deepcopy(BASE_RESOURCE_MAP)
+    for rscs in resource_map.itervalues():
+        rscs['contexts'] = [pg_edge_context]
     return resource_map
 
 
@@ -184,14 +533,16 @@ def restart_map():
     Constructs a restart map based on charm config settings and relation
     state.
     '''
-    return {cfg: rscs['services'] for cfg, rscs in resource_map().iteritems()}
+    return OrderedDict((cfg, list(rscs['services']))
+                       for cfg, rscs in BASE_RESOURCE_MAP.iteritems())
 
 
+@traced
 def ensure_files():
     '''
     Ensures PLUMgrid specific files exist before templates are written.
     '''
-    release = os_release('nova-compute', base='kilo')
+    release = openstack_release()
     if release == 'kilo':
         disable_apparmor_libvirt()
     write_file(SUDOERS_CONF,
@@ -201,83 +552,430 @@ def ensure_files():
     _exec_cmd(cmd=['touch', FILTERS_CONF])
 
 
+@traced
 def restart_pg():
     '''
     Stops and Starts PLUMgrid service after flushing iptables.
     '''
     stop_pg()
+    start_pg()
+
+
+@traced
+def start_pg():
+    '''
+    Starts PLUMgrid service, bringing up libvirt first if it is not
+    running, as the container does not come up without it.
+    '''
+    if not service_running('libvirt-bin'):
+        log('libvirt-bin not running, starting it before plumgrid')
+        if not service_start('libvirt-bin'):
+            raise ValueError("libvirt-bin service couldn't be started")
     service_start('plumgrid')
-    time.sleep(3)
-    if not service_running('plumgrid'):
-        if service_running('libvirt-bin'):
-            raise ValueError("plumgrid service couldn't be started")
-        else:
-            if service_start('libvirt-bin'):
-                time.sleep(8)
-                if not service_running('plumgrid') \
-                        and not service_start('plumgrid'):
-                    raise ValueError("plumgrid service couldn't be started")
-            else:
-                raise ValueError("libvirt-bin service couldn't be started")
+    wait_for_pg(running=True)
     status_set('active', 'Unit is ready')
 
 
+@traced
 def stop_pg():
     '''
     Stops PLUMgrid service.
     '''
     service_stop('plumgrid')
-    time.sleep(2)
+    wait_for_pg(running=False, timeout=PG_STOP_TIMEOUT)
+
+
+def _deb_cached(pkg):
+    '''
+    Returns True if the deb of pkg, a name=version pin, is in the apt
+    archives or that version is installed already.
+    '''
+    name, version = pkg.split('=', 1)
+    if installed_version(name) == version:
+        return True
+    pattern = '%s_%s_*.deb' % (name, version.replace(':', '%3a'))
+    return any(fnmatch.fnmatch(deb, pattern)
+               for deb in os.listdir(APT_ARCHIVES))
+
+
+@traced
+def prefetch_pg():
+    '''
+    Refreshes the PLUMgrid sources and downloads the packages of an upgrade
+    while PLUMgrid keeps running. apt verifies the downloads against the
+    signed indexes; debs missing from the archives afterwards fail the
+    upgrade before the service is stopped. Returns the packages.
+    '''
+    status_set('maintenance', 'Downloading PLUMgrid packages')
+    configure_pg_sources(update=True)
+    packages = determine_packages()
+    apt_install(packages, options=['--force-yes', '--download-only'],
+                fatal=True)
+    missing = missing_debs(packages)
+    if missing:
+        raise ValueError('PLUMgrid packages were not downloaded: %s' %
+                         ', '.join(missing))
+    return packages
+
+
+def missing_debs(packages):
+    '''
+    Returns the name=version of the debs apt would install to install
+    packages, unpinned ones at their candidate version and the
+    dependencies they pull in included, which are not in the apt archives,
+    so that the install without downloads can't fail.
+    '''
+    output = subprocess.check_output(
+        ['apt-get', '--simulate', '--force-yes', 'install'] + packages)
+    installs = ['%s=%s' % match.groups() for match in (
+        re.match(r'^Inst (\S+) (?:\[\S+\] )?\((\S+) ', line)
+        for line in output.splitlines()) if match]
+    return [pkg for pkg in installs if not _deb_cached(pkg)]
+
+
+def _apt_changes(packages):
+    '''
+    Returns the names of the packages apt would install or remove to
+    install packages.
+    '''
+    output = subprocess.check_output(
+        ['apt-get', '--simulate', '--force-yes', 'install'] + packages)
+    return sorted(set(line.split()[1] for line in output.splitlines()
+                      if line.startswith('Inst ') or
+                      line.startswith('Remv ')))
+
+
+@traced
+def prebuild_iovisor(packages):
+    '''
+    Installs the iovisor-dkms of packages, building its kernel module,
+    while PLUMgrid keeps running on the loaded module, if that upgrades
+    nothing else. Returns True if iovisor-dkms changed.
+    '''
+    dkms = [pkg for pkg in packages if pkg.split('=')[0] == 'iovisor-dkms']
+    if not dkms:
+        return False
+    changes = _apt_changes(dkms)
+    if not changes:
+        return False
+    if changes != ['iovisor-dkms']:
+        log('iovisor-dkms upgrades %s too, building it while PLUMgrid is '
+            'stopped' % ', '.join(c for c in changes if c != 'iovisor-dkms'))
+        return False
+    status_set('maintenance', 'Building iovisor kernel module')
+    iovisor_version = installed_version('iovisor-dkms')
+    with parallel_build():
+        apt_install(dkms, options=['--force-yes', '--no-download'],
+                    fatal=True)
+    flush_apt_cache()
+    return installed_version('iovisor-dkms') != iovisor_version
+
+
+@traced
+def install_pg(packages):
+    '''
+    Installs the prefetched PLUMgrid packages. Returns True if iovisor-dkms
+    changed and its kernel module has to be reloaded.
+    '''
+    status_set('maintenance', 'Upgrading apt packages')
+    iovisor_version = installed_version('iovisor-dkms')
+    with parallel_build():
+        apt_install(packages, options=['--force-yes', '--no-download'],
+                    fatal=True)
+    flush_apt_cache()
+    return installed_version('iovisor-dkms') != iovisor_version
+
+
+def _makeflags():
+    '''
+    Returns the MAKEFLAGS which run builds on every core, unless MAKEFLAGS
+    are set already.
+    '''
+    from multiprocessing import cpu_count
+    return os.environ.get('MAKEFLAGS') or '-j%d' % cpu_count()
+
+
+@contextmanager
+def parallel_build():
+    '''
+    Runs the kernel module builds of the enclosed block, dkms run directly
+    or from package maintainer scripts, on every core.
+    '''
+    makeflags = os.environ.get('MAKEFLAGS')
+    os.environ['MAKEFLAGS'] = _makeflags()
+    try:
+        yield
+    finally:
+        if makeflags is None:
+            os.environ.pop('MAKEFLAGS', None)
+
+
+def _iovisor_cached_module(kernel, version):
+    return os.path.join(IOVISOR_CACHE_DIR, kernel, version, 'iovisor.ko')
+
+
+def _copy_atomic(src, dst):
+    '''
+    Copies src to dst so that dst is never seen half written.
+    '''
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst),
+                               prefix='.%s.' % os.path.basename(dst))
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def cache_iovisor_module(kernel, version):
+    '''
+    Stores the iovisor module installed for kernel as the prebuilt module
+    of iovisor-dkms version and drops the oldest versions cached for kernel
+    beyond IOVISOR_CACHE_VERSIONS.
+    '''
+    _copy_atomic(IOVISOR_MODULE % kernel,
+                 _iovisor_cached_module(kernel, version))
+    kernel_dir = os.path.join(IOVISOR_CACHE_DIR, kernel)
+    versions = sorted(os.listdir(kernel_dir), reverse=True, key=lambda v: (
+        os.path.getmtime(os.path.join(kernel_dir, v))))
+    for stale in versions[IOVISOR_CACHE_VERSIONS:]:
+        log('Dropping cached iovisor module %s for kernel %s' %
+            (stale, kernel), level=DEBUG)
+        shutil.rmtree(os.path.join(kernel_dir, stale), ignore_errors=True)
+
 
+@traced
+def install_iovisor_module(kernel, version):
+    '''
+    Makes sure the module of iovisor-dkms version is installed for kernel.
+    A prebuilt module from the module cache is installed if there is one,
+    otherwise dkms builds it. Modules which were built are added to the
+    cache. Returns where the module came from: 'installed' if it was in
+    place already, 'cache' or 'build'.
+    '''
+    module = IOVISOR_MODULE % kernel
+    cached_module = _iovisor_cached_module(kernel, version)
+    if os.path.exists(module):
+        if file_hash(module, 'sha256') == file_hash(cached_module, 'sha256'):
+            return 'installed'
+        # Built by the iovisor-dkms maintainer scripts
+        cache_iovisor_module(kernel, version)
+        return 'build'
+    if os.path.exists(cached_module):
+        log('Installing cached iovisor module %s for kernel %s' %
+            (version, kernel))
+        _copy_atomic(cached_module, module)
+        subprocess.check_call(['depmod', kernel])
+        return 'cache'
+    status_set('maintenance', 'Building iovisor kernel module')
+    with parallel_build():
+        subprocess.check_call(['dkms', 'autoinstall', '-k', kernel])
+    if not os.path.exists(module):
+        raise ValueError('dkms did not build iovisor %s for kernel %s' %
+                         (version, kernel))
+    cache_iovisor_module(kernel, version)
+    return 'build'
 
+
+@traced
 def load_iovisor():
     '''
-    Loads iovisor kernel module.
+    Loads iovisor kernel module, installing it for the running kernel
+    first if needed, and records where the loaded module came from.
     '''
-    modprobe('iovisor')
+    kernel = os.uname()[2]
+    version = installed_version('iovisor-dkms')
+    if version is None:
+        raise ValueError('iovisor-dkms is not installed')
+    source = install_iovisor_module(kernel, version)
+    subprocess.check_call(['modprobe', 'iovisor'])
+    if not os.path.exists(IOVISOR_MODULES_LOAD):
+        write_file(IOVISOR_MODULES_LOAD, 'iovisor\n', perms=0o644)
+    log('Loaded iovisor module %s for kernel %s from %s' %
+        (version, kernel, source))
+    kv().set(IOVISOR_KV_KEY, {
+        'time': time.time(),
+        'kernel': kernel,
+        'version': version,
+        'source': source,
+    })
+    kv().flush()
 
 
+@traced
 def remove_iovisor():
     '''
     Removes iovisor kernel module.
     '''
     _exec_cmd(cmd=['rmmod', 'iovisor'],
               error_msg='Error Removing IOVisor Kernel Module')
-    time.sleep(1)
+    wait_for(lambda: not iovisor_loaded(), 'iovisor-unloaded',
+             timeout=IOVISOR_UNLOAD_TIMEOUT, fatal=False)
 
 
-def interface_exists(interface):
+def pg_container_running():
     '''
-    Checks if interface exists on node.
+    Returns True if the libvirt LXC pid file of the plumgrid container
+    points at a live process.
     '''
     try:
-        subprocess.check_call(['ip', 'link', 'show', interface],
-                              stdout=open(os.devnull, 'w'),
-                              stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+        with open(PG_PID_FILE, 'r') as pid_file:
+            os.kill(int(pid_file.read().strip()), 0)
+    except (IOError, OSError, ValueError):
         return False
     return True
 
 
+def _proc_children(pid):
+    '''
+    Returns the pids of the child processes of pid.
+    '''
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid), 'r') as children:
+            pids = [int(child) for child in children.read().split()]
+        if pids:
+            return pids
+    except IOError:
+        pass
+    # Kernels without CONFIG_PROC_CHILDREN, or children forked by another
+    # thread of pid
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry, 'r') as stat:
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def pg_container_init_pid():
+    '''
+    Returns the pid of the init process of the plumgrid container, the
+    child of the libvirt LXC process, or None if the container is not
+    running. It is resolved once per hook for every start of the container.
+    '''
+    try:
+        with open(PG_PID_FILE, 'r') as pid_file:
+            lxc_pid = int(pid_file.read().strip())
+    except (IOError, ValueError):
+        return None
+    cache_key = 'pg-edge-container-init:%d' % lxc_pid
+    init_pid = hookenv.cache.get(cache_key)
+    if init_pid is None or not os.path.isdir('/proc/%d' % init_pid):
+        children = _proc_children(lxc_pid)
+        if not children:
+            return None
+        init_pid = hookenv.cache[cache_key] = children[0]
+    return init_pid
+
+
+@traced
+def container_exec(cmd):
+    '''
+    Runs cmd, an argument list, in the namespaces of the plumgrid container
+    and returns its exit status and output. Raises ValueError if the
+    container is not running.
+    '''
+    init_pid = pg_container_init_pid()
+    if init_pid is None:
+        raise ValueError('plumgrid container is not running')
+    proc = subprocess.Popen(
+        [NSENTER, '-t', str(init_pid)] + NSENTER_NAMESPACES + list(cmd),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+
+def iovisor_loaded():
+    '''
+    Returns True if the iovisor kernel module is loaded.
+    '''
+    return os.path.isdir(IOVISOR_SYSFS_DIR)
+
+
+def wait_for_pg(running=True, timeout=PG_START_TIMEOUT):
+    '''
+    Waits until the plumgrid container is running, or stopped if running
+    is False.
+    '''
+    if running:
+        return wait_for(pg_container_running, 'plumgrid-running',
+                        timeout=timeout)
+    return wait_for(lambda: not pg_container_running(), 'plumgrid-stopped',
+                    timeout=timeout)
+
+
+@traced
+def wait_for(condition, name, timeout=PG_START_TIMEOUT, fatal=True):
+    '''
+    Polls condition with bounded exponential backoff until it returns True
+    and returns the number of seconds waited. The duration of every wait is
+    logged and recorded in unitdata under name. On timeout a ValueError is
+    raised, or None returned if fatal is False.
+    '''
+    start = time.time()
+    delay = WAIT_INITIAL_DELAY
+    while not condition():
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            _record_wait(name, elapsed, False)
+            error_msg = 'Timed out after %.1fs waiting for %s' % (elapsed,
+                                                                  name)
+            if fatal:
+                raise ValueError(error_msg)
+            log(error_msg, level=ERROR)
+            return None
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, WAIT_MAX_DELAY)
+    elapsed = time.time() - start
+    _record_wait(name, elapsed, True)
+    return elapsed
+
+
+def _record_wait(name, elapsed, success):
+    '''
+    Logs and stores in unitdata how long a wait took.
+    '''
+    log('Waited %.2fs for %s%s' % (elapsed, name,
+                                   '' if success else ' (timed out)'),
+        level=DEBUG)
+    kv().set(WAIT_KV_PREFIX + name, {'elapsed': round(elapsed, 3),
+                                     'success': success})
+    kv().flush()
+
+
+def interface_exists(interface):
+    '''
+    Checks if interface exists on node.
+    '''
+    return pg_edge_net.interface_exists(interface)
+
+
 def get_mgmt_interface():
     '''
     Returns the managment interface.
     '''
     mgmt_interface = config('mgmt-interface')
-    if not mgmt_interface:
-        try:
-            return get_iface_from_addr(unit_get('private-address'))
-        except:
-            for bridge_interface in get_bridges():
-                if (get_host_ip(unit_get('private-address'))
-                        in get_iface_addr(bridge_interface)):
-                    return bridge_interface
-    elif interface_exists(mgmt_interface):
-        return mgmt_interface
-    else:
+    if mgmt_interface:
+        if interface_exists(mgmt_interface):
+            return mgmt_interface
         log('Provided managment interface %s does not exist'
             % mgmt_interface)
-        return get_iface_from_addr(unit_get('private-address'))
+    address = unit_get('private-address')
+    interface = pg_edge_net.interface_for_address(address)
+    if interface is None:
+        from charmhelpers.contrib.network.ip import get_host_ip
+        interface = pg_edge_net.interface_for_address(get_host_ip(address))
+    return interface
 
 
 def fabric_interface_changed():
@@ -303,40 +1001,163 @@ def get_fabric_interface():
     fabric_interfaces = config('fabric-interfaces')
     if fabric_interfaces == 'MANAGEMENT':
         return get_mgmt_interface()
+    node_fabric_interface = lookup_fabric_interface(fabric_interfaces,
+                                                    get_unit_hostname())
+    if node_fabric_interface is None:
+        raise ValueError('No fabric interface provided for node')
+    if interface_exists(node_fabric_interface):
+        return node_fabric_interface
     else:
-        try:
-            all_fabric_interfaces = json.loads(fabric_interfaces)
-        except ValueError:
-            raise ValueError('Invalid json provided for fabric interfaces')
-        hostname = get_unit_hostname()
-        if hostname in all_fabric_interfaces:
-            node_fabric_interface = all_fabric_interfaces[hostname]
-        elif 'DEFAULT' in all_fabric_interfaces:
-            node_fabric_interface = all_fabric_interfaces['DEFAULT']
-        else:
-            raise ValueError('No fabric interface provided for node')
-        if interface_exists(node_fabric_interface):
-            return node_fabric_interface
+        log('Provided fabric interface %s does not exist'
+            % node_fabric_interface)
+        raise ValueError('Provided fabric interface does not exist')
+
+
+def _fabric_digest(fabric_interfaces):
+    if isinstance(fabric_interfaces, six.text_type):
+        fabric_interfaces = fabric_interfaces.encode('utf-8')
+    return hashlib.md5(fabric_interfaces).hexdigest()
+
+
+def compile_fabric_interfaces(fabric_interfaces):
+    '''
+    Parses and validates a fabric-interfaces map and returns its index.
+    Keys of the map are hostnames, hostname globs, regular expressions
+    prefixed with 're:', '@group' for the hosts listed under group in the
+    GROUPS entry, or DEFAULT. Raises ValueError if the map is invalid.
+    '''
+    try:
+        rules = json.loads(fabric_interfaces, object_pairs_hook=OrderedDict)
+    except ValueError:
+        raise ValueError('Invalid json provided for fabric interfaces')
+    if not isinstance(rules, dict):
+        raise ValueError('Invalid json provided for fabric interfaces')
+    groups = rules.pop(FABRIC_GROUPS_KEY, {})
+    if (not isinstance(groups, dict) or
+            not all(isinstance(m, list) for m in groups.values())):
+        raise ValueError('Fabric interfaces GROUPS must map group names to '
+                         'lists of hosts')
+    for group, members in groups.items():
+        for member in members:
+            if not isinstance(member, six.string_types) or not member:
+                raise ValueError('Invalid host %s in fabric interfaces group '
+                                 '%s' % (json.dumps(member), group))
+    index = {
+        'digest': _fabric_digest(fabric_interfaces),
+        'hosts': {},
+        'group_hosts': {},
+        'patterns': [],
+        'default': None,
+    }
+    for key, interface in rules.items():
+        if not isinstance(interface, six.string_types) or not interface:
+            raise ValueError('Invalid fabric interface provided for %s' % key)
+        if key == FABRIC_DEFAULT_KEY:
+            index['default'] = interface
+        elif key.startswith(FABRIC_GROUP_PREFIX):
+            group = key[len(FABRIC_GROUP_PREFIX):]
+            if group not in groups:
+                raise ValueError('Unknown fabric interfaces group %s' % group)
+            for member in groups[group]:
+                _add_fabric_rule(index, member, interface, 'group_hosts')
         else:
-            log('Provided fabric interface %s does not exist'
-                % node_fabric_interface)
-            raise ValueError('Provided fabric interface does not exist')
-        return node_fabric_interface
+            _add_fabric_rule(index, key, interface, 'hosts')
+    return index
 
 
+def _add_fabric_rule(index, key, interface, hosts):
+    '''
+    Adds the rule mapping key to interface to index. Exact hostnames go to
+    the hosts table of index, patterns are kept in map order.
+    '''
+    if key.startswith(FABRIC_REGEX_PREFIX):
+        pattern = '(?:%s)\\Z' % key[len(FABRIC_REGEX_PREFIX):]
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError('Invalid fabric interfaces regex %s: %s'
+                             % (key, e))
+        index['patterns'].append([pattern, interface])
+    elif any(c in key for c in '*?['):
+        index['patterns'].append([fnmatch.translate(key), interface])
+    else:
+        index[hosts].setdefault(key, interface)
+
+
+def fabric_index(fabric_interfaces):
+    '''
+    Returns the compiled index of fabric_interfaces. It is only compiled
+    when the map changed, and then kept in unitdata.
+    '''
+    index = kv().get(FABRIC_INDEX_KV_KEY)
+    if not index or index['digest'] != _fabric_digest(fabric_interfaces):
+        index = compile_fabric_interfaces(fabric_interfaces)
+        kv().set(FABRIC_INDEX_KV_KEY, index)
+        kv().unset(FABRIC_LOOKUP_KV_KEY)
+        kv().flush()
+    return index
+
+
+def fabric_interface_for(index, hostname):
+    '''
+    Returns the interface index maps hostname to, or None. Hostnames win
+    over groups, groups over patterns and patterns over DEFAULT.
+    '''
+    for hosts in ['hosts', 'group_hosts']:
+        if hostname in index[hosts]:
+            return index[hosts][hostname]
+    for pattern, interface in index['patterns']:
+        if re.match(pattern, hostname):
+            return interface
+    return index['default']
+
+
+def lookup_fabric_interface(fabric_interfaces, hostname):
+    '''
+    Returns the fabric interface of hostname in fabric_interfaces, or None.
+    The answer is remembered in unitdata until the map changes so that
+    the map is neither parsed nor scanned again on later hooks.
+    '''
+    digest = _fabric_digest(fabric_interfaces)
+    cache_key = 'pg-edge-fabric:%s:%s' % (digest, hostname)
+    if cache_key in hookenv.cache:
+        return hookenv.cache[cache_key]
+    lookup = kv().get(FABRIC_LOOKUP_KV_KEY)
+    if (lookup and lookup['digest'] == digest and
+            lookup['hostname'] == hostname):
+        interface = lookup['interface']
+    else:
+        interface = fabric_interface_for(fabric_index(fabric_interfaces),
+                                         hostname)
+        kv().set(FABRIC_LOOKUP_KV_KEY, {'digest': digest,
+                                        'hostname': hostname,
+                                        'interface': interface})
+        kv().flush()
+    hookenv.cache[cache_key] = interface
+    return interface
+
+
+@traced
 def ensure_mtu():
     '''
-    Ensures required MTU of the underlying networking of the node.
+    Ensures required MTU of the underlying networking of the node, setting
+    it on the bridge members before the fabric interface and only where it
+    differs. Returns the list of (interface, previous MTU, MTU) changed.
     '''
     interface_mtu = config('network-device-mtu')
     fabric_interface = get_fabric_interface()
-    if fabric_interface in get_bridges():
-        attached_interfaces = get_bridge_nics(fabric_interface)
-        for interface in attached_interfaces:
-            set_nic_mtu(interface, interface_mtu)
-    set_nic_mtu(fabric_interface, interface_mtu)
+    changes = pg_edge_net.reconcile_mtu(
+        [pg_edge_net.bridge_members(fabric_interface), [fabric_interface]],
+        interface_mtu)
+    for interface, previous, mtu in changes:
+        log('Changed MTU of %s from %s to %s' % (interface, previous, mtu))
+    if not changes:
+        log('MTU of %s already set to %s' % (fabric_interface, interface_mtu),
+            level=DEBUG)
+    return changes
 
 
+@traced
 def _exec_cmd(cmd=None, error_msg='Command exited with ERRORs', fatal=False,
               verbose=False):
     '''
@@ -392,50 +1213,26 @@ def disable_apparmor():
     f.close()
 
 
+@traced
 def add_lcm_key():
     '''
-    Adds public key of PLUMgrid-lcm to authorized keys of PLUMgrid Edge.
+    Makes the LCM keys of the lcm-ssh-key config the keys authorized by the
+    charm in the PLUMgrid container. Returns the number of keys added or
+    removed.
     '''
-    key = config('lcm-ssh-key')
-    if key == 'null':
-        log('lcm key not specified')
-        return 0
-    file_write_type = 'w+'
-    if os.path.isfile(AUTH_KEY_PATH):
-        file_write_type = 'a'
-        try:
-            fr = open(AUTH_KEY_PATH, 'r')
-        except IOError:
-            log('plumgrid-lxc not installed yet')
-            return 0
-        for line in fr:
-            if key in line:
-                log('key already added')
-                return 0
-    try:
-        fa = open(AUTH_KEY_PATH, file_write_type)
-    except IOError:
-        log('Error opening file to append')
-        return 0
-    fa.write(key)
-    fa.write('\n')
-    fa.close()
-    return 1
+    import pg_edge_lcm
+    return pg_edge_lcm.authorize_keys(AUTH_KEY_PATH)
 
 
+@traced
 def load_iptables():
     '''
     Loads iptables rules to allow all PLUMgrid communication.
     '''
+    import pg_edge_iptables
     network = get_cidr_from_iface(get_mgmt_interface())
     if network:
-        _exec_cmd(['sudo', 'iptables', '-A', 'INPUT', '-p', 'tcp',
-                   '-j', 'ACCEPT', '-s', network, '-d',
-                   network, '-m', 'state', '--state', 'NEW'])
-        _exec_cmd(['sudo', 'iptables', '-A', 'INPUT', '-p', 'udp', '-j',
-                   'ACCEPT', '-s', network, '-d', network,
-                   '-m', 'state', '--state', 'NEW'])
-        apt_install('iptables-persistent')
+        pg_edge_iptables.load_rules(network)
 
 
 def get_cidr_from_iface(interface):
@@ -444,46 +1241,66 @@ def get_cidr_from_iface(interface):
     '''
     if not interface:
         return None
-    apt_install('ohai')
-    try:
-        os_info = subprocess.check_output(['ohai', '-l', 'fatal'])
-    except OSError:
-        log('Unable to get operating system information')
-        return None
-    try:
-        os_info_json = json.loads(os_info)
-    except ValueError:
-        log('Unable to determine network')
-        return None
-    device = os_info_json['network']['interfaces'].get(interface)
-    if device is not None:
-        if device.get('routes'):
-            routes = device['routes']
-            for net in routes:
-                if 'scope' in net:
-                    return net.get('destination')
-        else:
-            return None
-    else:
-        return None
+    return pg_edge_net.connected_network(interface)
 
 
 def director_cluster_ready():
+    import pg_edge_context
     dirs_count = len(pg_edge_context._pg_dir_context()['director_ips'])
     return True if dirs_count == 1 or dirs_count == 3 else False
 
 
+def _director_state():
+    '''
+    Returns the part of the director relation data the edge depends on.
+    '''
+    import pg_edge_context
+    pg_dir_context = pg_edge_context._pg_dir_context()
+    return {
+        'director_ips': sorted(pg_dir_context['director_ips']),
+        'opsvm_ip': pg_dir_context['opsvm_ip'],
+    }
+
+
+def director_state_delta():
+    '''
+    Returns the director relation keys which changed since the state was
+    last recorded by commit_director_state(), an empty DeltaSet if nothing
+    changed.
+    '''
+    return kv().delta(_director_state(), DIRECTOR_KV_PREFIX)
+
+
+def commit_director_state(skip=()):
+    '''
+    Records the current director relation data as processed, except for
+    the keys in skip, which director_state_delta() keeps reporting as
+    changed so that the next hook processes them again.
+    '''
+    state = _director_state()
+    for key in skip:
+        del state[key]
+    kv().update(state, prefix=DIRECTOR_KV_PREFIX)
+    kv().flush()
+
+
 def restart_on_change(restart_map):
     """
-    Restart services based on configuration files changing
+    Restart services based on configuration files changing. restart_map
+    may be a callable, which is then only evaluated when the hook runs.
     """
+    from pg_edge_restarts import request_restart
+
     def wrap(f):
         def wrapped_f(*args, **kwargs):
-            checksums = {path: path_hash(path) for path in restart_map}
+            _restart_map = restart_map
+            if callable(_restart_map):
+                _restart_map = _restart_map()
+            checksums = {path: path_hash(path) for path in _restart_map}
             f(*args, **kwargs)
-            for path in restart_map:
+            for path in _restart_map:
                 if path_hash(path) != checksums[path]:
-                    restart_pg()
+                    request_restart('restart', path)
                     break
         return wrapped_f
     return wrap
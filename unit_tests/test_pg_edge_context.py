@@ -1,10 +1,13 @@
+import os
 from test_utils import CharmTestCase
 from mock import patch
 import pg_edge_context as context
 import pg_edge_utils as utils
 import charmhelpers
+from charmhelpers.core import hookenv
 
 TO_PATCH = [
+    'config',
     'gethostname',
     'getfqdn'
 ]
@@ -22,6 +25,8 @@ class PGEdgeContextTest(CharmTestCase):
 
     def setUp(self):
         super(PGEdgeContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        charmhelpers.core.hookenv.cache = {}
 
     def tearDown(self):
         super(PGEdgeContextTest, self).tearDown()
@@ -91,3 +96,71 @@ class PGEdgeContextTest(CharmTestCase):
             'opsvm_ip': '127.0.0.1',
         }
         self.assertEquals(expect, napi_ctxt())
+
+    @patch.object(context.PGEdgeContext, 'pg_ctxt')
+    @patch.object(charmhelpers.contrib.openstack.context, 'config')
+    @patch.object(charmhelpers.contrib.openstack.context, 'is_clustered')
+    @patch.object(charmhelpers.contrib.openstack.context, 'https')
+    @patch.object(charmhelpers.contrib.openstack.context, 'unit_get')
+    @patch.dict(os.environ, {'JUJU_UNIT_NAME': 'plumgrid-edge/0'})
+    def test_context_memoized_per_hook(self, _unit_get, _https, _is_clus,
+                                       _config, _pg_ctxt):
+        _unit_get.return_value = '192.168.100.203'
+        _https.return_value = False
+        _is_clus.return_value = False
+        _config.return_value = None
+        _pg_ctxt.return_value = {'pg_hostname': 'node0'}
+        first = context.PGEdgeContext()
+        second = context.PGEdgeContext()
+        self.assertEquals(first(), second())
+        self.assertEquals(first()['pg_hostname'], 'node0')
+        self.assertEquals(_pg_ctxt.call_count, 1)
+        # relation_set() flushes the hookenv cache for the local unit
+        with patch.object(hookenv.subprocess, 'check_output') as _output, \
+                patch.object(hookenv.subprocess, 'check_call'):
+            _output.return_value = ''
+            hookenv.relation_set(relation_settings={'pg-edge': 'ready'})
+        first()
+        self.assertEquals(_pg_ctxt.call_count, 2)
+        # config changes within the hook invalidate the memoized context
+        self.test_config.set('network-device-mtu', '9000')
+        first()
+        self.assertEquals(_pg_ctxt.call_count, 3)
+
+    @patch.object(context, 'log')
+    @patch.object(context.subprocess, 'check_output')
+    def test_pg_dir_context_bulk_loaded(self, _check_output, _log):
+        _check_output.return_value = '\n'.join([
+            'rid plumgrid:3',
+            'unit plumgrid-director/0',
+            'data {"private-address": "10.0.0.1"}',
+            'unit plumgrid-director/1',
+            'data {"private-address": "10.0.0.2", "opsvm_ip": "10.0.0.9"}',
+            'unit plumgrid-director/2',
+            'data {"private-address": "10.0.0.3"}',
+        ])
+        self.assertEqual(context._pg_dir_context(), {
+            'director_ips': ['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+            'opsvm_ip': '10.0.0.9'})
+        self.assertEqual(context.load_relations('plumgrid'),
+                         {'python_spawns': 1, 'python_spawns_avoided': 4,
+                          'tool_calls': 5})
+        self.assertEqual(_check_output.call_count, 1)
+        self.assertEqual(
+            charmhelpers.core.hookenv.related_units('plumgrid:3'),
+            ['plumgrid-director/0', 'plumgrid-director/1',
+             'plumgrid-director/2'])
+
+    @patch.object(context, 'log')
+    @patch.object(context.subprocess, 'check_output')
+    def test_load_relations_bad_data(self, _check_output, _log):
+        _check_output.return_value = '\n'.join([
+            'rid plumgrid:3',
+            'unit plumgrid-director/0',
+            'data {"private-address": "10.0.0.1"}',
+            'unit plumgrid-director/1',
+            'data {"private-address": ',
+        ])
+        self.assertIsNone(context.load_relations('plumgrid'))
+        # nothing is cached, relation data is read with a fork per call
+        self.assertEqual(charmhelpers.core.hookenv.cache, {})
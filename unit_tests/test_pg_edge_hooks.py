@@ -1,5 +1,8 @@
-from mock import MagicMock, patch, call
+import threading
+from mock import MagicMock, call, patch
 from test_utils import CharmTestCase
+from charmhelpers.core import unitdata
+from charmhelpers.core.unitdata import Storage
 with patch('charmhelpers.core.hookenv.config') as config:
     config.return_value = 'neutron'
     import pg_edge_utils as utils
@@ -11,30 +14,36 @@ utils.register_configs = MagicMock()
 utils.restart_map = MagicMock()
 
 import pg_edge_hooks as hooks
+import pg_edge_tasks as tasks
 
 utils.register_configs = _reg
 utils.restart_map = _map
 
 TO_PATCH = [
-    'remove_iovisor',
-    'apt_install',
     'CONFIGS',
     'log',
-    'configure_sources',
+    'configure_pg_sources',
     'ensure_files',
     'stop_pg',
-    'restart_pg',
     'load_iovisor',
     'ensure_mtu',
     'add_lcm_key',
-    'determine_packages',
+    'cancel_restarts',
     'config',
     'relation_set',
     'relation_ids',
     'load_iptables',
     'director_cluster_ready',
     'status_set',
-    'configure_analyst_opsvm'
+    'configure_analyst_opsvm',
+    'analyst_opsvm_retry',
+    'service_running',
+    'fabric_interface_changed',
+    'director_state_delta',
+    'commit_director_state',
+    'install_packages',
+    'request_restart',
+    'update_slots',
 ]
 NEUTRON_CONF_DIR = "/etc/neutron"
 
@@ -52,19 +61,52 @@ class PGEdgeHooksTests(CharmTestCase):
         hooks.hooks.execute([
             'hooks/{}'.format(hookname)])
 
-    def test_install_hook(self):
-        _pkgs = ['plumgrid-lxc', 'iovisor-dkms']
-        self.determine_packages.return_value = [_pkgs]
+    @patch.object(tasks, 'log')
+    @patch.object(unitdata, '_KV', Storage(':memory:'))
+    def test_install_hook(self, _log):
+        started = dict((name, threading.Event())
+                       for name in ['iptables', 'mtu'])
+
+        def step(name, other):
+            def run():
+                started[name].set()
+                # only returns if both steps run at the same time
+                self.assertTrue(started[other].wait(5))
+                tasks.kv().set(name, 'done')
+            return run
+
+        self.load_iptables.side_effect = step('iptables', 'mtu')
+        self.ensure_mtu.side_effect = step('mtu', 'iptables')
         self._call_hook('install')
-        self.configure_sources.assert_called_with(update=True)
-        self.apt_install.assert_has_calls([
-            call(_pkgs, fatal=True,
-                 options=['--force-yes']),
-        ])
+        self.load_iptables.assert_called_with()
+        self.configure_pg_sources.assert_called_with(update=True)
+        self.install_packages.assert_called_with()
         self.load_iovisor.assert_called_with()
         self.ensure_mtu.assert_called_with()
         self.ensure_files.assert_called_with()
         self.add_lcm_key.assert_called_with()
+        self.assertEqual(unitdata.kv().get('iptables'), 'done')
+        self.assertEqual(unitdata.kv().get('mtu'), 'done')
+
+    def _changed_config(self, *keys):
+        charm_config = MagicMock()
+        charm_config.changed.side_effect = lambda key: key in keys
+        self.config.side_effect = None
+        self.config.return_value = charm_config
+
+    def test_config_changed_upgrade(self):
+        self._changed_config('iovisor-build')
+        self.service_running.return_value = True
+        self._call_hook('config-changed')
+        self.assertEqual(self.request_restart.call_args_list, [
+            call('upgrade', 'package upgrade'), call('start')])
+        self.CONFIGS.write_all.assert_called_with()
+
+    def test_config_changed_unchanged(self):
+        self._changed_config()
+        self._call_hook('config-changed')
+        self.request_restart.assert_called_once_with('start')
+        self.assertFalse(self.add_lcm_key.called)
 
     def test_plumgrid_changed(self):
         self._call_hook('plumgrid-relation-changed')
@@ -72,6 +114,45 @@ class PGEdgeHooksTests(CharmTestCase):
         self.ensure_mtu.assert_called_with()
         self.CONFIGS.write_all.assert_called_with()
 
+    def test_plumgrid_changed_opsvm(self):
+        self.director_state_delta.return_value = {'opsvm_ip': 'changed'}
+        self.director_cluster_ready.return_value = True
+        self.configure_analyst_opsvm.return_value = True
+        self._call_hook('plumgrid-relation-changed')
+        self.configure_analyst_opsvm.assert_called_with()
+        self.CONFIGS.write_all.assert_called_with()
+        self.commit_director_state.assert_called_with(skip=[])
+
+    def test_plumgrid_changed_opsvm_failed(self):
+        self.director_state_delta.return_value = {'opsvm_ip': 'changed'}
+        self.director_cluster_ready.return_value = True
+        self.configure_analyst_opsvm.return_value = False
+        self._call_hook('plumgrid-relation-changed')
+        self.CONFIGS.write_all.assert_called_with()
+        self.commit_director_state.assert_called_with(skip=['opsvm_ip'])
+
+    def test_update_status_opsvm_retry(self):
+        self.service_running.return_value = True
+        self.analyst_opsvm_retry.return_value = False
+        self._call_hook('update-status')
+        self.assertFalse(self.director_state_delta.called)
+        self.status_set.assert_called_with('active', 'Unit is ready')
+        self.analyst_opsvm_retry.return_value = True
+        self.director_state_delta.return_value = {'opsvm_ip': 'changed'}
+        self.director_cluster_ready.return_value = True
+        self.configure_analyst_opsvm.return_value = True
+        self._call_hook('update-status')
+        self.configure_analyst_opsvm.assert_called_with()
+        self.commit_director_state.assert_called_with(skip=[])
+
+    def test_plumgrid_changed_unchanged(self):
+        self.director_state_delta.return_value = {}
+        self._call_hook('plumgrid-relation-changed')
+        self.assertFalse(self.ensure_mtu.called)
+        self.assertFalse(self.configure_analyst_opsvm.called)
+        self.assertFalse(self.CONFIGS.write_all.called)
+        self.assertFalse(self.commit_director_state.called)
+
     def test_neutron_plugin_joined(self):
         self.test_config.set('metadata-shared-key', 'plumgrid')
         self._call_hook('neutron-plugin-relation-joined')
@@ -83,6 +164,13 @@ class PGEdgeHooksTests(CharmTestCase):
             **rel_data
         )
 
+    def test_rolling_restart_changed(self):
+        for hook in ['edge-peers-relation-changed', 'leader-elected',
+                     'leader-settings-changed']:
+            self._call_hook(hook)
+        self.assertEqual(self.update_slots.call_count, 3)
+
     def test_stop(self):
         self._call_hook('stop')
+        self.cancel_restarts.assert_called_with()
         self.stop_pg.assert_called_with()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from mock import patch
+from test_utils import CharmTestCase
+
+import pg_edge_iptables as iptables
+from pg_edge_utils import write_file_atomic
+
+TO_PATCH = [
+    'log',
+    'apt_install',
+]
+
+
+class TestPGEdgeIptables(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeIptables, self).setUp(iptables, TO_PATCH)
+
+    @patch.object(iptables, 'persist_iptables')
+    @patch.object(iptables.subprocess, 'Popen')
+    @patch.object(iptables, 'iptables_input_rules')
+    @patch.object(iptables, 'kv')
+    def test_load_rules(self, _kv, _rules, _popen, _persist):
+        _kv().get.return_value = [
+            '-A INPUT -s 10.9.0.0/24 -d 10.9.0.0/24 -p udp -m state '
+            '--state NEW -j ACCEPT']
+        _rules.return_value = [
+            '-A INPUT -s 10.0.0.0/24 -d 10.0.0.0/24 -p tcp -m state '
+            '--state NEW -j ACCEPT',
+            '-A INPUT -s 10.9.0.0/24 -d 10.9.0.0/24 -p udp -m state '
+            '--state NEW -j ACCEPT']
+        _popen.return_value.returncode = 0
+        iptables.load_rules('10.0.0.0/24')
+        _popen.assert_called_once_with(['iptables-restore', '--noflush'],
+                                       stdin=iptables.subprocess.PIPE)
+        _popen.return_value.communicate.assert_called_once_with(
+            '*filter\n'
+            '-D INPUT -s 10.9.0.0/24 -d 10.9.0.0/24 -p udp -m state '
+            '--state NEW -j ACCEPT\n'
+            '-A INPUT -s 10.0.0.0/24 -d 10.0.0.0/24 -p udp -m state '
+            '--state NEW -j ACCEPT\n'
+            'COMMIT\n')
+        desired = iptables.pg_iptables_rules('10.0.0.0/24')
+        _persist.assert_called_once_with(desired, _kv().get.return_value)
+        _kv().set.assert_called_with(iptables.IPTABLES_KV_KEY, desired)
+
+    @patch.object(iptables, 'write_file_atomic')
+    @patch.object(iptables, 'installed_version')
+    def test_persist_iptables(self, _installed_version, _write):
+        _write.side_effect = write_file_atomic
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rules_v4 = os.path.join(tmpdir, 'rules.v4')
+        old = iptables.pg_iptables_rules('10.9.0.0/24')
+        new = iptables.pg_iptables_rules('10.0.0.0/24')
+        with open(rules_v4, 'w') as rules:
+            rules.write('*nat\n:PREROUTING ACCEPT [0:0]\nCOMMIT\n'
+                        '*filter\n:INPUT ACCEPT [0:0]\n'
+                        '-A INPUT -p tcp --dport 22 -j ACCEPT\n%s\n'
+                        'COMMIT\n' % old[0])
+        with patch.object(iptables, 'IPTABLES_RULES', rules_v4):
+            iptables.persist_iptables(new, old)
+            with open(rules_v4) as rules:
+                self.assertEqual(rules.read().splitlines(), [
+                    '*nat', ':PREROUTING ACCEPT [0:0]', 'COMMIT',
+                    '*filter', ':INPUT ACCEPT [0:0]',
+                    '-A INPUT -p tcp --dport 22 -j ACCEPT'] + new +
+                    ['COMMIT'])
+            iptables.persist_iptables(new, new)
+            self.assertEqual(_write.call_count, 1)
+            os.unlink(rules_v4)
+            iptables.persist_iptables(new)
+            with open(rules_v4) as rules:
+                self.assertEqual(rules.read().splitlines(), [
+                    '*filter', ':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]',
+                    ':OUTPUT ACCEPT [0:0]'] + new + ['COMMIT'])
+
+    @patch.object(iptables, 'persist_iptables')
+    @patch.object(iptables.subprocess, 'Popen')
+    @patch.object(iptables, 'iptables_input_rules')
+    @patch.object(iptables, 'kv')
+    def test_load_rules_idempotent(self, _kv, _rules, _popen, _persist):
+        _kv().get.return_value = []
+        _rules.return_value = iptables.pg_iptables_rules('10.0.0.0/24')
+        iptables.load_rules('10.0.0.0/24')
+        self.assertFalse(_popen.called)
+        self.assertFalse(_persist.called)
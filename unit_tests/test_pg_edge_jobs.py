@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from mock import patch
+from test_utils import CharmTestCase
+
+import pg_edge_jobs as jobs
+
+TO_PATCH = [
+    'local_unit',
+    'log',
+]
+
+
+class TestPGEdgeJobs(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeJobs, self).setUp(jobs, TO_PATCH)
+        self.local_unit.return_value = 'plumgrid-edge/0'
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for name, path in [('JOBS_DIR', 'jobs'), ('SYSTEMD_DIR', 'systemd')]:
+            _patch = patch.object(jobs, name,
+                                  os.path.join(self.tmpdir, path))
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def _wait(self, name):
+        for _ in range(100):
+            state = jobs.job_state(name)
+            if state['status'] != 'running':
+                return state
+            time.sleep(0.05)
+        self.fail('job %s did not finish' % name)
+
+    def test_detached_job(self):
+        self.assertIsNone(jobs.job_state('upgrade'))
+        got = os.path.join(self.tmpdir, 'got')
+        self.assertTrue(jobs.start_job('upgrade', [
+            ('Downloading', ['sh', '-c', 'echo "$JOB_ENV" > %s' % got]),
+        ], meta={'packages': ['iovisor-dkms']}, env={'JOB_ENV': 'set'}))
+        state = self._wait('upgrade')
+        self.assertEqual(state['status'], 'done')
+        with open(got) as f:
+            self.assertEqual(f.read(), 'set\n')
+        self.assertEqual(state['step'], 1)
+        self.assertEqual(state['meta'], {'packages': ['iovisor-dkms']})
+        jobs.clear_job('upgrade')
+        self.assertIsNone(jobs.job_state('upgrade'))
+
+    def test_failed_job(self):
+        with patch.object(subprocess, 'Popen') as _popen:
+            jobs.start_job('upgrade', [
+                ('Downloading', ['true']),
+                ('Building', ['sh', '-c', 'echo broken; exit 3']),
+                ('Cleaning', ['true']),
+            ])
+            state = jobs.job_state('upgrade')
+            self.assertEqual((state['status'], state['step']),
+                             ('running', 0))
+            # Running jobs are not started again
+            self.assertFalse(jobs.start_job('upgrade', []))
+            self.assertEqual(_popen.call_count, 1)
+        call = subprocess.call
+        with patch.object(subprocess, 'call') as _call:
+            _call.side_effect = lambda cmd, **kwargs: (
+                0 if cmd[0] == 'juju-run' else call(cmd, **kwargs))
+            self.assertEqual(jobs.run_worker(jobs._job_dir('upgrade')), 3)
+            self.assertEqual(_call.call_count, 3)
+            self.assertEqual(_call.call_args[0][0], [
+                'juju-run', 'plumgrid-edge/0', 'hooks/update-status'])
+        state = jobs.job_state('upgrade')
+        self.assertEqual((state['status'], state['step'],
+                          state['description']),
+                         ('failed', 2, 'Building'))
+        self.assertEqual(state['output'][-1], 'broken')
+
+    def test_lost_worker(self):
+        with patch.object(subprocess, 'Popen'):
+            jobs.start_job('upgrade', [('Downloading', ['true'])])
+        later = time.time() + 2 * jobs.JOB_START_TIMEOUT
+        with patch.object(jobs.time, 'time', return_value=later):
+            self.assertEqual(jobs.job_state('upgrade')['status'], 'failed')
+        worker = subprocess.Popen(['true'])
+        worker.wait()
+        progress = jobs._read(jobs._job_dir('upgrade'), jobs.PROGRESS_FILE)
+        progress['pid'] = worker.pid
+        jobs._write(jobs._job_dir('upgrade'), jobs.PROGRESS_FILE, progress)
+        self.assertEqual(jobs.job_state('upgrade')['error'], 'worker exited')
+
+    @patch.object(subprocess, 'check_call')
+    def test_systemd_job(self, _check_call):
+        os.makedirs(jobs.SYSTEMD_DIR)
+        jobs.start_job('upgrade', [('Downloading', ['true'])])
+        cmd = _check_call.call_args[0][0]
+        self.assertEqual(cmd[0], 'systemd-run')
+        self.assertTrue(cmd[1].startswith('--unit=plumgrid-edge-upgrade-'))
+        self.assertEqual(cmd[3:], [sys.executable,
+                                   os.path.abspath(jobs.__file__),
+                                   jobs._job_dir('upgrade')])
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+from mock import patch
+from test_utils import CharmTestCase
+from charmhelpers.core.unitdata import Storage
+
+import pg_edge_lcm as lcm
+from pg_edge_utils import write_file_atomic
+
+TO_PATCH = [
+    'log',
+]
+
+
+class TestPGEdgeLcm(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeLcm, self).setUp(lcm, TO_PATCH)
+
+    def test_ssh_key_fingerprint(self):
+        key = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC7 lcm@pg'
+        self.assertEqual(lcm.ssh_key_fingerprint(key),
+                         lcm.ssh_key_fingerprint(
+                             'from="10.0.0.1" ssh-rsa '
+                             'AAAAB3NzaC1yc2EAAAADAQABAAABAQC7 other'))
+        self.assertNotEqual(lcm.ssh_key_fingerprint(key),
+                            lcm.ssh_key_fingerprint(
+                                'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC8'))
+
+    @patch.object(lcm, 'write_file_atomic')
+    @patch.object(lcm, 'config')
+    @patch.object(lcm, 'kv')
+    def test_authorize_keys(self, _kv, _config, _write):
+        _kv.return_value = Storage(':memory:')
+        _write.side_effect = write_file_atomic
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        auth_keys = os.path.join(tmpdir, 'authorized_keys')
+        manual = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCm manual'
+        key1 = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC1 lcm1'
+        key2 = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC2 lcm2'
+        with open(auth_keys, 'w') as keys:
+            keys.write(manual + '\n')
+        _config.return_value = '%s\n%s\n' % (key1, key2)
+        self.assertEqual(lcm.authorize_keys(auth_keys), 2)
+        self.assertEqual(lcm.authorize_keys(auth_keys), 0)
+        self.assertEqual(_write.call_count, 1)
+        _config.return_value = key2
+        self.assertEqual(lcm.authorize_keys(auth_keys), 1)
+        with open(auth_keys) as keys:
+            self.assertEqual(keys.read(), '%s\n%s\n' % (manual, key2))
+        _config.return_value = 'null'
+        self.assertEqual(lcm.authorize_keys(auth_keys), 1)
+        with open(auth_keys) as keys:
+            self.assertEqual(keys.read(), manual + '\n')
+
+    @patch.object(lcm, 'write_file_atomic')
+    @patch.object(lcm, 'config')
+    @patch.object(lcm, 'kv')
+    def test_authorize_keys_upgrade(self, _kv, _config, _write):
+        # earlier versions of the charm appended the key without owning it
+        _kv.return_value = Storage(':memory:')
+        _write.side_effect = write_file_atomic
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        auth_keys = os.path.join(tmpdir, 'authorized_keys')
+        manual = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCm manual'
+        old_key = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC1 lcm1'
+        new_key = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC2 lcm2'
+        with open(auth_keys, 'w') as keys:
+            keys.write('%s\n%s\n' % (manual, old_key))
+        _config.return_value = old_key
+        self.assertEqual(lcm.authorize_keys(auth_keys), 0)
+        _config.return_value = new_key
+        self.assertEqual(lcm.authorize_keys(auth_keys), 2)
+        with open(auth_keys) as keys:
+            self.assertEqual(keys.read(), '%s\n%s\n' % (manual, new_key))
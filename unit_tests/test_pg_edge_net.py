@@ -0,0 +1,123 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+from mock import patch
+from test_utils import CharmTestCase
+import charmhelpers.core.hookenv as hookenv
+
+import pg_edge_net as net
+
+TO_PATCH = [
+    'log',
+]
+
+
+def _rtattr(rta_type, payload):
+    length = net.RTATTR.size + len(payload)
+    return (net.RTATTR.pack(length, rta_type) + payload +
+            '\0' * (net._align(length) - length))
+
+
+def _nlmsg(msg_type, payload):
+    return net.NLMSGHDR.pack(net.NLMSGHDR.size + len(payload), msg_type,
+                             0, 1, 0) + payload
+
+
+def _addr_msg(index, address, prefixlen):
+    return _nlmsg(net.RTM_NEWADDR,
+                  net.IFADDRMSG.pack(socket.AF_INET, prefixlen, 0, 0,
+                                     index) +
+                  _rtattr(net.IFA_LOCAL, socket.inet_aton(address)))
+
+
+def _route_msg(index, network, dst_len, scope=net.RT_SCOPE_LINK):
+    return _nlmsg(net.RTM_NEWROUTE,
+                  net.RTMSG.pack(socket.AF_INET, dst_len, 0, 0,
+                                 net.RT_TABLE_MAIN, 2, scope,
+                                 net.RTN_UNICAST, 0) +
+                  _rtattr(net.RTA_DST, socket.inet_aton(network)) +
+                  _rtattr(net.RTA_OIF, struct.pack('=I', index)))
+
+
+class TestPGEdgeNet(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeNet, self).setUp(net, TO_PATCH)
+        hookenv.cache = {}
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        _sysfs = patch.object(net, 'SYS_CLASS_NET', self.sysfs)
+        _sysfs.start()
+        self.addCleanup(_sysfs.stop)
+
+    def _add_iface(self, name, index, mtu, members=None):
+        path = os.path.join(self.sysfs, name)
+        os.mkdir(path)
+        open(os.path.join(path, 'ifindex'), 'w').write('%d\n' % index)
+        open(os.path.join(path, 'mtu'), 'w').write('%d\n' % mtu)
+        if members is not None:
+            os.mkdir(os.path.join(path, 'brif'))
+            for member in members:
+                os.mkdir(os.path.join(path, 'brif', member))
+                os.symlink(path, os.path.join(self.sysfs, member, 'master'))
+
+    def test_parse_addresses(self):
+        data = (_addr_msg(2, '10.0.0.5', 24) + _addr_msg(3, '10.1.0.5', 16) +
+                _nlmsg(net.NLMSG_DONE, '\0' * 4))
+        self.assertEqual(net.parse_addresses(data),
+                         [(2, '10.0.0.5/24'), (3, '10.1.0.5/16')])
+
+    def test_parse_connected_routes(self):
+        data = (_route_msg(2, '10.0.0.0', 24) +
+                _route_msg(2, '0.0.0.0', 0, scope=0) +
+                _nlmsg(net.NLMSG_DONE, '\0' * 4))
+        self.assertEqual(net.parse_connected_routes(data),
+                         [(2, '10.0.0.0/24')])
+
+    @patch.object(net, '_netlink_dump')
+    def test_snapshot(self, _dump):
+        self._add_iface('eth1', 2, 1500)
+        self._add_iface('eth2', 3, 1500)
+        self._add_iface('br0', 4, 1500, members=['eth1', 'eth2'])
+        _dump.side_effect = [_addr_msg(4, '10.0.0.5', 24),
+                             _route_msg(4, '10.0.0.0', 24)]
+        self.assertTrue(net.interface_exists('br0'))
+        self.assertFalse(net.interface_exists('eth9'))
+        self.assertEqual(net.bridge_members('br0'), ['eth1', 'eth2'])
+        self.assertEqual(net.interface_for_address('10.0.0.5'), 'br0')
+        self.assertEqual(net.connected_network('br0'), '10.0.0.0/24')
+        self.assertEqual(net.snapshot()['eth1']['master'], 'br0')
+        self.assertEqual(net.snapshot()['eth1']['mtu'], 1500)
+        self.assertEqual(_dump.call_count, 2)
+
+    @patch.object(net, '_netlink_dump')
+    def test_reconcile_mtu(self, _dump):
+        _dump.return_value = ''
+        self._add_iface('eth1', 2, 1500)
+        self._add_iface('eth2', 3, 1580)
+        self._add_iface('br0', 4, 1500, members=['eth1', 'eth2'])
+        self.assertEqual(net.snapshot()['br0']['mtu'], 1500)
+        written = []
+        _write_mtu = net._write_mtu
+
+        def write_mtu(interface, mtu):
+            written.append(interface)
+            _write_mtu(interface, mtu)
+
+        with patch.object(net, '_write_mtu', side_effect=write_mtu):
+            changes = net.reconcile_mtu([['eth1', 'eth2'], ['br0']], '1580')
+            self.assertEqual(changes, [('eth1', 1500, 1580),
+                                       ('br0', 1500, 1580)])
+            self.assertEqual(written, ['eth1', 'br0'])
+            self.assertEqual(net.snapshot()['br0']['mtu'], 1580)
+            self.assertEqual(net.reconcile_mtu([['eth1', 'eth2'], ['br0']],
+                                               1580), [])
+            self.assertEqual(written, ['eth1', 'br0'])
+
+    def test_reconcile_mtu_error(self):
+        self._add_iface('br0', 4, 1500, members=[])
+        self.assertRaises(ValueError, net.reconcile_mtu,
+                          [['eth9'], ['br0']], 1580)
+        self.assertEqual(net.read_mtu('br0'), 1500)
@@ -0,0 +1,307 @@
+import time
+from mock import patch
+from test_utils import CharmTestCase
+import charmhelpers.core.hookenv as hookenv
+from charmhelpers.core.unitdata import Storage
+
+import pg_edge_restarts as restarts
+
+TO_PATCH = [
+    'config',
+    'log',
+]
+
+
+class TestPGEdgeRestarts(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeRestarts, self).setUp(restarts, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        hookenv.cache = {}
+
+    def tearDown(self):
+        hookenv.cache = {}
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'load_iovisor')
+    @patch.object(restarts, 'remove_iovisor')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_coalesced(self, _stop, _start, _running, _remove,
+                                    _load, _kv, _rolling):
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = True
+        _running.return_value = True
+        self.assertEqual(restarts.run_restarts(), [])
+        restarts.request_restart('restart', 'fabric-interfaces')
+        restarts.request_restart('reload', 'iovisor-dkms upgrade')
+        restarts.request_restart('reload', 'iovisor-dkms upgrade')
+        restarts.request_restart('restart', 'metadata-shared-key')
+        restarts.request_restart('start')
+        self.assertEqual(restarts.run_restarts(), ['stop', 'reload', 'start'])
+        _stop.assert_called_once_with()
+        _remove.assert_called_once_with()
+        _load.assert_called_once_with()
+        _start.assert_called_once_with()
+        self.assertEqual(restarts.run_restarts(), [])
+        # plumgrid is not running, so no restart slot is needed
+        _rolling.reset_mock()
+        _running.return_value = False
+        restarts.request_restart('restart', 'fabric-interfaces')
+        self.assertEqual(restarts.run_restarts(), ['stop', 'start'])
+        self.assertFalse(_rolling.request_slot.called)
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts(self, _stop, _start, _running, _kv, _rolling):
+        hookenv.cache = {}
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = False
+        _running.return_value = True
+        restarts.request_restart('start')
+        self.assertEqual(restarts.run_restarts(), [])
+        restarts.request_restart('restart', '/etc/hosts')
+        restarts.request_restart('restart', '/etc/hostname')
+        _running.return_value = False
+        self.assertEqual(restarts.run_restarts(), ['stop', 'start'])
+        _stop.assert_called_once_with()
+        self.assertRaises(ValueError, restarts.request_restart, 'reboot')
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_after_failed_hook(self, _stop, _start, _running,
+                                            _kv, _rolling):
+        hookenv.cache = {}
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = False
+        _running.return_value = True
+        failures = [ValueError('plumgrid did not stop')]
+
+        def stop():
+            if failures:
+                raise failures.pop()
+        _stop.side_effect = stop
+        restarts.request_restart('restart', 'fabric-interfaces')
+        restarts.request_restart('start')
+        self.assertRaises(ValueError, restarts.run_restarts)
+        # The retried hook finds the config unchanged and requests nothing
+        hookenv.cache = {}
+        self.assertEqual(restarts.run_restarts(), ['stop', 'start'])
+        self.assertIsNone(_kv.return_value.get(restarts.RESTART_KV_KEY))
+        hookenv.cache = {}
+        self.assertEqual(restarts.run_restarts(), [])
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, '_prefetched')
+    @patch.object(restarts, 'install_pg')
+    @patch.object(restarts, 'prebuild_iovisor')
+    @patch.object(restarts, 'prefetch_pg')
+    @patch.object(restarts, 'load_iovisor')
+    @patch.object(restarts, 'remove_iovisor')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_rolling(self, _stop, _start, _running, _remove,
+                                  _load, _prefetch, _prebuild, _install,
+                                  _prefetched, _kv, _rolling):
+        hookenv.cache = {}
+        _kv.return_value = Storage(':memory:')
+        _prefetched.return_value = True
+        _rolling.coordinated.return_value = True
+        _rolling.request_slot.return_value = False
+        _running.return_value = True
+        _prefetch.return_value = ['plumgrid-lxc', 'iovisor-dkms']
+        _prebuild.return_value = True
+        _install.return_value = False
+        restarts.request_restart('upgrade', 'plumgrid-build')
+        restarts.request_restart('start')
+        self.assertEqual(restarts.run_restarts(), [])
+        self.assertFalse(_stop.called)
+        # the upgrade is downloaded and built before the slot is requested
+        _prefetch.assert_called_once_with()
+        _prebuild.assert_called_once_with(['plumgrid-lxc', 'iovisor-dkms'])
+        _rolling.request_slot.assert_called_with(['plumgrid-build'])
+        # A later hook finds the deferred upgrade and holds a slot
+        hookenv.cache = {}
+        _rolling.request_slot.return_value = True
+        started = time.time()
+        self.assertEqual(restarts.run_restarts(),
+                         ['stop', 'upgrade', 'reload', 'start'])
+        elapsed = time.time() - started
+        _install.assert_called_once_with(['plumgrid-lxc', 'iovisor-dkms'])
+        timing = _kv.return_value.get(restarts.RESTART_TIMING_KV_KEY)
+        self.assertEqual(_prefetch.call_count, 1)
+        self.assertEqual([name for name, _ in timing['phases']], [
+            'stop', 'install', 'reload', 'start'])
+        self.assertTrue(0 <= timing['outage'] <= round(elapsed, 3) + 0.001)
+        _rolling.wait_jitter.assert_called_once_with()
+        _rolling.release_slot.assert_called_once_with()
+        hookenv.cache = {}
+        self.assertEqual(restarts.run_restarts(), [])
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'missing_debs')
+    @patch.object(restarts, 'determine_packages')
+    @patch.object(restarts, 'install_pg')
+    @patch.object(restarts, 'prebuild_iovisor')
+    @patch.object(restarts, 'prefetch_pg')
+    @patch.object(restarts, 'load_iovisor')
+    @patch.object(restarts, 'remove_iovisor')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_resume(self, _stop, _start, _running, _remove,
+                                 _load, _prefetch, _prebuild, _install,
+                                 _packages, _missing_debs, _kv, _rolling):
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = False
+        plumgrid = {'running': True}
+        _running.side_effect = lambda service: plumgrid['running']
+        _stop.side_effect = lambda: plumgrid.update(running=False)
+        _start.side_effect = lambda: plumgrid.update(running=True)
+        _prefetch.return_value = ['plumgrid-lxc=5.0-1', 'iovisor-dkms=5.0-1']
+        _packages.return_value = _prefetch.return_value
+        _missing_debs.return_value = []
+        _prebuild.return_value = False
+        _install.side_effect = [IOError('dpkg interrupted'), True]
+        restarts.request_restart('upgrade', 'package upgrade')
+        self.assertRaises(IOError, restarts.run_restarts)
+        checkpoint = _kv.return_value.get(restarts.RESTART_CHECKPOINT_KV_KEY)
+        self.assertEqual(checkpoint['done'], ['prefetch', 'prebuild', 'stop'])
+        # The next hook resumes with the install, plumgrid still being down
+        hookenv.cache = {}
+        self.assertEqual(restarts.run_restarts(),
+                         ['upgrade', 'reload', 'start'])
+        self.assertEqual(_prefetch.call_count, 1)
+        self.assertEqual(_prebuild.call_count, 1)
+        self.assertEqual(_stop.call_count, 1)
+        _install.assert_called_with(_prefetch.return_value)
+        self.assertIsNone(
+            _kv.return_value.get(restarts.RESTART_CHECKPOINT_KV_KEY))
+        # Downloads are redone if the packages to upgrade to changed
+        hookenv.cache = {}
+        _install.side_effect = [IOError('dpkg interrupted')]
+        restarts.request_restart('upgrade', 'package upgrade')
+        self.assertRaises(IOError, restarts.run_restarts)
+        hookenv.cache = {}
+        _packages.return_value = ['plumgrid-lxc=5.0-2', 'iovisor-dkms=5.0-1']
+        _install.side_effect = None
+        _install.return_value = False
+        self.assertEqual(restarts.run_restarts(), ['upgrade', 'start'])
+        self.assertEqual(_prefetch.call_count, 3)
+        self.assertEqual(_stop.call_count, 2)
+        hookenv.cache = {}
+        restarts.request_restart('upgrade', 'package upgrade')
+        restarts.cancel_restarts()
+        self.assertEqual(restarts.run_restarts(), [])
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'install_pg')
+    @patch.object(restarts, 'prebuild_iovisor')
+    @patch.object(restarts, 'prefetch_pg')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_resume_download(self, _stop, _start, _running,
+                                          _prefetch, _prebuild, _install,
+                                          _kv, _rolling):
+        hookenv.cache = {}
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = False
+        _running.return_value = True
+        _prefetch.side_effect = [IOError('apt-get update failed'),
+                                 ['plumgrid-lxc=5.0-1']]
+        _prebuild.return_value = False
+        _install.return_value = False
+        restarts.request_restart('upgrade', 'package upgrade')
+        self.assertRaises(IOError, restarts.run_restarts)
+        checkpoint = _kv.return_value.get(restarts.RESTART_CHECKPOINT_KV_KEY)
+        self.assertEqual(checkpoint['done'], [])
+        self.assertEqual(checkpoint['requests'],
+                         {'upgrade': ['package upgrade']})
+        self.assertFalse(_stop.called)
+        # The checkpoint alone carries the upgrade over to the next hook
+        _kv.return_value.unset(restarts.RESTART_KV_KEY)
+        hookenv.cache = {}
+        self.assertEqual(restarts.run_restarts(), ['stop', 'upgrade', 'start'])
+        _install.assert_called_once_with(['plumgrid-lxc=5.0-1'])
+        self.assertIsNone(
+            _kv.return_value.get(restarts.RESTART_CHECKPOINT_KV_KEY))
+
+    @patch.object(restarts, 'pg_edge_rolling')
+    @patch.object(restarts, 'pg_edge_jobs')
+    @patch.object(restarts, 'kv')
+    @patch.object(restarts, 'missing_debs')
+    @patch.object(restarts, 'determine_packages')
+    @patch.object(restarts, 'configure_pg_sources')
+    @patch.object(restarts, 'status_set')
+    @patch.object(restarts, 'install_pg')
+    @patch.object(restarts, 'prebuild_iovisor')
+    @patch.object(restarts, 'prefetch_pg')
+    @patch.object(restarts, 'load_iovisor')
+    @patch.object(restarts, 'remove_iovisor')
+    @patch.object(restarts, 'service_running')
+    @patch.object(restarts, 'start_pg')
+    @patch.object(restarts, 'stop_pg')
+    def test_run_restarts_background(self, _stop, _start, _running, _remove,
+                                     _load, _prefetch, _prebuild, _install,
+                                     _status_set, _sources, _packages,
+                                     _missing_debs, _kv, _jobs, _rolling):
+        hookenv.cache = {}
+        self.test_config.set('background-upgrades', True)
+        _kv.return_value = Storage(':memory:')
+        _rolling.coordinated.return_value = False
+        _running.return_value = True
+        _packages.return_value = ['plumgrid-lxc=5.0-1', 'iovisor-dkms=5.0-1']
+        _missing_debs.return_value = []
+        _prebuild.return_value = True
+        _install.return_value = False
+        _jobs.job_state.return_value = None
+        restarts.request_restart('upgrade', 'package upgrade')
+        self.assertEqual(restarts.run_restarts(), [])
+        # Only the download runs in the background, dpkg runs in hooks
+        commands, = _jobs.start_job.call_args[0][1:]
+        self.assertEqual(commands, [
+            ('Downloading PLUMgrid packages',
+             ['apt-get', '--assume-yes', '--force-yes', '--download-only',
+              'install'] + _packages.return_value)])
+        self.assertEqual(_jobs.start_job.call_args[1]['meta'], {
+            'packages': _packages.return_value})
+        # Later hooks report the progress until the job is done
+        hookenv.cache = {}
+        _jobs.job_state.return_value = {
+            'status': 'running', 'step': 1, 'total': 1,
+            'description': 'Downloading PLUMgrid packages',
+            'meta': _jobs.start_job.call_args[1]['meta']}
+        self.assertEqual(restarts.run_restarts(), [])
+        _status_set.assert_called_with(
+            'maintenance',
+            'Downloading PLUMgrid packages in the background (1/1)')
+        self.assertEqual(_jobs.start_job.call_count, 1)
+        self.assertFalse(_prebuild.called)
+        hookenv.cache = {}
+        _jobs.job_state.return_value['status'] = 'done'
+        self.assertEqual(restarts.run_restarts(),
+                         ['stop', 'upgrade', 'reload', 'start'])
+        _jobs.clear_job.assert_called_once_with(restarts.UPGRADE_JOB)
+        self.assertFalse(_prefetch.called)
+        _prebuild.assert_called_once_with(_packages.return_value)
+        _install.assert_called_once_with(_packages.return_value)
+        # Failed jobs fail the hook, which prepares the upgrade again
+        hookenv.cache = {}
+        _jobs.job_state.return_value = {
+            'status': 'failed', 'step': 1, 'total': 1, 'meta': {},
+            'output': ['E: Unable to fetch some archives']}
+        restarts.request_restart('upgrade', 'package upgrade')
+        self.assertRaises(ValueError, restarts.run_restarts)
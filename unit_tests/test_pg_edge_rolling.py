@@ -0,0 +1,122 @@
+from mock import patch
+from test_utils import CharmTestCase, get_default_config
+from charmhelpers.core.unitdata import Storage
+
+import pg_edge_rolling as rolling
+
+TO_PATCH = [
+    'config',
+    'is_leader',
+    'leader_get',
+    'leader_set',
+    'local_unit',
+    'log',
+    'related_units',
+    'relation_get',
+    'relation_ids',
+    'relation_set',
+    'status_set',
+]
+
+UNITS = ['plumgrid-edge/0', 'plumgrid-edge/1', 'plumgrid-edge/2']
+
+
+class TestPGEdgeRolling(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeRolling, self).setUp(rolling, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('rolling-restart-concurrency', 1)
+        self.unit = UNITS[0]
+        self.leader = UNITS[0]
+        self.settings = dict((unit, {}) for unit in UNITS)
+        self.leader_settings = {}
+        self.stores = dict((unit, Storage(':memory:')) for unit in UNITS)
+        _kv = patch.object(rolling, 'kv',
+                           side_effect=lambda: self.stores[self.unit])
+        _kv.start()
+        self.addCleanup(_kv.stop)
+        self.relation_ids.return_value = ['edge-peers:1']
+        self.local_unit.side_effect = lambda: self.unit
+        self.is_leader.side_effect = lambda: self.unit == self.leader
+        self.related_units.side_effect = lambda rid: [
+            unit for unit in UNITS if unit != self.unit]
+        self.relation_get.side_effect = self._relation_get
+        self.relation_set.side_effect = self._relation_set
+        self.leader_get.side_effect = self.leader_settings.get
+        self.leader_set.side_effect = self.leader_settings.update
+
+    def _relation_get(self, attribute=None, unit=None, rid=None):
+        if attribute:
+            return self.settings[unit].get(attribute)
+        return self.settings[unit]
+
+    def _relation_set(self, relation_id=None, **settings):
+        self.settings[self.unit].update(settings)
+
+    def _request(self, unit):
+        self.unit = unit
+        return rolling.request_slot(['plumgrid-build'])
+
+    def test_coordinated(self):
+        self.assertTrue(rolling.coordinated())
+        # Restarts are not coordinated unless enabled
+        default = get_default_config()['rolling-restart-concurrency']
+        self.test_config.set('rolling-restart-concurrency', default)
+        self.assertFalse(rolling.coordinated())
+        self.test_config.set('rolling-restart-concurrency', 1)
+        self.relation_ids.return_value = []
+        self.assertFalse(rolling.coordinated())
+        self.relation_ids.return_value = ['edge-peers:1']
+        self.is_leader.side_effect = NotImplementedError
+        self.assertFalse(rolling.coordinated())
+
+    @patch('time.time')
+    def test_rolling_restart(self, _time):
+        _time.side_effect = [1.0, 2.0, 3.0]
+        self.assertFalse(self._request(UNITS[1]))
+        self.assertFalse(self._request(UNITS[2]))
+        # The leader queues itself behind the edges which asked first
+        self.assertFalse(self._request(UNITS[0]))
+        self.unit = self.leader
+        self.assertEqual(rolling.allocate_slots(), {UNITS[1]: '1000'})
+        self.assertEqual(self.leader_settings[rolling.PROGRESS_KEY],
+                         '0/3 edges done, 1 restarting, 2 waiting')
+        # Asking again keeps the place in the queue
+        self.assertFalse(self._request(UNITS[2]))
+        self.assertTrue(self._request(UNITS[1]))
+        rolling.release_slot()
+        self.assertEqual(self.settings[UNITS[1]][rolling.DONE_KEY], '1000')
+        self.assertFalse(rolling.holds_slot())
+        self.unit = self.leader
+        rolling.update_slots()
+        self.unit = UNITS[2]
+        self.assertTrue(rolling.holds_slot())
+        # Only the leader hands out slots
+        calls = self.leader_set.call_count
+        self.unit = UNITS[1]
+        rolling.update_slots()
+        self.assertEqual(self.leader_set.call_count, calls)
+        self.unit = UNITS[2]
+        rolling.release_slot()
+        self.unit = self.leader
+        self.assertEqual(rolling.allocate_slots(), {UNITS[0]: '3000'})
+        self.assertTrue(rolling.holds_slot())
+        rolling.release_slot()
+        self.assertEqual(rolling.allocate_slots(), {})
+        self.assertEqual(self.leader_settings[rolling.PROGRESS_KEY],
+                         '3/3 edges done, 0 restarting, 0 waiting')
+
+    @patch('time.time')
+    def test_concurrency_and_departed_units(self, _time):
+        _time.side_effect = [1.0, 2.0, 3.0]
+        self.test_config.set('rolling-restart-concurrency', 2)
+        for unit in UNITS[1:]:
+            self.assertFalse(self._request(unit))
+        self.unit = self.leader
+        self.assertEqual(sorted(rolling.allocate_slots()), UNITS[1:])
+        self.assertFalse(self._request(UNITS[0]))
+        # A departed edge gives its slot up
+        self.related_units.side_effect = lambda rid: [UNITS[2]]
+        self.assertEqual(sorted(rolling.allocate_slots()),
+                         [UNITS[0], UNITS[2]])
@@ -0,0 +1,96 @@
+import threading
+from mock import patch
+from test_utils import CharmTestCase
+from charmhelpers.core import unitdata
+from charmhelpers.core.unitdata import Storage
+
+import pg_edge_tasks as tasks
+
+TO_PATCH = [
+    'log',
+]
+
+
+class TestPGEdgeTasks(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeTasks, self).setUp(tasks, TO_PATCH)
+
+    @patch.object(unitdata, '_KV', Storage(':memory:'))
+    def test_task_graph(self):
+        started = [threading.Event(), threading.Event()]
+        order = []
+        active = set()
+
+        def concurrent(i):
+            def step():
+                started[i].set()
+                # only returns if both steps run at the same time
+                self.assertTrue(started[1 - i].wait(5))
+                order.append(i)
+            return step
+
+        def locked(name):
+            def step():
+                self.assertFalse(active)
+                active.add(name)
+                order.append(name)
+                active.remove(name)
+            return step
+
+        graph = tasks.TaskGraph('test')
+        graph.add('a', concurrent(0))
+        graph.add('b', concurrent(1))
+        graph.add('c', locked('c'), requires=['a', 'b'], locks=['apt'])
+        graph.add('d', locked('d'), requires=['a'], locks=['apt'],
+                  main_thread=True)
+        results = graph.run()
+        self.assertEqual(sorted(order[:2]), [0, 1])
+        self.assertEqual(sorted(order[2:]), ['c', 'd'])
+        self.assertEqual([r['status'] for r in results.values()],
+                         ['done'] * 4)
+        self.assertEqual(unitdata.kv().get('pg_edge.tasks.test')['c']
+                         ['status'], 'done')
+
+    @patch.object(unitdata, '_KV', Storage(':memory:'))
+    def test_task_graph_unitdata(self):
+        errors = []
+
+        def step():
+            tasks.kv().set('step', threading.current_thread().name)
+            try:
+                tasks.kv().set('broken', object())
+            except TypeError as e:
+                errors.append(e)
+
+        graph = tasks.TaskGraph('test')
+        graph.add('step', step)
+        graph.run()
+        store = unitdata.kv()
+        self.assertIsInstance(store, Storage)
+        self.assertNotEqual(store.get('step'),
+                            threading.current_thread().name)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(store.get('pg_edge.tasks.test')['step']['status'],
+                         'done')
+
+    @patch.object(unitdata, '_KV', Storage(':memory:'))
+    def test_task_graph_failure(self):
+        ran = []
+
+        def fail():
+            raise ValueError('apt failed')
+
+        graph = tasks.TaskGraph('test', workers=1)
+        graph.add('packages', fail)
+        graph.add('iovisor', lambda: ran.append('iovisor'),
+                  requires=['packages'])
+        graph.add('mtu', lambda: ran.append('mtu'), main_thread=True)
+        self.assertRaises(ValueError, graph.run)
+        self.assertEqual(ran, ['mtu'])
+        results = unitdata.kv().get('pg_edge.tasks.test')
+        self.assertEqual(dict((k, v['status']) for k, v in results.items()),
+                         {'packages': 'failed', 'iovisor': 'skipped',
+                          'mtu': 'done'})
+        self.assertRaises(ValueError, graph.add, 'files', fail,
+                          requires=['unknown'])
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from mock import patch
+import charmhelpers.contrib.openstack.templating as templating
+from charmhelpers.core.unitdata import Storage
+from test_utils import CharmTestCase
+
+import pg_edge_templating as render
+
+TO_PATCH = [
+    'log',
+]
+
+
+class TestPGEdgeTemplating(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeTemplating, self).setUp(render, TO_PATCH)
+
+    def test_render_fingerprint(self):
+        ctxt = {'interface': 'eth0', 'director_ips_string': '10.0.0.1'}
+        fp = render.render_fingerprint(ctxt, u'mgmt_dev={{ interface }}',
+                                       'kilo')
+        self.assertEqual(fp, render.render_fingerprint(
+            dict(ctxt), 'mgmt_dev={{ interface }}', 'kilo'))
+        self.assertNotEqual(fp, render.render_fingerprint(
+            dict(ctxt, interface='eth1'), 'mgmt_dev={{ interface }}',
+            'kilo'))
+        self.assertNotEqual(fp, render.render_fingerprint(
+            ctxt, 'mgmt_dev={{ interface }}\n', 'kilo'))
+
+    @patch.object(templating, 'log')
+    @patch.object(render, 'kv')
+    def test_write_all_skips_unchanged(self, _kv, _log):
+        _kv.return_value = Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        hostname = os.path.join(tmpdir, 'hostname')
+        ctxt = {'pg_hostname': 'node0'}
+        configs = render.PGConfigRenderer(templates_dir='templates/',
+                                          openstack_release='kilo')
+        configs.register(hostname, [lambda: ctxt])
+        configs.templates[hostname].context = lambda: ctxt
+        self.assertEqual(configs.write_all(), [hostname])
+        self.assertEqual(open(hostname).read().strip(), 'node0')
+        self.assertEqual(configs.write_all(), [])
+        ctxt['pg_hostname'] = 'node1'
+        self.assertEqual(configs.write_all(), [hostname])
+        os.unlink(hostname)
+        self.assertEqual(configs.write_all(), [hostname])
+        # files edited outside the charm are rendered again
+        with open(hostname, 'w') as f:
+            f.write('edited\n')
+        self.assertEqual(configs.write_all(), [hostname])
+        self.assertEqual(open(hostname).read().strip(), 'node1')
+        self.assertEqual(configs.write_all(), [])
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from mock import patch
+from test_utils import CharmTestCase
+
+import pg_edge_trace as trace
+
+TO_PATCH = []
+
+
+@trace.traced
+def _restart():
+    subprocess.check_call(['true'])
+    with trace.span('wait'):
+        subprocess.check_output(['/bin/echo', 'ok'])
+
+
+class TestPGEdgeTrace(CharmTestCase):
+
+    def setUp(self):
+        super(TestPGEdgeTrace, self).setUp(trace, TO_PATCH)
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_dir)
+        self.trace_dir = os.path.join(self.charm_dir, trace.TRACE_DIR)
+        module = sys.modules[__name__]
+        self.addCleanup(setattr, module, 'subprocess', subprocess)
+        trace.count_forks([module])
+
+    def test_traced_without_tracer(self):
+        _restart()
+        self.assertIsNone(trace._tracer)
+
+    @patch.dict(os.environ, {'PG_EDGE_TRACE': ''})
+    def test_tracing_enabled(self):
+        self.assertFalse(trace.tracing_enabled())
+        os.environ['PG_EDGE_TRACE'] = '1'
+        self.assertTrue(trace.tracing_enabled())
+
+    def test_count_forks(self):
+        # only the given modules count their commands
+        self.assertIsInstance(subprocess, trace.CountingSubprocess)
+        self.assertFalse(isinstance(trace.subprocess,
+                                    trace.CountingSubprocess))
+        self.assertEqual(subprocess.PIPE, trace.subprocess.PIPE)
+
+    def test_trace_hook(self):
+        with open(os.path.join(self.charm_dir, 'revision'), 'w') as revision:
+            revision.write('42\n')
+        with trace.trace_hook('config-changed', self.charm_dir):
+            _restart()
+            # commands run by other modules are not counted
+            trace.subprocess.check_call(['true'])
+        traces = [f for f in os.listdir(self.trace_dir)
+                  if f.endswith('.json')]
+        self.assertEqual(len(traces), 1)
+        with open(os.path.join(self.trace_dir, traces[0])) as trace_file:
+            data = json.load(trace_file)
+        self.assertEqual(data['name'], 'config-changed')
+        self.assertEqual(data['revision'], '42')
+        self.assertEqual(data['forks'], 2)
+        restart = data['children'][0]
+        self.assertEqual(restart['name'], '_restart')
+        self.assertEqual([c['name'] for c in restart['children']],
+                         ['exec:true', 'wait'])
+        self.assertEqual(restart['children'][1]['children'][0]['name'],
+                         'exec:echo')
+        summary = trace.history_summary(self.trace_dir)
+        self.assertEqual(summary['42']['config-changed']['runs'], 1)
+        self.assertEqual(summary['42']['config-changed']['forks'], 2)
+
+    @patch.object(trace, 'TRACE_HISTORY', 2)
+    def test_trace_history_is_rolling(self):
+        for _ in range(3):
+            with trace.trace_hook('update-status', self.charm_dir):
+                pass
+        traces = [f for f in os.listdir(self.trace_dir)
+                  if f.endswith('.json')]
+        self.assertEqual(len(traces), 2)
+        summary = trace.history_summary(self.trace_dir)
+        self.assertEqual(summary['unknown']['update-status']['runs'], 3)
+
+    def test_trace_hook_error(self):
+        with self.assertRaises(ValueError):
+            with trace.trace_hook('install', self.charm_dir):
+                raise ValueError('failed')
+        self.assertIsNone(trace._tracer)
+        self.assertEqual(len(os.listdir(self.trace_dir)), 2)
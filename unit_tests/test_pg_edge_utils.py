@@ -1,20 +1,32 @@
-from mock import MagicMock
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from mock import MagicMock, call, patch
 from collections import OrderedDict
 import charmhelpers.contrib.openstack.templating as templating
 
 templating.OSConfigRenderer = MagicMock()
 
 import pg_edge_utils as nutils
+import pg_edge_templating
+
+_openstack_release = nutils.openstack_release._wrapped
+_compile_fabric_interfaces = nutils.compile_fabric_interfaces
+_write_file_atomic = nutils.write_file_atomic
 
 from test_utils import (
     CharmTestCase,
 )
 import charmhelpers.core.hookenv as hookenv
+from charmhelpers.core.unitdata import Storage
 
 
 TO_PATCH = [
-    'os_release',
-    'neutron_plugin_attribute',
+    'config',
+    'log',
+    'openstack_release',
 ]
 
 
@@ -31,7 +43,7 @@ class TestPGEdgeUtils(CharmTestCase):
 
     def setUp(self):
         super(TestPGEdgeUtils, self).setUp(nutils, TO_PATCH)
-        # self.config.side_effect = self.test_config.get
+        self.config.side_effect = self.test_config.get
 
     def tearDown(self):
         # Reset cached cache
@@ -47,9 +59,11 @@ class TestPGEdgeUtils(CharmTestCase):
                 self.configs.append(config)
                 self.ctxts.append(ctxt)
 
-        self.os_release.return_value = 'trusty'
-        templating.OSConfigRenderer.side_effect = _mock_OSConfigRenderer
-        _regconfs = nutils.register_configs()
+        self.openstack_release.return_value = 'trusty'
+        with patch.object(pg_edge_templating,
+                          'PGConfigRenderer') as renderer:
+            renderer.side_effect = _mock_OSConfigRenderer
+            _regconfs = nutils.register_configs()
         confs = [nutils.PG_CONF,
                  nutils.PG_HN_CONF,
                  nutils.PG_HS_CONF,
@@ -79,3 +93,472 @@ class TestPGEdgeUtils(CharmTestCase):
         for item in _restart_map:
             self.assertTrue(item in _restart_map)
             self.assertTrue(expect[item] == _restart_map[item])
+
+    def test_write_file_atomic(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'plumgrid.conf')
+        nutils.write_file_atomic(path, u'label=node0\n')
+        self.assertEqual(open(path).read(), 'label=node0\n')
+        os.chmod(path, 0o600)
+        with patch.object(os, 'chown', wraps=os.chown) as _chown:
+            nutils.write_file_atomic(path, 'label=node1\n')
+        self.assertEqual(open(path).read(), 'label=node1\n')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        # the owner of the replaced file is kept
+        self.assertEqual(_chown.call_args[0][1:],
+                         (os.stat(path).st_uid, os.stat(path).st_gid))
+        self.assertEqual(os.listdir(tmpdir), ['plumgrid.conf'])
+
+    @patch.object(nutils, 'kv')
+    @patch.object(nutils, 'time')
+    def test_wait_for_backoff(self, _time, _kv):
+        _time.time.side_effect = [0, 0.1, 0.3, 0.7, 0.7]
+        condition = MagicMock(side_effect=[False, False, False, True])
+        self.assertEqual(nutils.wait_for(condition, 'test', timeout=5), 0.7)
+        self.assertEqual([c[0][0] for c in _time.sleep.call_args_list],
+                         [0.1, 0.2, 0.4])
+        _kv().set.assert_called_with('pg_edge.wait.test',
+                                     {'elapsed': 0.7, 'success': True})
+
+    @patch.object(nutils, 'kv')
+    @patch.object(nutils, 'time')
+    def test_wait_for_timeout(self, _time, _kv):
+        _time.time.side_effect = [0, 3, 6]
+        condition = MagicMock(return_value=False)
+        self.assertRaises(ValueError, nutils.wait_for, condition, 'test',
+                          timeout=5)
+        _time.time.side_effect = [0, 3, 6]
+        self.assertEqual(nutils.wait_for(condition, 'test', timeout=5,
+                                         fatal=False), None)
+
+    @patch.object(nutils, 'status_set')
+    @patch.object(nutils, 'wait_for_pg')
+    @patch.object(nutils, 'service_running')
+    @patch.object(nutils, 'service_start')
+    @patch.object(nutils, 'service_stop')
+    def test_restart_pg_starts_libvirt(self, _stop, _start, _running,
+                                       _wait_for_pg, _status_set):
+        _running.return_value = False
+        _start.return_value = True
+        nutils.restart_pg()
+        # libvirt comes up before plumgrid, which is waited for once
+        self.assertEqual(_start.call_args_list,
+                         [call('libvirt-bin'), call('plumgrid')])
+        _wait_for_pg.assert_called_with(running=True)
+        self.assertEqual(_wait_for_pg.call_count, 2)
+        _status_set.assert_called_with('active', 'Unit is ready')
+        _start.reset_mock()
+        _start.return_value = False
+        self.assertRaises(ValueError, nutils.start_pg)
+        _start.assert_called_once_with('libvirt-bin')
+        _running.return_value = True
+        _start.reset_mock()
+        nutils.start_pg()
+        _start.assert_called_once_with('plumgrid')
+
+    @patch.object(subprocess, 'check_output')
+    @patch.object(nutils, 'installed_version')
+    @patch.object(nutils, 'determine_packages')
+    @patch.object(nutils, 'apt_install')
+    @patch.object(nutils, 'configure_pg_sources')
+    @patch.object(nutils, 'status_set')
+    def test_prefetch_pg(self, _status_set, _sources, _apt_install,
+                         _packages, _installed, _check_output):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        open(os.path.join(tmpdir, 'plumgrid-lxc_1%3a5.0-1_amd64.deb'),
+             'w').close()
+        _packages.return_value = ['plumgrid-lxc=1:5.0-1', 'iovisor-dkms']
+        _installed.return_value = '4.1-1'
+        _check_output.return_value = (
+            'Inst iovisor-dkms [4.1-1] (5.0-1 pg:trusty [all])\n'
+            'Inst plumgrid-lxc [4.1-1] (1:5.0-1 pg:trusty [amd64])\n'
+            'Conf iovisor-dkms (5.0-1 pg:trusty [all])\n')
+        with patch.object(nutils, 'APT_ARCHIVES', tmpdir):
+            # the candidate of unpinned iovisor-dkms is not downloaded
+            with self.assertRaisesRegexp(ValueError, 'iovisor-dkms=5.0-1'):
+                nutils.prefetch_pg()
+            _apt_install.assert_called_with(
+                _packages.return_value,
+                options=['--force-yes', '--download-only'], fatal=True)
+            _check_output.assert_called_with(
+                ['apt-get', '--simulate', '--force-yes', 'install'] +
+                _packages.return_value)
+            open(os.path.join(tmpdir, 'iovisor-dkms_5.0-1_all.deb'),
+                 'w').close()
+            self.assertEqual(nutils.prefetch_pg(), _packages.return_value)
+            # nothing to download once the candidates are installed
+            os.remove(os.path.join(tmpdir, 'iovisor-dkms_5.0-1_all.deb'))
+            _check_output.return_value = ''
+            self.assertEqual(nutils.prefetch_pg(), _packages.return_value)
+        _sources.assert_called_with(update=True)
+
+    @patch.object(nutils, 'installed_version')
+    @patch.object(nutils, 'apt_install')
+    @patch.object(subprocess, 'check_output')
+    @patch.object(nutils, 'status_set')
+    def test_prebuild_iovisor(self, _status_set, _check_output,
+                              _apt_install, _installed):
+        packages = ['plumgrid-lxc=5.0-1', 'iovisor-dkms=5.0-1']
+        _installed.side_effect = ['4.1-1', '5.0-1']
+        _check_output.return_value = (
+            'Inst iovisor-dkms [4.1-1] (5.0-1 pg:trusty [all])\n'
+            'Inst plumgrid-lxc [4.1-1] (5.0-1 pg:trusty [amd64])\n')
+        self.assertFalse(nutils.prebuild_iovisor(packages))
+        self.assertFalse(_apt_install.called)
+        _check_output.return_value = (
+            'Inst iovisor-dkms [4.1-1] (5.0-1 pg:trusty [all])\n'
+            'Conf iovisor-dkms (5.0-1 pg:trusty [all])\n')
+        self.assertTrue(nutils.prebuild_iovisor(packages))
+        _apt_install.assert_called_once_with(
+            ['iovisor-dkms=5.0-1'], options=['--force-yes', '--no-download'],
+            fatal=True)
+        self.assertFalse(nutils.prebuild_iovisor(['plumgrid-lxc']))
+
+    @patch.object(subprocess, 'check_call')
+    @patch.object(nutils, 'status_set')
+    def test_install_iovisor_module(self, _status_set, _check_call):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        module = os.path.join(tmpdir, 'modules', '4.4.0-1', 'iovisor.ko')
+
+        def build(cmd):
+            if cmd[0] == 'dkms':
+                self.assertTrue(os.environ['MAKEFLAGS'].startswith('-j'))
+                os.makedirs(os.path.dirname(module))
+                with open(module, 'w') as ko:
+                    ko.write('built')
+        _check_call.side_effect = build
+        with patch.object(nutils, 'IOVISOR_MODULE',
+                          os.path.join(tmpdir, 'modules', '%s',
+                                       'iovisor.ko')), \
+                patch.object(nutils, 'IOVISOR_CACHE_DIR',
+                             os.path.join(tmpdir, 'cache')):
+            self.assertEqual(
+                nutils.install_iovisor_module('4.4.0-1', '5.0-1'), 'build')
+            _check_call.assert_called_once_with(
+                ['dkms', 'autoinstall', '-k', '4.4.0-1'])
+            self.assertEqual(
+                nutils.install_iovisor_module('4.4.0-1', '5.0-1'),
+                'installed')
+            # Reinstalls find the prebuilt module
+            shutil.rmtree(os.path.dirname(module))
+            self.assertEqual(
+                nutils.install_iovisor_module('4.4.0-1', '5.0-1'), 'cache')
+            _check_call.assert_called_with(['depmod', '4.4.0-1'])
+            with open(module) as ko:
+                self.assertEqual(ko.read(), 'built')
+            # Modules built by iovisor-dkms upgrades are cached too
+            for version in ['5.1-1', '5.2-1']:
+                with open(module, 'w') as ko:
+                    ko.write(version)
+                self.assertEqual(
+                    nutils.install_iovisor_module('4.4.0-1', version),
+                    'build')
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(tmpdir, 'cache', '4.4.0-1'))),
+                ['5.1-1', '5.2-1'])
+        self.assertEqual(_check_call.call_count, 2)
+
+    @patch.object(nutils, 'time')
+    @patch.object(nutils, 'apt_update')
+    @patch.object(nutils, '_run_apt_command')
+    @patch.object(nutils, 'add_source')
+    @patch.object(nutils, 'config')
+    @patch.object(nutils, 'kv')
+    def test_configure_pg_sources(self, _kv, _config, _add_source, _apt,
+                                  _apt_update, _time):
+        _kv.return_value = Storage(':memory:')
+        _time.time.return_value = 1000.0
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ppa_list = os.path.join(tmpdir, 'plumgrid-team-stable-trusty.list')
+        with open(ppa_list, 'w') as ppa:
+            ppa.write('deb http://ppa.launchpad.net/plumgrid-team/stable/'
+                      'ubuntu trusty main\n')
+        pg_list = os.path.join(tmpdir, 'plumgrid.list')
+        settings = {
+            'install_sources': "['ppa:plumgrid-team/stable', "
+                               "'http://pg.example.com/pg trusty main']",
+            'install_keys': "[null, 'abcd1234']",
+        }
+        _config.side_effect = settings.get
+        with patch.object(nutils, 'SOURCES_LIST_D', tmpdir), \
+                patch.object(nutils, 'PG_SOURCES_LIST', pg_list), \
+                patch.object(nutils, 'SOURCES_LIST',
+                             os.path.join(tmpdir, 'sources.list')):
+            self.assertTrue(nutils.configure_pg_sources(update=True))
+            with open(pg_list) as pg:
+                self.assertEqual(pg.read(),
+                                 'deb http://pg.example.com/pg trusty main\n')
+            self.assertEqual(_add_source.call_args_list, [
+                call('ppa:plumgrid-team/stable', None),
+                call('distro', 'abcd1234')])
+            self.assertEqual(
+                [c[0][0][3] for c in _apt.call_args_list],
+                ['Dir::Etc::sourcelist=%s' % pg_list,
+                 'Dir::Etc::sourcelist=%s' % ppa_list])
+            self.assertFalse(_apt_update.called)
+            # Unchanged sources with fresh indexes
+            _add_source.reset_mock()
+            _apt.reset_mock()
+            self.assertFalse(nutils.configure_pg_sources(update=True))
+            self.assertFalse(_add_source.called)
+            self.assertFalse(_apt.called)
+            self.assertTrue(nutils.configure_pg_sources(update=True,
+                                                        force=True))
+            self.assertEqual(_apt.call_count, 2)
+            _time.time.return_value += nutils.PG_SOURCES_MAX_AGE
+            self.assertTrue(nutils.configure_pg_sources(update=True))
+            self.assertEqual(_apt.call_count, 4)
+            # The list of a source is unknown
+            settings.update(install_sources='ppa:other/ppa',
+                            install_keys=None)
+            self.assertTrue(nutils.configure_pg_sources(update=True))
+            _apt_update.assert_called_once_with(fatal=True)
+
+    @patch.object(nutils, 'flush_apt_cache')
+    @patch.object(nutils, 'configure_pg_sources')
+    @patch.object(nutils, 'available_versions')
+    @patch('charmhelpers.contrib.openstack.neutron.neutron_plugin_attribute')
+    def test_determine_packages_refresh(self, _attribute, _versions,
+                                        _sources, _flush):
+        hookenv.cache = {}
+        _attribute.return_value = ['plumgrid-lxc', 'iovisor-dkms']
+        self.test_config.set('plumgrid-build', '5.0-1')
+        published = {'plumgrid-lxc': ['4.1-1'], 'iovisor-dkms': []}
+        _versions.side_effect = lambda pkg: published[pkg]
+        # A build published since the indexes were refreshed
+        _sources.side_effect = lambda **kwargs: published.update(
+            {'plumgrid-lxc': ['4.1-1', '5.0-1']})
+        self.assertEqual(nutils.determine_packages(),
+                         ['plumgrid-lxc=5.0-1', 'iovisor-dkms'])
+        _sources.assert_called_once_with(update=True, force=True)
+        _flush.assert_called_once_with()
+        # Builds which are not published fail after one refresh per hook
+        self.test_config.set('plumgrid-build', '6.0-1')
+        self.assertRaises(ValueError, nutils.determine_packages)
+        self.assertEqual(_sources.call_count, 1)
+
+    @patch.object(nutils, 'kv')
+    @patch.object(nutils, '_apt_index_key')
+    @patch.object(nutils, 'pg_apt_cache')
+    def test_available_versions_index(self, _cache, _index_key, _kv):
+        class _Version(object):
+            def __init__(self, ver_str):
+                self.ver_str = ver_str
+
+        pkg = MagicMock()
+        pkg.version_list = [_Version('1.0'), _Version('1.1')]
+        _cache.return_value = {'plumgrid-lxc': pkg, 'iovisor-dkms': pkg}
+        _index_key.return_value = [10.0, 20.0]
+        store = {}
+        _kv().get.side_effect = store.get
+        _kv().set.side_effect = store.__setitem__
+        self.assertEqual(nutils.available_versions('plumgrid-lxc'),
+                         ['1.0', '1.1'])
+        self.assertEqual(nutils.available_versions('iovisor-dkms'),
+                         ['1.0', '1.1'])
+        self.assertEqual(_cache.call_count, 1)
+        _index_key.return_value = [11.0, 20.0]
+        nutils.available_versions('plumgrid-lxc')
+        self.assertEqual(_cache.call_count, 2)
+
+    @patch.object(nutils, 'installed_version')
+    def test_openstack_release(self, _installed_version):
+        openstack_release = _openstack_release
+        _installed_version.return_value = '1:2015.1.2-0ubuntu2'
+        self.assertEqual(openstack_release(), 'kilo')
+        _installed_version.return_value = '2:12.0.0-0ubuntu1'
+        self.assertEqual(openstack_release('nova-common'), 'liberty')
+        _installed_version.return_value = None
+        self.assertEqual(openstack_release(), 'kilo')
+
+    @patch('pg_edge_iptables.load_rules')
+    @patch.object(nutils, 'get_mgmt_interface')
+    @patch.object(nutils, 'get_cidr_from_iface')
+    def test_load_iptables(self, _cidr, _mgmt, _load_rules):
+        _cidr.return_value = None
+        nutils.load_iptables()
+        self.assertFalse(_load_rules.called)
+        _cidr.return_value = '10.0.0.0/24'
+        nutils.load_iptables()
+        _load_rules.assert_called_once_with('10.0.0.0/24')
+
+    @patch('pg_edge_context._pg_dir_context')
+    @patch.object(nutils, 'kv')
+    def test_director_state_delta(self, _kv, _pg_dir_context):
+        _kv.return_value = Storage(':memory:')
+        _pg_dir_context.return_value = {
+            'director_ips': ['10.0.0.3', '10.0.0.1', '10.0.0.2'],
+            'opsvm_ip': '127.0.0.1'}
+        self.assertEqual(sorted(nutils.director_state_delta().keys()),
+                         ['director_ips', 'opsvm_ip'])
+        nutils.commit_director_state()
+        self.assertFalse(nutils.director_state_delta())
+        _pg_dir_context.return_value = {
+            'director_ips': ['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+            'opsvm_ip': '10.0.0.9'}
+        delta = nutils.director_state_delta()
+        self.assertEqual(delta.keys(), ['opsvm_ip'])
+        self.assertEqual(delta['opsvm_ip'].current, '10.0.0.9')
+        nutils.commit_director_state(skip=['opsvm_ip'])
+        self.assertEqual(nutils.director_state_delta().keys(), ['opsvm_ip'])
+        nutils.commit_director_state()
+        self.assertFalse(nutils.director_state_delta())
+
+    def test_compile_fabric_interfaces(self):
+        index = nutils.compile_fabric_interfaces(json.dumps(OrderedDict([
+            ('edge-1', 'eth2'),
+            ('re:edge-(1|2)[0-9]+', 'eth3'),
+            ('@rack2', 'bond0'),
+            ('rack3-*', 'eth4'),
+            ('DEFAULT', 'eth1'),
+            ('GROUPS', {'rack2': ['edge-7', 'edge-1', 'r2-*']}),
+        ])))
+        lookup = nutils.fabric_interface_for
+        self.assertEqual(lookup(index, 'edge-1'), 'eth2')
+        self.assertEqual(lookup(index, 'edge-7'), 'bond0')
+        self.assertEqual(lookup(index, 'edge-15'), 'eth3')
+        self.assertEqual(lookup(index, 'edge-15.maas'), 'eth1')
+        self.assertEqual(lookup(index, 'r2-node'), 'bond0')
+        self.assertEqual(lookup(index, 'rack3-node1'), 'eth4')
+        self.assertEqual(lookup(index, 'other'), 'eth1')
+        self.assertIsNone(lookup(nutils.compile_fabric_interfaces(
+            '{"edge-1": "eth2"}'), 'edge-2'))
+
+    def test_compile_fabric_interfaces_invalid(self):
+        for fabric_interfaces in ['{"edge-1": ', '["eth1"]',
+                                  '{"edge-1": 1}', '{"re:edge-(": "eth1"}',
+                                  '{"@rack1": "eth1"}',
+                                  '{"GROUPS": {"rack1": "edge-1"}}',
+                                  '{"GROUPS": {"r": [""]}, "@r": "eth1"}']:
+            self.assertRaises(ValueError, nutils.compile_fabric_interfaces,
+                              fabric_interfaces)
+        with self.assertRaises(ValueError) as error:
+            nutils.compile_fabric_interfaces(
+                '{"GROUPS": {"r": ["edge-1", 1]}, "@r": "eth1"}')
+        self.assertEqual(str(error.exception),
+                         'Invalid host 1 in fabric interfaces group r')
+
+    @patch.object(nutils, 'compile_fabric_interfaces')
+    @patch.object(nutils, 'kv')
+    def test_lookup_fabric_interface(self, _kv, _compile):
+        _kv.return_value = Storage(':memory:')
+        _compile.side_effect = _compile_fabric_interfaces
+        fabric_interfaces = '{"edge-1": "eth2", "DEFAULT": "eth1"}'
+        self.assertEqual(
+            nutils.lookup_fabric_interface(fabric_interfaces, 'edge-1'),
+            'eth2')
+        self.assertEqual(
+            nutils.lookup_fabric_interface(fabric_interfaces, 'edge-1'),
+            'eth2')
+        # a new hook run is answered from unitdata
+        hookenv.cache = {}
+        self.assertEqual(
+            nutils.lookup_fabric_interface(fabric_interfaces, 'edge-1'),
+            'eth2')
+        self.assertEqual(_compile.call_count, 1)
+        self.assertEqual(
+            nutils.lookup_fabric_interface(fabric_interfaces, 'edge-2'),
+            'eth1')
+        self.assertEqual(_compile.call_count, 1)
+        self.assertEqual(
+            nutils.lookup_fabric_interface('{"DEFAULT": "eth3"}', 'edge-2'),
+            'eth3')
+        self.assertEqual(_compile.call_count, 2)
+
+    @patch('pg_edge_net.reconcile_mtu')
+    @patch('pg_edge_net.bridge_members')
+    @patch.object(nutils, 'get_fabric_interface')
+    @patch.object(nutils, 'config')
+    def test_ensure_mtu(self, _config, _fabric, _members, _reconcile):
+        _config.return_value = '1580'
+        _fabric.return_value = 'br0'
+        _members.return_value = ['eth1', 'eth2']
+        _reconcile.return_value = [('eth1', 1500, 1580)]
+        self.assertEqual(nutils.ensure_mtu(), [('eth1', 1500, 1580)])
+        _reconcile.assert_called_with([['eth1', 'eth2'], ['br0']], '1580')
+
+    def test_proc_children(self):
+        child = subprocess.Popen(['sleep', '10'])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        self.assertIn(child.pid, nutils._proc_children(os.getpid()))
+
+    @patch.object(nutils, '_proc_children')
+    def test_pg_container_init_pid(self, _children):
+        hookenv.cache = {}
+        pid_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(pid_file.close)
+        _children.return_value = [os.getpid()]
+        with patch.object(nutils, 'PG_PID_FILE', pid_file.name):
+            self.assertEqual(nutils.pg_container_init_pid(), None)
+            pid_file.write('4242\n')
+            pid_file.flush()
+            self.assertEqual(nutils.pg_container_init_pid(), os.getpid())
+            self.assertEqual(nutils.pg_container_init_pid(), os.getpid())
+        _children.assert_called_once_with(4242)
+
+    @patch('pg_edge_context._pg_dir_context')
+    @patch.object(nutils, 'pg_container_init_pid')
+    @patch.object(nutils, 'container_exec')
+    @patch.object(nutils, 'service_running')
+    @patch.object(nutils, 'kv')
+    def test_configure_analyst_opsvm(self, _kv, _running, _exec, _init_pid,
+                                     _pg_dir_context):
+        _kv.return_value = Storage(':memory:')
+        _running.return_value = True
+        _init_pid.return_value = 4243
+        _pg_dir_context.return_value = {'opsvm_ip': '10.0.0.9'}
+        _exec.return_value = (0, 'plumgrid-sigmund start/running')
+        self.assertTrue(nutils.configure_analyst_opsvm())
+        _exec.assert_called_with([nutils.SIGMUND_CONFIGURE, '--ip',
+                                  '10.0.0.9', '--start', '--autoboot'])
+        _exec.reset_mock()
+        self.assertTrue(nutils.configure_analyst_opsvm())
+        _exec.assert_called_once_with(nutils.SIGMUND_SERVICE + ['status'])
+        _init_pid.return_value = 5000
+        self.assertTrue(nutils.configure_analyst_opsvm())
+        _pg_dir_context.return_value = {'opsvm_ip': '10.0.0.10'}
+        _exec.side_effect = lambda cmd: (
+            (1, '') if cmd[0] == nutils.SIGMUND_CONFIGURE
+            else (0, 'plumgrid-sigmund start/running'))
+        self.assertFalse(nutils.configure_analyst_opsvm())
+        self.assertFalse(nutils.analyst_opsvm_retry())
+
+    @patch('pg_edge_context._pg_dir_context')
+    @patch('pg_edge_restarts.request_restart')
+    @patch.object(nutils, 'container_exec')
+    @patch.object(nutils, 'service_running')
+    @patch.object(nutils, 'kv')
+    def test_configure_analyst_opsvm_not_running(self, _kv, _running, _exec,
+                                                 _request_restart,
+                                                 _pg_dir_context):
+        _kv.return_value = Storage(':memory:')
+        _running.return_value = False
+        self.assertFalse(nutils.configure_analyst_opsvm())
+        _request_restart.assert_called_once_with('restart', 'opsvm')
+        self.assertFalse(_exec.called)
+        self.assertTrue(nutils.analyst_opsvm_retry())
+        self.assertFalse(nutils.analyst_opsvm_retry())
+
+    @patch.object(subprocess, 'Popen')
+    @patch.object(nutils, 'pg_container_init_pid')
+    def test_container_exec(self, _init_pid, _popen):
+        _init_pid.return_value = None
+        self.assertRaises(ValueError, nutils.container_exec, ['true'])
+        _init_pid.return_value = 4243
+        _popen.return_value.communicate.return_value = ('out', None)
+        _popen.return_value.returncode = 0
+        self.assertEqual(nutils.container_exec(['true']), (0, 'out'))
+        self.assertEqual(_popen.call_args[0][0],
+                         [nutils.NSENTER, '-t', '4243', '-m', '-n', '-u',
+                          '-i', '-p', 'true'])
+
+    @patch('pg_edge_lcm.authorize_keys')
+    def test_add_lcm_key(self, _authorize):
+        _authorize.return_value = 1
+        self.assertEqual(nutils.add_lcm_key(), 1)
+        _authorize.assert_called_once_with(nutils.AUTH_KEY_PATH)